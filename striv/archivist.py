@@ -5,6 +5,7 @@ import sys
 import time
 from argparse import ArgumentParser
 from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode
 from urllib3.util.retry import Retry
 
 import requests
@@ -24,7 +25,7 @@ parser.add_argument(
         'STRIV_ARCHIVE_MAX_AGE',
         86400000
     ),
-    help='Oldest run to consider on startup in milliseconds'
+    help='Oldest finished run to consider on startup in milliseconds'
 )
 parser.add_argument(
     '--worker-base-url',
@@ -63,19 +64,26 @@ http.mount("https://", adapter)
 http.mount("http://", adapter)
 
 
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
+FINISHED_STATUSES = ('successful', 'failed')
+
+
 def start_from_max_age(max_age):
     start = datetime.now(timezone.utc) - timedelta(milliseconds=max_age)
-    return start.strftime('%Y-%m-%dT%H:%M:%S%z')
+    return start.strftime(TIMESTAMP_FORMAT)
 
 
-def runs_since(base, start):
-    '''Generator over all runs since start time.'''
-    path = f'/runs?lower={start}'
+def finished_runs_since(base, finished_after):
+    '''Generator over all runs that finished after the given time.'''
+    path = '/runs?' + urlencode(
+        [('status', status) for status in FINISHED_STATUSES] +
+        [('finished_after', finished_after)]
+    )
     while True:
         response = http.get(base + path)
         if response.status_code != requests.codes['ok']:
             raise RuntimeError(
-                f'Failed retrieving runs [start={start}, status={response.status_code}, body={response.text}]')
+                f'Failed retrieving runs [finished_after={finished_after}, status={response.status_code}, body={response.text}]')
         for run_id, run in response.json().items():
             logger.debug(
                 'Received run [id=%s, status=%s]', run_id, run['status'])
@@ -86,85 +94,98 @@ def runs_since(base, start):
             break
 
 
-class UniqueFinishedRuns:
-    def __init__(self):
-        self.seen_runs = {}
-
-    def process(self, runs):
-        '''Generator yielding previously unknown finished runs.'''
-        for run_id, run in runs:
-            if run['status'] in ['successful', 'failed']:
-                if run_id not in self.seen_runs:
-                    self.seen_runs[run_id] = run['created_at']
-                    yield (run_id, run)
-
-    def prune(self, earliest):
-        to_prune = [
-            run_id for run_id, created_at in self.seen_runs.items()
-            if created_at < earliest
-        ]
-        for run_id in to_prune:
-            del self.seen_runs[run_id]
-
-
-class OldestUnfinishedRun:
-    def __init__(self):
-        self.oldest = None
-
-    def process(self, runs):
-        '''The oldest observed run that is not done.'''
-        for run_id, run in runs:
-            if self.oldest is None:
-                self.oldest = run['created_at']
-            elif run['status'] not in ['successful', 'failed']:
-                self.oldest = run['created_at']
-            yield (run_id, run)
+def feed_head(base):
+    '''The latest change sequence number.'''
+    response = http.get(base + '/changes?since=0&types=run&limit=1')
+    if response.status_code != requests.codes['ok']:
+        raise RuntimeError(
+            f'Failed retrieving change feed head [status={response.status_code}, body={response.text}]')
+    return response.json()['head']
+
 
-    def next_start(self):
-        return self.oldest
+def run_changes_since(base, since):
+    '''
+    Generator over (seq, run_id, run) for runs changed after change
+    sequence number since. run is None for deleted runs.
+    '''
+    path = '/changes?' + urlencode([('since', since), ('types', 'run')])
+    while True:
+        response = http.get(base + path)
+        if response.status_code != requests.codes['ok']:
+            raise RuntimeError(
+                f'Failed retrieving changes [since={since}, status={response.status_code}, body={response.text}]')
+        for change in response.json()['changes']:
+            yield (change['seq'], change['id'], change.get('entity'))
+        if response.headers.get('Link'):
+            path = re.match('<([^>]+)>', response.headers['Link'])[1]
+        else:
+            break
 
 
-def run_once(start, unique_filter, remember_oldest, base_url):
-    runs = unique_filter.process(
-        remember_oldest.process(
-            runs_since(base_url, start)
+def archive_logs(base_url, run_id, run):
+    path = f'/run/{run_id}/logs?max_size=0'
+    response = http.get(base_url + path)
+    if response.status_code == requests.codes['ok']:
+        logger.info(
+            'Triggering log archiving [run=%s. finished=%s]',
+            run_id,
+            run['finished_at']
         )
-    )
-    for run_id, run in runs:
-        path = f'/run/{run_id}/logs?max_size=0'
-        response = http.get(base_url + path)
-        if response.status_code == requests.codes['ok']:
-            logger.info(
-                'Triggering log archiving [run=%s. created=%s]',
-                run_id,
-                run['created_at']
-            )
-        else:
-            logger.warning(
-                'Log archiving failed [run=%s. created=%s, status=%d, body=%s]',
-                run_id,
-                run['created_at'],
-                response.status_code,
-                response.text
-            )
-    start = remember_oldest.next_start() or start
-    unique_filter.prune(start)
-    return start
+    else:
+        logger.warning(
+            'Log archiving failed [run=%s. finished=%s, status=%d, body=%s]',
+            run_id,
+            run['finished_at'],
+            response.status_code,
+            response.text
+        )
+
+
+def bootstrap(base_url, earliest):
+    '''
+    Archive runs that finished after earliest, including runs written
+    before the change feed existed or while the archivist was down.
+    Returns the ids of archived runs.
+    '''
+    archived = set()
+    for run_id, run in finished_runs_since(base_url, earliest):
+        archive_logs(base_url, run_id, run)
+        archived.add(run_id)
+    return archived
+
+
+def run_once(since, base_url, skip=()):
+    '''
+    Archive runs that finished among the runs changed after change
+    sequence number since. A run gets a new sequence number whenever
+    it is written, so runs reported long after they finished are still
+    seen. Runs in skip are left alone. Returns the sequence number to
+    continue from.
+    '''
+    for (seq, run_id, run) in run_changes_since(base_url, since):
+        since = seq
+        if run is None or run.get('status') not in FINISHED_STATUSES or run_id in skip:
+            continue
+        archive_logs(base_url, run_id, run)
+    return since
 
 
 def run(args, running=set([True])):
-    start = start_from_max_age(args.max_age)
-    unique_filter = UniqueFinishedRuns()
-    remember_oldest = OldestUnfinishedRun()
+    earliest = start_from_max_age(args.max_age)
     logger.warning(
-        'Archivist starting [base_url=%s, start=%s, interval=%d]',
+        'Archivist starting [base_url=%s, earliest=%s, interval=%d]',
         args.worker_base_url,
-        start,
+        earliest,
         args.archive_interval
     )
+    # The feed is followed from where it stood before the bootstrap, so
+    # that nothing changed during the bootstrap is missed without
+    # reading the feed's history; runs already archived are skipped.
+    since = feed_head(args.worker_base_url)
+    skip = bootstrap(args.worker_base_url, earliest)
     while running:
-        start = run_once(start, unique_filter,
-                         remember_oldest, args.worker_base_url)
+        since = run_once(since, args.worker_base_url, skip)
+        skip = ()
         time.sleep(args.archive_interval / 1000.0)
 
 
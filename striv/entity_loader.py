@@ -0,0 +1,42 @@
+from striv.errors import EntityNotFound
+
+
+class EntityLoader:
+    '''
+    Loads entities on behalf of a single request. Keys that are primed
+    or requested together are resolved in one store call and loaded
+    entities are memoized, so asking for the same entity twice does
+    not reach the store again. Keys are (type, id) tuples, as with
+    load_entities. The loader should not be used to read back entities
+    that the request has written.
+    '''
+
+    def __init__(self, store):
+        self.store = store
+        self.cache = {}
+        self.pending = set()
+
+    def prime(self, *keys):
+        '''
+        Queue keys to be resolved with the next load.
+        '''
+        self.pending.update(key for key in keys if key not in self.cache)
+
+    def load(self, *keys):
+        '''
+        Return entities for keys in the order given, raising
+        EntityNotFound for the first key that does not exist.
+        '''
+        self.prime(*keys)
+        if self.pending:
+            query = sorted(self.pending)
+            self.pending = set()
+            found = self.store.load_entities(*query, ignore_missing=True)
+            self.cache.update(zip(query, found))
+        entities = []
+        for key in keys:
+            entity = self.cache[key]
+            if entity is None:
+                raise EntityNotFound('%s:%s' % key)
+            entities.append(entity)
+        return entities
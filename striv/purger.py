@@ -0,0 +1,106 @@
+import logging
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+import requests
+
+logger = logging.getLogger('purge-worker')
+handler = logging.StreamHandler(sys.stderr)
+handler.setFormatter(logging.Formatter(
+    '%(asctime)s  [%(levelname)s] %(message)s')
+)
+logger.addHandler(handler)
+
+parser = ArgumentParser(description='Run purge worker')
+parser.add_argument(
+    '--worker-base-url',
+    default=os.environ.get(
+        'STRIV_WORKER_BASE_URL',
+        'http://localhost:8081'
+    ),
+    help='Base url where striv API is located',
+)
+parser.add_argument(
+    '--purge-interval',
+    type=int,
+    default=os.environ.get(
+        'STRIV_PURGE_INTERVAL',
+        3600000
+    ),
+    help='Purge expired runs every interval in milliseconds',
+)
+parser.add_argument(
+    '--purge-batch-size',
+    type=int,
+    default=os.environ.get(
+        'STRIV_PURGE_BATCH_SIZE',
+        1000
+    ),
+    help='Max number of runs to delete in one batch',
+)
+parser.add_argument(
+    '--purge-pause',
+    type=int,
+    default=os.environ.get(
+        'STRIV_PURGE_PAUSE',
+        1000
+    ),
+    help='Pause between batches in milliseconds, to let the API in',
+)
+parser.add_argument(
+    '--purge-backoff',
+    type=int,
+    default=os.environ.get(
+        'STRIV_PURGE_BACKOFF',
+        5000
+    ),
+    help='Backoff interval in case of striv API failure'
+)
+parser.add_argument(
+    '--log-level',
+    default=os.environ.get(
+        'STRIV_LOG_LEVEL',
+        'WARNING'
+    ),
+    help='One of DEBUG, INFO, WARNING or ERROR'
+)
+
+
+def purge_once(args):
+    '''
+    Purge batches until a batch comes back short. Returns the number of
+    deleted runs.
+    '''
+    total = 0
+    while True:
+        response = requests.post(
+            args.worker_base_url + '/runs/purge',
+            params={'batch_size': args.purge_batch_size}
+        )
+        if response.status_code != requests.codes['ok']:
+            raise RuntimeError(
+                f'Failed purging runs [status={response.status_code}, body={response.text}]')
+        deleted = response.json()['deleted']
+        total += deleted
+        logger.info('Purged runs [deleted=%d, total=%d]', deleted, total)
+        if deleted < args.purge_batch_size:
+            return total
+        time.sleep(args.purge_pause / 1000.0)
+
+
+def run(args, running=set([True])):
+    while running:
+        try:
+            purge_once(args)
+            time.sleep(args.purge_interval / 1000.0)
+        except RuntimeError as err:
+            logger.warning('%s', err)
+            time.sleep(args.purge_backoff / 1000.0)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    logger.setLevel(args.log_level)
+    run(args)
@@ -1,14 +1,32 @@
+import json
+
 from mysql.connector import connect, errors
 
 ENTITY_TABLE_DEF = '''
 CREATE TABLE IF NOT EXISTS entities (
     typed_id VARCHAR(128) PRIMARY KEY,
+    type VARCHAR(32),
     sortkey VARCHAR(128),
-    entity TEXT
+    entity JSON,
+    content_hash CHAR(40),
+    name VARCHAR(128) AS (JSON_UNQUOTE(JSON_EXTRACT(entity, '$.name'))) VIRTUAL,
+    execution VARCHAR(128) AS (JSON_UNQUOTE(JSON_EXTRACT(entity, '$.execution'))) VIRTUAL
 )
 '''
-SORTKEY_INDEX_DEF = '''
-CREATE INDEX sortkey ON entities (sortkey)
+# Entity fields that can be filtered on in SQL
+ENTITY_FIELD_DEFS = {
+    'name': "VARCHAR(128) AS (JSON_UNQUOTE(JSON_EXTRACT(entity, '$.name'))) VIRTUAL",
+    'execution': "VARCHAR(128) AS (JSON_UNQUOTE(JSON_EXTRACT(entity, '$.execution'))) VIRTUAL",
+}
+ENTITY_FIELD_INDEX_DEF = '''
+CREATE INDEX entities_%s ON entities (type, %s)
+'''
+TYPE_SORTKEY_INDEX_DEF = '''
+CREATE INDEX type_sortkey ON entities (type, sortkey)
+'''
+BACKFILL_TYPE = '''
+UPDATE entities SET type = SUBSTRING_INDEX(typed_id, ':', 1)
+WHERE type IS NULL LIMIT %d
 '''
 RELATION_TABLE_DEF = '''
 CREATE TABLE IF NOT EXISTS relations (
@@ -20,6 +38,96 @@ CREATE TABLE IF NOT EXISTS relations (
 RELATION_INDEX_DEF = '''
 CREATE INDEX lookup ON relations (relation, secondary_key)
 '''
+RELATION_KEY_INDEX_DEF = '''
+CREATE UNIQUE INDEX relation_key ON relations (typed_id, relation, secondary_key)
+'''
+DEDUPLICATE_RELATIONS = [
+    '''CREATE TEMPORARY TABLE distinct_relations AS
+    SELECT DISTINCT typed_id, relation, secondary_key FROM relations''',
+    'DELETE FROM relations',
+    '''INSERT INTO relations (typed_id, relation, secondary_key)
+    SELECT typed_id, relation, secondary_key FROM distinct_relations''',
+    'DROP TABLE distinct_relations',
+]
+INDEX_STATE_TABLE_DEF = '''
+CREATE TABLE IF NOT EXISTS index_state (
+    name VARCHAR(128) PRIMARY KEY,
+    state VARCHAR(16)
+)
+'''
+GENERATION_TABLE_DEF = '''
+CREATE TABLE IF NOT EXISTS generations (
+    type VARCHAR(32) PRIMARY KEY,
+    generation BIGINT
+)
+'''
+RUN_TABLE_DEF = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id VARCHAR(128) PRIMARY KEY,
+    job_id VARCHAR(128),
+    execution VARCHAR(128),
+    status VARCHAR(32),
+    created_at BIGINT,
+    started_at BIGINT,
+    finished_at BIGINT,
+    archived_at BIGINT,
+    seq BIGINT,
+    content_hash CHAR(40)
+)
+'''
+# InnoDB secondary indexes implicitly carry the primary key (run_id)
+RUN_CREATED_INDEX_DEF = '''
+CREATE INDEX runs_created ON runs (created_at)
+'''
+RUN_JOB_INDEX_DEF = '''
+CREATE INDEX runs_job ON runs (job_id, created_at)
+'''
+# Serves the last finish time per status in run summaries
+RUN_JOB_STATUS_INDEX_DEF = '''
+CREATE INDEX runs_job_status ON runs (job_id, status, finished_at)
+'''
+# Serves polling for newly finished runs
+RUN_FINISHED_INDEX_DEF = '''
+CREATE INDEX runs_finished ON runs (finished_at, status)
+'''
+# Change feed: every written row is stamped with the next value of
+# a sequence and deletions leave tombstones
+ENTITY_SEQ_INDEX_DEF = '''
+CREATE INDEX entities_seq ON entities (seq)
+'''
+RUN_SEQ_INDEX_DEF = '''
+CREATE INDEX runs_seq ON runs (seq)
+'''
+TOMBSTONE_TABLE_DEF = '''
+CREATE TABLE IF NOT EXISTS tombstones (
+    typed_id VARCHAR(128) PRIMARY KEY,
+    type VARCHAR(32),
+    seq BIGINT
+)
+'''
+TOMBSTONE_SEQ_INDEX_DEF = '''
+CREATE INDEX tombstones_seq ON tombstones (seq)
+'''
+SEQUENCE_TABLE_DEF = '''
+CREATE TABLE IF NOT EXISTS sequences (
+    name VARCHAR(32) PRIMARY KEY,
+    value BIGINT
+)
+'''
+RUN_SUMMARY_TABLE_DEF = '''
+CREATE TABLE IF NOT EXISTS run_summaries (
+    job_key VARCHAR(128) PRIMARY KEY,
+    summary TEXT,
+    expires_at BIGINT
+)
+'''
+RUN_SUMMARY_EXPIRES_INDEX_DEF = '''
+CREATE INDEX run_summaries_expires ON run_summaries (expires_at)
+'''
+
+BEGIN = 'START TRANSACTION'
+LOCK_ROWS = ' FOR UPDATE'
+INSERT_PAGE_SIZE = 1000
 
 
 def connection(connargs):
@@ -30,6 +138,14 @@ def connection(connargs):
     return conn
 
 
+def max_connections(_):
+    return None
+
+
+def ping(conn):
+    return conn.is_connected()
+
+
 def ensure_database(connargs):
     props = connargs.copy()
     db = props.pop('database')
@@ -37,16 +153,243 @@ def ensure_database(connargs):
     c.cursor().execute('CREATE DATABASE IF NOT EXISTS %s' % db)
 
 
-def ensure_ddl(conn):
-    conn.cursor().execute(ENTITY_TABLE_DEF)
+def insert_values(cur, query, rows):
+    '''
+    Execute an INSERT whose VALUES clause is a single %s for all rows,
+    sending multi-row VALUES lists in pages.
+    '''
+    for offset in range(0, len(rows), INSERT_PAGE_SIZE):
+        page = rows[offset:offset + INSERT_PAGE_SIZE]
+        row_qs = '(%s)' % ', '.join(['%s'] * len(page[0]))
+        cur.execute(
+            query % ', '.join([row_qs] * len(page)),
+            [value for row in page for value in row]
+        )
+
+
+def load_json(value):
+    return json.loads(value)
+
+
+def project_json(_fields):
+    '''
+    mysql 5.7 cannot drop absent keys when building a JSON object, so
+    entities are projected after loading.
+    '''
+    return None
+
+
+def bucket_expression(column, width):
+    '''
+    SQL expression truncating an integer column to a multiple of width.
+    '''
+    return '(%s DIV %d) * %d' % (column, width, width)
+
+
+def percentiles_expression(_expression, _fractions):
+    '''
+    mysql 5.7 has no percentile aggregate, so percentiles are computed
+    from the ordered values.
+    '''
+    return None
+
+
+def stream_cursor(conn):
+    '''
+    An unbuffered cursor reads rows off the wire as they are consumed.
+    '''
+    return conn.cursor(buffered=False)
+
+
+def close_stream(conn, cur):
+    '''
+    A stream that was abandoned early leaves rows unread, and the
+    connection cannot be used again until they are drained.
+    '''
+    if conn.unread_result:
+        conn.consume_results()
+    cur.close()
+
+
+def _column_type(conn, table, column):
+    cur = conn.cursor()
+    cur.execute(
+        '''SELECT data_type FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s''',
+        [table, column]
+    )
+    return cur.fetchall()[0][0]
+
+
+def _has_column(conn, table, column):
+    cur = conn.cursor()
+    cur.execute(
+        '''SELECT 1 FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s''',
+        [table, column]
+    )
+    found = cur.fetchall()
+    return len(found) > 0
+
+
+def _has_index(conn, table, index):
+    cur = conn.cursor()
+    cur.execute(
+        '''SELECT 1 FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s''',
+        [table, index]
+    )
+    found = cur.fetchall()
+    return len(found) > 0
+
+
+def _add_column(conn, table, column, definition):
+    if _has_column(conn, table, column):
+        return False
+    conn.cursor().execute('ALTER TABLE %s ADD COLUMN %s %s' %
+                          (table, column, definition))
+    return True
+
+
+def _migrate_type_column(conn, batch_size):
+    '''
+    Entities used to be typed only by the prefix of typed_id. The
+    backfill runs in batches so that the API can keep serving.
+    '''
+    if not _add_column(conn, 'entities', 'type', 'VARCHAR(32)'):
+        return
+    while True:
+        cur = conn.cursor()
+        cur.execute(BACKFILL_TYPE % batch_size)
+        if cur.rowcount < batch_size:
+            break
     try:
-        conn.cursor().execute(SORTKEY_INDEX_DEF)
+        conn.cursor().execute('DROP INDEX sortkey ON entities')
     except errors.ProgrammingError as err:
-        if err.errno != 1061:
+        if err.errno != 1091:
             raise err
+
+
+def _migrate_entity_json(conn):
+    '''
+    Entities used to be stored as TEXT.
+    '''
+    if _column_type(conn, 'entities', 'entity') == 'text':
+        conn.cursor().execute('ALTER TABLE entities MODIFY entity JSON')
+
+
+def _migrate_relation_key(conn):
+    '''
+    Relations used to be allowed to contain duplicates. Remove them
+    before adding the unique index.
+    '''
+    if _has_index(conn, 'relations', 'relation_key'):
+        return
+    conn.cursor().execute(BEGIN)
+    for statement in DEDUPLICATE_RELATIONS:
+        conn.cursor().execute(statement)
+    conn.cursor().execute(RELATION_KEY_INDEX_DEF)
+    conn.cursor().execute('COMMIT')
+
+
+def _run_partition_rows(conn):
+    cur = conn.cursor()
+    cur.execute(
+        '''SELECT partition_name, partition_description FROM information_schema.partitions
+        WHERE table_schema = DATABASE() AND table_name = 'runs' AND partition_name IS NOT NULL
+        ORDER BY partition_ordinal_position'''
+    )
+    return cur.fetchall()
+
+
+def _partition_defs(bounds):
+    return ', '.join('PARTITION %s VALUES LESS THAN (%d)' % (name, upper)
+                     for (name, _, upper) in bounds)
+
+
+def partition_runs(conn, bounds):
+    '''
+    Turn runs into a table partitioned on created_at, with one partition
+    for each (name, lower, upper) in bounds and a catch-all partition
+    for later runs. The first partition also holds all older runs.
+    Partitioning requires created_at to be part of the primary key.
+    Returns False if runs is already partitioned.
+    '''
+    if _run_partition_rows(conn):
+        return False
+    cur = conn.cursor()
+    cur.execute('ALTER TABLE runs MODIFY created_at BIGINT NOT NULL, '
+                'DROP PRIMARY KEY, ADD PRIMARY KEY (run_id, created_at)')
+    cur.execute('ALTER TABLE runs PARTITION BY RANGE (created_at) (%s, %s)' % (
+        _partition_defs(bounds), 'PARTITION runs_pmax VALUES LESS THAN MAXVALUE'))
+    return True
+
+
+def run_partitions(conn):
+    '''
+    Return (name, lower, upper) for each range partition of runs,
+    ordered by bound. The first partition has no lower bound and the
+    catch-all partition is not included.
+    '''
+    partitions = []
+    lower = None
+    for (name, description) in _run_partition_rows(conn):
+        if description == 'MAXVALUE':
+            break
+        partitions.append((name, lower, int(description)))
+        lower = int(description)
+    return partitions
+
+
+def add_run_partitions(conn, bounds):
+    '''
+    Split the partitions in bounds that do not yet exist off the
+    catch-all partition. Bounds below the last partition are skipped,
+    since range partitions can only be added at the end.
+    '''
+    existing = run_partitions(conn)
+    last = existing[-1][2] if existing else None
+    new = [(name, lower, upper) for (name, lower, upper) in bounds
+           if last is None or lower >= last]
+    if not new:
+        return
+    conn.cursor().execute('ALTER TABLE runs REORGANIZE PARTITION runs_pmax INTO (%s, %s)' % (
+        _partition_defs(new), 'PARTITION runs_pmax VALUES LESS THAN MAXVALUE'))
+
+
+def drop_run_partition(conn, name):
+    conn.cursor().execute('ALTER TABLE runs DROP PARTITION %s' % name)
+
+
+def ensure_ddl(conn, batch_size=10000):
+    conn.cursor().execute(ENTITY_TABLE_DEF)
+    _migrate_type_column(conn, batch_size)
+    _migrate_entity_json(conn)
+    _add_column(conn, 'entities', 'content_hash', 'CHAR(40)')
+    for (field, definition) in ENTITY_FIELD_DEFS.items():
+        _add_column(conn, 'entities', field, definition)
     conn.cursor().execute(RELATION_TABLE_DEF)
-    try:
-        conn.cursor().execute(RELATION_INDEX_DEF)
-    except errors.ProgrammingError as err:
-        if err.errno != 1061:
-            raise err
+    _migrate_relation_key(conn)
+    conn.cursor().execute(INDEX_STATE_TABLE_DEF)
+    conn.cursor().execute(GENERATION_TABLE_DEF)
+    conn.cursor().execute(RUN_TABLE_DEF)
+    _add_column(conn, 'runs', 'content_hash', 'CHAR(40)')
+    _add_column(conn, 'runs', 'archived_at', 'BIGINT')
+    _add_column(conn, 'runs', 'seq', 'BIGINT')
+    _add_column(conn, 'entities', 'seq', 'BIGINT')
+    conn.cursor().execute(RUN_SUMMARY_TABLE_DEF)
+    conn.cursor().execute(TOMBSTONE_TABLE_DEF)
+    conn.cursor().execute(SEQUENCE_TABLE_DEF)
+    field_index_defs = [ENTITY_FIELD_INDEX_DEF % (field, field)
+                        for field in ENTITY_FIELD_DEFS]
+    for index_def in [TYPE_SORTKEY_INDEX_DEF, RELATION_INDEX_DEF,
+                      RUN_CREATED_INDEX_DEF, RUN_JOB_INDEX_DEF, RUN_FINISHED_INDEX_DEF,
+                      RUN_JOB_STATUS_INDEX_DEF,
+                      RUN_SUMMARY_EXPIRES_INDEX_DEF,
+                      ENTITY_SEQ_INDEX_DEF, RUN_SEQ_INDEX_DEF, TOMBSTONE_SEQ_INDEX_DEF,
+                      *field_index_defs]:
+        try:
+            conn.cursor().execute(index_def)
+        except errors.ProgrammingError as err:
+            if err.errno != 1061:
+                raise err
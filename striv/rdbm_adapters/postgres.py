@@ -1,14 +1,36 @@
-from psycopg2 import connect, errors
+import re
+import uuid
+
+from psycopg2 import Error, connect, errors
+from psycopg2.extensions import (TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INERROR,
+                                  TRANSACTION_STATUS_INTRANS)
+from psycopg2.extras import execute_values
 
 ENTITY_TABLE_DEF = '''
 CREATE TABLE IF NOT EXISTS entities (
     typed_id VARCHAR(128) PRIMARY KEY,
+    type VARCHAR(32),
     sortkey VARCHAR(128),
-    entity TEXT
+    entity JSONB,
+    content_hash CHAR(40),
+    name TEXT GENERATED ALWAYS AS (entity->>'name') STORED,
+    execution TEXT GENERATED ALWAYS AS (entity->>'execution') STORED
 )
 '''
-SORTKEY_INDEX_DEF = '''
-CREATE INDEX IF NOT EXISTS sortkey ON entities (sortkey)
+# Entity fields that can be filtered on in SQL
+ENTITY_FIELD_DEFS = {
+    'name': "TEXT GENERATED ALWAYS AS (entity->>'name') STORED",
+    'execution': "TEXT GENERATED ALWAYS AS (entity->>'execution') STORED",
+}
+ENTITY_FIELD_INDEX_DEF = '''
+CREATE INDEX CONCURRENTLY IF NOT EXISTS entities_%s ON entities (type, %s)
+'''
+TYPE_SORTKEY_INDEX_DEF = '''
+CREATE INDEX CONCURRENTLY IF NOT EXISTS type_sortkey ON entities (type, sortkey)
+'''
+BACKFILL_TYPE = '''
+UPDATE entities SET type = split_part(typed_id, ':', 1)
+WHERE typed_id IN (SELECT typed_id FROM entities WHERE type IS NULL LIMIT %d)
 '''
 RELATION_TABLE_DEF = '''
 CREATE TABLE IF NOT EXISTS relations (
@@ -20,6 +42,121 @@ CREATE TABLE IF NOT EXISTS relations (
 RELATION_INDEX_DEF = '''
 CREATE INDEX IF NOT EXISTS lookup ON relations (relation, secondary_key)
 '''
+RELATION_KEY_INDEX_DEF = '''
+CREATE UNIQUE INDEX IF NOT EXISTS relation_key ON relations (typed_id, relation, secondary_key)
+'''
+DEDUPLICATE_RELATIONS = [
+    '''CREATE TEMPORARY TABLE distinct_relations AS
+    SELECT DISTINCT typed_id, relation, secondary_key FROM relations''',
+    'DELETE FROM relations',
+    '''INSERT INTO relations (typed_id, relation, secondary_key)
+    SELECT typed_id, relation, secondary_key FROM distinct_relations''',
+    'DROP TABLE distinct_relations',
+]
+INDEX_STATE_TABLE_DEF = '''
+CREATE TABLE IF NOT EXISTS index_state (
+    name VARCHAR(128) PRIMARY KEY,
+    state VARCHAR(16)
+)
+'''
+GENERATION_TABLE_DEF = '''
+CREATE TABLE IF NOT EXISTS generations (
+    type VARCHAR(32) PRIMARY KEY,
+    generation BIGINT
+)
+'''
+RUN_TABLE_DEF = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id VARCHAR(128) PRIMARY KEY,
+    job_id VARCHAR(128),
+    execution VARCHAR(128),
+    status VARCHAR(32),
+    created_at BIGINT,
+    started_at BIGINT,
+    finished_at BIGINT,
+    archived_at BIGINT,
+    seq BIGINT,
+    content_hash CHAR(40)
+)
+'''
+# Partitioned tables need the partition key in the primary key
+RUN_PARTITIONED_TABLE_DEF = '''
+CREATE TABLE runs (
+    run_id VARCHAR(128),
+    job_id VARCHAR(128),
+    execution VARCHAR(128),
+    status VARCHAR(32),
+    created_at BIGINT,
+    started_at BIGINT,
+    finished_at BIGINT,
+    archived_at BIGINT,
+    seq BIGINT,
+    content_hash CHAR(40),
+    PRIMARY KEY (run_id, created_at)
+) PARTITION BY RANGE (created_at)
+'''
+# Catches runs created outside the partitions created so far
+RUN_DEFAULT_PARTITION_DEF = '''
+CREATE TABLE IF NOT EXISTS runs_default PARTITION OF runs DEFAULT
+'''
+RUN_TABLE_COLUMNS = ('run_id, job_id, execution, status, created_at, started_at, '
+                     'finished_at, archived_at, seq, content_hash')
+# Run listings are served by index-only scans
+RUN_CREATED_INDEX_DEF = '''
+CREATE INDEX IF NOT EXISTS runs_created ON runs (created_at, run_id)
+INCLUDE (job_id, execution, status, started_at, finished_at)
+'''
+RUN_JOB_INDEX_DEF = '''
+CREATE INDEX IF NOT EXISTS runs_job ON runs (job_id, created_at, run_id)
+INCLUDE (execution, status, started_at, finished_at)
+'''
+# Serves the last finish time per status in run summaries
+RUN_JOB_STATUS_INDEX_DEF = '''
+CREATE INDEX IF NOT EXISTS runs_job_status ON runs (job_id, status, finished_at)
+'''
+# Serves polling for newly finished runs
+RUN_FINISHED_INDEX_DEF = '''
+CREATE INDEX IF NOT EXISTS runs_finished ON runs (finished_at, status)
+'''
+# Change feed: every written row is stamped with the next value of
+# a sequence and deletions leave tombstones
+ENTITY_SEQ_INDEX_DEF = '''
+CREATE INDEX CONCURRENTLY IF NOT EXISTS entities_seq ON entities (seq)
+'''
+RUN_SEQ_INDEX_DEF = '''
+CREATE INDEX IF NOT EXISTS runs_seq ON runs (seq)
+'''
+TOMBSTONE_TABLE_DEF = '''
+CREATE TABLE IF NOT EXISTS tombstones (
+    typed_id VARCHAR(128) PRIMARY KEY,
+    type VARCHAR(32),
+    seq BIGINT
+)
+'''
+TOMBSTONE_SEQ_INDEX_DEF = '''
+CREATE INDEX IF NOT EXISTS tombstones_seq ON tombstones (seq)
+'''
+SEQUENCE_TABLE_DEF = '''
+CREATE TABLE IF NOT EXISTS sequences (
+    name VARCHAR(32) PRIMARY KEY,
+    value BIGINT
+)
+'''
+RUN_SUMMARY_TABLE_DEF = '''
+CREATE TABLE IF NOT EXISTS run_summaries (
+    job_key VARCHAR(128) PRIMARY KEY,
+    summary TEXT,
+    expires_at BIGINT
+)
+'''
+RUN_SUMMARY_EXPIRES_INDEX_DEF = '''
+CREATE INDEX IF NOT EXISTS run_summaries_expires ON run_summaries (expires_at)
+'''
+
+BEGIN = 'BEGIN'
+LOCK_ROWS = ' FOR UPDATE'
+INSERT_PAGE_SIZE = 1000
+STREAM_FETCH_SIZE = 500
 
 
 def connection(connargs):
@@ -30,6 +167,20 @@ def connection(connargs):
     return conn
 
 
+def max_connections(_):
+    return None
+
+
+def ping(conn):
+    if conn.closed:
+        return False
+    try:
+        conn.cursor().execute('SELECT 1')
+        return True
+    except Error:
+        return False
+
+
 def ensure_database(connargs):
     props = connargs.copy()
     db = props.pop('dbname')
@@ -41,8 +192,299 @@ def ensure_database(connargs):
         pass
 
 
-def ensure_ddl(conn):
+def insert_values(cur, query, rows):
+    '''
+    Execute an INSERT whose VALUES clause is a single %s for all rows,
+    sending multi-row VALUES lists in pages.
+    '''
+    if not rows:
+        return
+    execute_values(cur, query, rows, page_size=INSERT_PAGE_SIZE)
+
+
+def load_json(value):
+    '''
+    psycopg2 already decodes JSONB columns.
+    '''
+    return value
+
+
+def project_json(fields):
+    '''
+    SQL expression reducing the entity column to fields. Takes fields
+    as query parameters.
+    '''
+    if not fields:
+        return "'{}'::jsonb"
+    return '''(SELECT COALESCE(jsonb_object_agg(key, value), '{}'::jsonb)
+    FROM jsonb_each(entity) WHERE key IN (%s))''' % ', '.join(['%s'] * len(fields))
+
+
+def bucket_expression(column, width):
+    '''
+    SQL expression truncating an integer column to a multiple of width.
+    '''
+    return '(%s / %d) * %d' % (column, width, width)
+
+
+def percentiles_expression(expression, fractions):
+    '''
+    Aggregate returning an array with the continuous percentiles of
+    expression at each of fractions.
+    '''
+    return 'percentile_cont(ARRAY[%s]::float8[]) WITHIN GROUP (ORDER BY %s)' % (
+        ', '.join('%r' % float(f) for f in fractions), expression)
+
+
+class _StreamCursor:
+    '''
+    Reads rows in batches from a server-side cursor declared in a
+    transaction. Holdable cursors, the only named cursors psycopg2
+    allows in autocommit mode, materialize the whole result before the
+    first fetch. Outside a store transaction, the cursor gets a
+    transaction of its own which ends when the stream is closed.
+    '''
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.cur = conn.cursor()
+        self.name = 'stream_%s' % uuid.uuid4().hex
+        self.owns_transaction = False
+
+    def execute(self, query, args=None):
+        if self.conn.info.transaction_status == TRANSACTION_STATUS_IDLE:
+            self.cur.execute('BEGIN')
+            self.owns_transaction = True
+        self.cur.execute('DECLARE %s NO SCROLL CURSOR FOR %s' % (self.name, query), args)
+
+    def __iter__(self):
+        while True:
+            self.cur.execute('FETCH FORWARD %d FROM %s' % (STREAM_FETCH_SIZE, self.name))
+            rows = self.cur.fetchall()
+            if not rows:
+                return
+            yield from rows
+
+    def close(self):
+        try:
+            status = self.conn.info.transaction_status
+            if self.owns_transaction:
+                # Ending the transaction also closes the cursor
+                self.cur.execute('ROLLBACK' if status == TRANSACTION_STATUS_INERROR else 'COMMIT')
+            elif status == TRANSACTION_STATUS_INTRANS:
+                self.cur.execute('CLOSE %s' % self.name)
+        finally:
+            self.cur.close()
+
+
+def stream_cursor(conn):
+    '''
+    A server-side cursor fetches rows from the server in batches.
+    '''
+    return _StreamCursor(conn)
+
+
+def close_stream(_conn, cur):
+    cur.close()
+
+
+def _column_type(conn, table, column):
+    cur = conn.cursor()
+    cur.execute(
+        '''SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s''',
+        [table, column]
+    )
+    return cur.fetchone()[0]
+
+
+def _has_column(conn, table, column):
+    cur = conn.cursor()
+    cur.execute(
+        '''SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s''',
+        [table, column]
+    )
+    return cur.fetchone() is not None
+
+
+def _has_index(conn, table, index):
+    cur = conn.cursor()
+    cur.execute(
+        '''SELECT 1 FROM pg_indexes
+        WHERE schemaname = current_schema() AND tablename = %s AND indexname = %s''',
+        [table, index]
+    )
+    return cur.fetchone() is not None
+
+
+def _add_column(conn, table, column, definition):
+    if _has_column(conn, table, column):
+        return False
+    conn.cursor().execute('ALTER TABLE %s ADD COLUMN %s %s' %
+                          (table, column, definition))
+    return True
+
+
+def _migrate_type_column(conn, batch_size):
+    '''
+    Entities used to be typed only by the prefix of typed_id. The
+    backfill runs in batches so that the API can keep serving.
+    '''
+    if not _add_column(conn, 'entities', 'type', 'VARCHAR(32)'):
+        return
+    while True:
+        cur = conn.cursor()
+        cur.execute(BACKFILL_TYPE % batch_size)
+        if cur.rowcount < batch_size:
+            break
+    conn.cursor().execute('DROP INDEX IF EXISTS sortkey')
+
+
+def _migrate_entity_json(conn):
+    '''
+    Entities used to be stored as TEXT.
+    '''
+    if _column_type(conn, 'entities', 'entity') == 'text':
+        conn.cursor().execute(
+            'ALTER TABLE entities ALTER COLUMN entity TYPE JSONB USING entity::jsonb')
+
+
+def _migrate_relation_key(conn):
+    '''
+    Relations used to be allowed to contain duplicates. Remove them
+    before adding the unique index.
+    '''
+    if _has_index(conn, 'relations', 'relation_key'):
+        return
+    conn.cursor().execute(BEGIN)
+    for statement in DEDUPLICATE_RELATIONS:
+        conn.cursor().execute(statement)
+    conn.cursor().execute(RELATION_KEY_INDEX_DEF)
+    conn.cursor().execute('COMMIT')
+
+
+def _is_partitioned(conn, table):
+    cur = conn.cursor()
+    cur.execute(
+        '''SELECT relkind FROM pg_class
+        WHERE relname = %s AND relkind IN ('r', 'p') AND pg_table_is_visible(oid)''',
+        [table]
+    )
+    return cur.fetchone()[0] == 'p'
+
+
+def partition_runs(conn, bounds):
+    '''
+    Turn runs into a table partitioned on created_at, with one partition
+    for each (name, lower, upper) in bounds and a default partition for
+    runs outside them. Existing runs are copied in a single transaction.
+    Returns False if runs is already partitioned.
+    '''
+    if _is_partitioned(conn, 'runs'):
+        return False
+    cur = conn.cursor()
+    cur.execute(BEGIN)
+    try:
+        cur.execute('ALTER TABLE runs RENAME TO runs_unpartitioned')
+        cur.execute('ALTER TABLE runs_unpartitioned RENAME CONSTRAINT runs_pkey TO runs_unpartitioned_pkey')
+        for index in ('runs_created', 'runs_job', 'runs_finished', 'runs_seq'):
+            cur.execute('ALTER INDEX IF EXISTS %s RENAME TO %s_unpartitioned' % (index, index))
+        cur.execute(RUN_PARTITIONED_TABLE_DEF)
+        cur.execute(RUN_DEFAULT_PARTITION_DEF)
+        for (name, lower, upper) in bounds:
+            cur.execute('CREATE TABLE %s PARTITION OF runs FOR VALUES FROM (%d) TO (%d)' % (
+                name, lower, upper))
+        cur.execute('INSERT INTO runs (%s) SELECT %s FROM runs_unpartitioned' % (
+            RUN_TABLE_COLUMNS, RUN_TABLE_COLUMNS))
+        cur.execute('DROP TABLE runs_unpartitioned')
+        for index_def in (RUN_CREATED_INDEX_DEF, RUN_JOB_INDEX_DEF, RUN_FINISHED_INDEX_DEF,
+                          RUN_JOB_STATUS_INDEX_DEF, RUN_SEQ_INDEX_DEF):
+            cur.execute(index_def)
+    except Exception:
+        cur.execute('ROLLBACK')
+        raise
+    cur.execute('COMMIT')
+    return True
+
+
+def run_partitions(conn):
+    '''
+    Return (name, lower, upper) for each range partition of runs,
+    ordered by lower bound. The default partition is not included.
+    '''
+    cur = conn.cursor()
+    cur.execute(
+        '''SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'runs'::regclass'''
+    )
+    partitions = []
+    for (name, bound) in cur:
+        match = re.search(r"FROM \('?(-?\d+)'?\) TO \('?(-?\d+)'?\)", bound)
+        if match:
+            partitions.append((name, int(match[1]), int(match[2])))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def add_run_partitions(conn, bounds):
+    '''
+    Create the partitions in bounds that do not yet exist. Runs that
+    have already landed in the default partition are moved into the new
+    partition before it is attached.
+    '''
+    existing = set(name for (name, _, _) in run_partitions(conn))
+    for (name, lower, upper) in bounds:
+        if name in existing:
+            continue
+        cur = conn.cursor()
+        cur.execute(BEGIN)
+        try:
+            cur.execute('CREATE TABLE %s (LIKE runs INCLUDING DEFAULTS)' % name)
+            cur.execute(
+                '''WITH moved AS (
+                    DELETE FROM runs_default WHERE created_at >= %d AND created_at < %d
+                    RETURNING *
+                ) INSERT INTO %s SELECT * FROM moved''' % (lower, upper, name))
+            cur.execute('ALTER TABLE runs ATTACH PARTITION %s FOR VALUES FROM (%d) TO (%d)' % (
+                name, lower, upper))
+        except Exception:
+            cur.execute('ROLLBACK')
+            raise
+        cur.execute('COMMIT')
+
+
+def drop_run_partition(conn, name):
+    conn.cursor().execute('DROP TABLE %s' % name)
+
+
+def ensure_ddl(conn, batch_size=10000):
     conn.cursor().execute(ENTITY_TABLE_DEF)
-    conn.cursor().execute(SORTKEY_INDEX_DEF)
+    _migrate_type_column(conn, batch_size)
+    _migrate_entity_json(conn)
+    _add_column(conn, 'entities', 'content_hash', 'CHAR(40)')
+    conn.cursor().execute(TYPE_SORTKEY_INDEX_DEF)
+    for (field, definition) in ENTITY_FIELD_DEFS.items():
+        _add_column(conn, 'entities', field, definition)
+        conn.cursor().execute(ENTITY_FIELD_INDEX_DEF % (field, field))
     conn.cursor().execute(RELATION_TABLE_DEF)
+    _migrate_relation_key(conn)
     conn.cursor().execute(RELATION_INDEX_DEF)
+    conn.cursor().execute(INDEX_STATE_TABLE_DEF)
+    conn.cursor().execute(GENERATION_TABLE_DEF)
+    conn.cursor().execute(RUN_TABLE_DEF)
+    _add_column(conn, 'runs', 'content_hash', 'CHAR(40)')
+    _add_column(conn, 'runs', 'archived_at', 'BIGINT')
+    _add_column(conn, 'runs', 'seq', 'BIGINT')
+    _add_column(conn, 'entities', 'seq', 'BIGINT')
+    conn.cursor().execute(RUN_CREATED_INDEX_DEF)
+    conn.cursor().execute(RUN_JOB_INDEX_DEF)
+    conn.cursor().execute(RUN_FINISHED_INDEX_DEF)
+    conn.cursor().execute(RUN_JOB_STATUS_INDEX_DEF)
+    conn.cursor().execute(RUN_SUMMARY_TABLE_DEF)
+    conn.cursor().execute(RUN_SUMMARY_EXPIRES_INDEX_DEF)
+    conn.cursor().execute(ENTITY_SEQ_INDEX_DEF)
+    conn.cursor().execute(RUN_SEQ_INDEX_DEF)
+    conn.cursor().execute(TOMBSTONE_TABLE_DEF)
+    conn.cursor().execute(TOMBSTONE_SEQ_INDEX_DEF)
+    conn.cursor().execute(SEQUENCE_TABLE_DEF)
@@ -1,14 +1,31 @@
-from sqlite3 import connect
+import json
+from sqlite3 import Error, connect
 
 ENTITY_TABLE_DEF = '''
 CREATE TABLE IF NOT EXISTS entities (
     typed_id TEXT PRIMARY KEY,
+    type TEXT,
     sortkey TEXT,
-    entity TEXT
+    entity TEXT,
+    content_hash TEXT,
+    name TEXT AS (json_extract(entity, '$.name')) VIRTUAL,
+    execution TEXT AS (json_extract(entity, '$.execution')) VIRTUAL
 )
 '''
-SORTKEY_INDEX_DEF = '''
-CREATE INDEX IF NOT EXISTS sortkey ON entities (sortkey)
+# Entity fields that can be filtered on in SQL
+ENTITY_FIELD_DEFS = {
+    'name': "TEXT AS (json_extract(entity, '$.name')) VIRTUAL",
+    'execution': "TEXT AS (json_extract(entity, '$.execution')) VIRTUAL",
+}
+ENTITY_FIELD_INDEX_DEF = '''
+CREATE INDEX IF NOT EXISTS entities_%s ON entities (type, %s)
+'''
+TYPE_SORTKEY_INDEX_DEF = '''
+CREATE INDEX IF NOT EXISTS type_sortkey ON entities (type, sortkey)
+'''
+BACKFILL_TYPE = '''
+UPDATE entities SET type = substr(typed_id, 1, instr(typed_id, ':') - 1)
+WHERE typed_id IN (SELECT typed_id FROM entities WHERE type IS NULL LIMIT %d)
 '''
 RELATION_TABLE_DEF = '''
 CREATE TABLE IF NOT EXISTS relations (
@@ -20,16 +37,247 @@ CREATE TABLE IF NOT EXISTS relations (
 RELATION_INDEX_DEF = '''
 CREATE INDEX IF NOT EXISTS lookup ON relations (relation, secondary_key)
 '''
+RELATION_KEY_INDEX_DEF = '''
+CREATE UNIQUE INDEX IF NOT EXISTS relation_key ON relations (typed_id, relation, secondary_key)
+'''
+DEDUPLICATE_RELATIONS = [
+    '''CREATE TEMPORARY TABLE distinct_relations AS
+    SELECT DISTINCT typed_id, relation, secondary_key FROM relations''',
+    'DELETE FROM relations',
+    '''INSERT INTO relations (typed_id, relation, secondary_key)
+    SELECT typed_id, relation, secondary_key FROM distinct_relations''',
+    'DROP TABLE distinct_relations',
+]
+INDEX_STATE_TABLE_DEF = '''
+CREATE TABLE IF NOT EXISTS index_state (
+    name TEXT PRIMARY KEY,
+    state TEXT
+)
+'''
+GENERATION_TABLE_DEF = '''
+CREATE TABLE IF NOT EXISTS generations (
+    type TEXT PRIMARY KEY,
+    generation INTEGER
+)
+'''
+RUN_TABLE_DEF = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    job_id TEXT,
+    execution TEXT,
+    status TEXT,
+    created_at INTEGER,
+    started_at INTEGER,
+    finished_at INTEGER,
+    archived_at INTEGER,
+    seq INTEGER,
+    content_hash TEXT
+)
+'''
+RUN_CREATED_INDEX_DEF = '''
+CREATE INDEX IF NOT EXISTS runs_created ON runs (created_at, run_id)
+'''
+RUN_JOB_INDEX_DEF = '''
+CREATE INDEX IF NOT EXISTS runs_job ON runs (job_id, created_at, run_id)
+'''
+# Serves the last finish time per status in run summaries
+RUN_JOB_STATUS_INDEX_DEF = '''
+CREATE INDEX IF NOT EXISTS runs_job_status ON runs (job_id, status, finished_at)
+'''
+# Serves polling for newly finished runs
+RUN_FINISHED_INDEX_DEF = '''
+CREATE INDEX IF NOT EXISTS runs_finished ON runs (finished_at, status)
+'''
+# Change feed: every written row is stamped with the next value of
+# a sequence and deletions leave tombstones
+ENTITY_SEQ_INDEX_DEF = '''
+CREATE INDEX IF NOT EXISTS entities_seq ON entities (seq)
+'''
+RUN_SEQ_INDEX_DEF = '''
+CREATE INDEX IF NOT EXISTS runs_seq ON runs (seq)
+'''
+TOMBSTONE_TABLE_DEF = '''
+CREATE TABLE IF NOT EXISTS tombstones (
+    typed_id TEXT PRIMARY KEY,
+    type TEXT,
+    seq INTEGER
+)
+'''
+TOMBSTONE_SEQ_INDEX_DEF = '''
+CREATE INDEX IF NOT EXISTS tombstones_seq ON tombstones (seq)
+'''
+SEQUENCE_TABLE_DEF = '''
+CREATE TABLE IF NOT EXISTS sequences (
+    name TEXT PRIMARY KEY,
+    value INTEGER
+)
+'''
+RUN_SUMMARY_TABLE_DEF = '''
+CREATE TABLE IF NOT EXISTS run_summaries (
+    job_key TEXT PRIMARY KEY,
+    summary TEXT,
+    expires_at INTEGER
+)
+'''
+RUN_SUMMARY_EXPIRES_INDEX_DEF = '''
+CREATE INDEX IF NOT EXISTS run_summaries_expires ON run_summaries (expires_at)
+'''
+
+# Take the write lock up front so that read-then-write transactions
+# cannot deadlock on lock upgrade.
+BEGIN = 'BEGIN IMMEDIATE'
+# The write lock already serializes read-then-write batches
+LOCK_ROWS = ''
 
 
 def connection(connargs):
-    conn = connect(**connargs)
+    conn = connect(check_same_thread=False, **connargs)
     conn.isolation_level = None
     return conn
 
 
-def ensure_ddl(conn):
+def max_connections(connargs):
+    '''
+    Each connection to :memory: opens a separate database, so such a
+    store can only ever have one connection.
+    '''
+    return 1 if connargs.get('database') == ':memory:' else None
+
+
+def ping(conn):
+    try:
+        conn.execute('SELECT 1')
+        return True
+    except Error:
+        return False
+
+
+def insert_values(cur, query, rows):
+    '''
+    Execute an INSERT whose VALUES clause is a single %s for all rows.
+    Inside a transaction, executemany is as fast as sqlite gets.
+    '''
+    if not rows:
+        return
+    cur.executemany(query % '(%s)' % ', '.join(['?'] * len(rows[0])), rows)
+
+
+def load_json(value):
+    return json.loads(value)
+
+
+def project_json(_fields):
+    '''
+    sqlite cannot drop absent keys when building a JSON object, so
+    entities are projected after loading.
+    '''
+    return None
+
+
+def bucket_expression(column, width):
+    '''
+    SQL expression truncating an integer column to a multiple of width.
+    '''
+    return '(%s / %d) * %d' % (column, width, width)
+
+
+def percentiles_expression(_expression, _fractions):
+    '''
+    sqlite has no percentile aggregate, so percentiles are computed
+    from the ordered values.
+    '''
+    return None
+
+
+def stream_cursor(conn):
+    '''
+    sqlite cursors already step through results row by row.
+    '''
+    return conn.cursor()
+
+
+def close_stream(_conn, cur):
+    cur.close()
+
+
+def _has_column(conn, table, column):
+    cur = conn.cursor()
+    # table_xinfo also lists generated columns
+    cur.execute('PRAGMA table_xinfo(%s)' % table)
+    return column in (row[1] for row in cur)
+
+
+def _has_index(conn, table, index):
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND name = ?",
+        [table, index]
+    )
+    return cur.fetchone() is not None
+
+
+def _add_column(conn, table, column, definition):
+    if _has_column(conn, table, column):
+        return False
+    conn.cursor().execute('ALTER TABLE %s ADD COLUMN %s %s' %
+                          (table, column, definition))
+    return True
+
+
+def _migrate_type_column(conn, batch_size):
+    '''
+    Entities used to be typed only by the prefix of typed_id.
+    '''
+    if not _add_column(conn, 'entities', 'type', 'TEXT'):
+        return
+    while True:
+        cur = conn.cursor()
+        cur.execute(BACKFILL_TYPE % batch_size)
+        if cur.rowcount < batch_size:
+            break
+    conn.cursor().execute('DROP INDEX IF EXISTS sortkey')
+
+
+def _migrate_relation_key(conn):
+    '''
+    Relations used to be allowed to contain duplicates. Remove them
+    before adding the unique index.
+    '''
+    if _has_index(conn, 'relations', 'relation_key'):
+        return
+    conn.cursor().execute(BEGIN)
+    for statement in DEDUPLICATE_RELATIONS:
+        conn.cursor().execute(statement)
+    conn.cursor().execute(RELATION_KEY_INDEX_DEF)
+    conn.cursor().execute('COMMIT')
+
+
+def ensure_ddl(conn, batch_size=10000):
     conn.cursor().execute(ENTITY_TABLE_DEF)
-    conn.cursor().execute(SORTKEY_INDEX_DEF)
+    _migrate_type_column(conn, batch_size)
+    _add_column(conn, 'entities', 'content_hash', 'TEXT')
+    conn.cursor().execute(TYPE_SORTKEY_INDEX_DEF)
+    for (field, definition) in ENTITY_FIELD_DEFS.items():
+        _add_column(conn, 'entities', field, definition)
+        conn.cursor().execute(ENTITY_FIELD_INDEX_DEF % (field, field))
     conn.cursor().execute(RELATION_TABLE_DEF)
+    _migrate_relation_key(conn)
     conn.cursor().execute(RELATION_INDEX_DEF)
+    conn.cursor().execute(INDEX_STATE_TABLE_DEF)
+    conn.cursor().execute(GENERATION_TABLE_DEF)
+    conn.cursor().execute(RUN_TABLE_DEF)
+    _add_column(conn, 'runs', 'content_hash', 'TEXT')
+    _add_column(conn, 'runs', 'archived_at', 'INTEGER')
+    _add_column(conn, 'runs', 'seq', 'INTEGER')
+    _add_column(conn, 'entities', 'seq', 'INTEGER')
+    conn.cursor().execute(RUN_CREATED_INDEX_DEF)
+    conn.cursor().execute(RUN_JOB_INDEX_DEF)
+    conn.cursor().execute(RUN_FINISHED_INDEX_DEF)
+    conn.cursor().execute(RUN_JOB_STATUS_INDEX_DEF)
+    conn.cursor().execute(RUN_SUMMARY_TABLE_DEF)
+    conn.cursor().execute(RUN_SUMMARY_EXPIRES_INDEX_DEF)
+    conn.cursor().execute(ENTITY_SEQ_INDEX_DEF)
+    conn.cursor().execute(RUN_SEQ_INDEX_DEF)
+    conn.cursor().execute(TOMBSTONE_TABLE_DEF)
+    conn.cursor().execute(TOMBSTONE_SEQ_INDEX_DEF)
+    conn.cursor().execute(SEQUENCE_TABLE_DEF)
@@ -0,0 +1,152 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PoolTimeout(RuntimeError):
+    '''
+    No connection became available within the checkout timeout.
+    '''
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:  # pylint: disable = broad-except
+        pass
+
+
+class ConnectionPool:
+    '''
+    A bounded, thread-safe pool of database connections. Connections
+    are created on demand up to max_size and at least min_size
+    connections are kept open. A connection which has been idle for
+    more than ping_interval seconds is health checked before being
+    handed out and broken connections are transparently replaced.
+    '''
+
+    def __init__(self, connect, ping, min_size=1, max_size=10, timeout=30.0, ping_interval=10.0):
+        assert 0 < max_size and 0 <= min_size <= max_size
+        self.connect = connect
+        self.ping = ping
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.idle = []
+        self.size = 0
+        self.closed = False
+        self.stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'created': 0,
+            'discarded': 0,
+        }
+        self.lock = threading.Condition()
+        for _ in range(min_size):
+            self.idle.append((self._create(), time.monotonic()))
+
+    def _create(self):
+        conn = self.connect()
+        with self.lock:
+            self.size += 1
+            self.stats['created'] += 1
+        return conn
+
+    def _discard(self, conn):
+        _close_quietly(conn)
+        with self.lock:
+            self.size -= 1
+            self.stats['discarded'] += 1
+            self.lock.notify()
+
+    def _acquire(self):
+        deadline = time.monotonic() + self.timeout
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('Connection pool is closed')
+            self.stats['checkouts'] += 1
+            waited = False
+            while not self.idle and self.size >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    raise PoolTimeout(
+                        'No database connection available after %.1fs' % self.timeout)
+                if not waited:
+                    self.stats['waits'] += 1
+                    waited = True
+                self.lock.wait(remaining)
+            if self.idle:
+                conn, idle_since = self.idle.pop()
+            else:
+                # Reserve the slot before connecting outside the lock
+                self.size += 1
+                conn, idle_since = None, None
+        if conn is not None:
+            if time.monotonic() - idle_since <= self.ping_interval or self.ping(conn):
+                return conn
+            _close_quietly(conn)
+            with self.lock:
+                self.stats['discarded'] += 1
+        try:
+            conn = self.connect()
+        except Exception:
+            with self.lock:
+                self.size -= 1
+                self.lock.notify()
+            raise
+        with self.lock:
+            self.stats['created'] += 1
+        return conn
+
+    def _release(self, conn):
+        with self.lock:
+            if not self.closed:
+                self.idle.append((conn, time.monotonic()))
+                self.lock.notify()
+                return
+        self._discard(conn)
+
+    @contextmanager
+    def checkout(self):
+        '''
+        Check out a connection for the duration of the with block. If
+        the block fails and the connection no longer answers, it is
+        discarded rather than returned to the pool.
+        '''
+        conn = self._acquire()
+        try:
+            yield conn
+        except Exception:
+            if self.ping(conn):
+                self._release(conn)
+            else:
+                self._discard(conn)
+            raise
+        self._release(conn)
+
+    def metrics(self):
+        '''
+        Return a dict with counters and current pool utilization.
+        '''
+        with self.lock:
+            return dict(
+                self.stats,
+                size=self.size,
+                idle=len(self.idle),
+                in_use=self.size - len(self.idle),
+                max_size=self.max_size,
+            )
+
+    def close(self):
+        '''
+        Close all idle connections. Connections currently checked out
+        are closed when they are released.
+        '''
+        with self.lock:
+            idle, self.idle = self.idle, []
+            self.closed = True
+        for (conn, _) in idle:
+            self._discard(conn)
@@ -1,14 +1,119 @@
+import copy
+import hashlib
+import itertools
 import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
 from striv.errors import EntityNotFound
+from striv.rdbm_pool import ConnectionPool
+
+logger = logging.getLogger('striv')
 
-CONN = None
+POOL = None
 DRIVER = None
-RELATIONS = {}  # pylint: disable = dangerous-default-value
+ADAPTER = None
+INDEXES = {}
+READY_INDEXES = set()
 SORTKEYS = {}  # pylint: disable = dangerous-default-value
+# Months per run partition, or 0 for an unpartitioned runs table
+RUN_PARTITION_MONTHS = 0
+# Number of partitions to keep created ahead of the current one
+RUN_PARTITIONS_AHEAD = 3
+
+# Runs live in their own table with one column per run property.
+# Timestamps are stored as integer nanoseconds since the epoch.
+RUN_COLUMNS = ('job_id', 'execution', 'status',
+               'created_at', 'started_at', 'finished_at')
+RUN_TIMESTAMPS = ('created_at', 'started_at', 'finished_at')
+RUN_RELATIONS = {'job': 'job_id', 'execution': 'execution'}
+RUN_FILTERS = ('job_id', 'execution', 'status')
+# Entity properties that the adapters extract into indexed columns
+ENTITY_FILTERS = ('name', 'execution')
+# Run summaries count finished runs over these windows
+SUMMARY_WINDOWS = (('24h', timedelta(hours=24)), ('7d', timedelta(days=7)))
+FINISHED_STATUSES = ('successful', 'failed')
+# Run properties that run statistics can be grouped by
+STAT_GROUPS = {'job': 'job_id', 'execution': 'execution', 'status': 'status'}
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# Max number of parameters in one IN (...) list
+IN_CHUNK_SIZE = 500
+
+# Config-level types that change rarely are cached in-process. Each
+# has a generation counter in the database which writers bump, so
+# that caches in all processes notice the change.
+CACHED_TYPES = ('dimension', 'execution')
+_CACHE = {}
+_CACHE_LOCK = threading.Lock()
+CACHE_STATS = {'hits': 0, 'misses': 0}
+
+_LOCAL = threading.local()
+
+
+@contextmanager
+def connection():
+    '''
+    Check out a connection from the pool for the duration of the with
+    block. Nested use within a thread reuses the outermost connection,
+    so wrapping a whole request in connection() pins one connection
+    for all store calls made by that request.
+    '''
+    conn = getattr(_LOCAL, 'conn', None)
+    if conn is not None:
+        yield conn
+        return
+    with POOL.checkout() as conn:
+        _LOCAL.conn = conn
+        try:
+            yield conn
+        finally:
+            _LOCAL.conn = None
+            _LOCAL.generations = None
 
 
-def _cursor():
-    return CONN.cursor()
+@contextmanager
+def transaction():
+    '''
+    Run the with block as a single database transaction, committing on
+    success and rolling back if the block raises. Store calls made
+    inside the block join the transaction, as do nested transaction()
+    blocks.
+    '''
+    with connection() as conn:
+        if getattr(_LOCAL, 'in_transaction', False):
+            yield conn
+            return
+        conn.cursor().execute(ADAPTER.BEGIN)
+        _LOCAL.in_transaction = True
+        try:
+            yield conn
+        except BaseException:
+            _LOCAL.in_transaction = False
+            try:
+                conn.cursor().execute('ROLLBACK')
+            except Exception:  # pylint: disable = broad-except
+                pass
+            raise
+        _LOCAL.in_transaction = False
+        conn.cursor().execute('COMMIT')
+
+
+def pool_metrics():
+    '''
+    Connection pool counters (checkouts, waits, timeouts, ...).
+    '''
+    return POOL.metrics()
+
+
+def cache_metrics():
+    '''
+    Hit and miss counters for the cache of CACHED_TYPES.
+    '''
+    with _CACHE_LOCK:
+        return dict(CACHE_STATS, types=sorted(_CACHE))
 
 
 def _maybe_qm(source):
@@ -17,29 +122,125 @@ def _maybe_qm(source):
     return source
 
 
+def _content_hash(value):
+    canonical = json.dumps(value, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
 def _prepare_entities(entities):
     for (typ, eid, entity) in entities:
         yield (
             '%s:%s' % (typ, eid),
+            typ,
             SORTKEYS[typ](entity) if typ in SORTKEYS else None,
-            json.dumps(entity)
+            json.dumps(entity),
+            _content_hash(entity)
+        )
+
+
+def _to_epoch_ns(ts):
+    if ts is None:
+        return None
+    try:
+        parsed = datetime.strptime(ts, '%Y-%m-%dT%H:%M:%S%z')
+    except ValueError:
+        parsed = datetime.strptime(ts, '%Y-%m-%dT%H:%M:%S.%f%z')
+    return (parsed - EPOCH) // timedelta(microseconds=1) * 1000
+
+
+def _from_epoch_ns(ns):
+    return datetime.fromtimestamp(ns // 1000000000, tz=timezone.utc) \
+        .strftime('%Y-%m-%dT%H:%M:%S%z')
+
+
+def _run_row(run_id, run):
+    values = [
+        _to_epoch_ns(run.get(column)) if column in RUN_TIMESTAMPS
+        else run.get(column)
+        for column in RUN_COLUMNS
+    ]
+    return (run_id, *values, _content_hash(values))
+
+
+def _select_in(conn, columns, table, key, ids):
+    '''
+    Yield rows of table whose key is among ids, querying in chunks.
+    '''
+    for offset in range(0, len(ids), IN_CHUNK_SIZE):
+        chunk = ids[offset:offset + IN_CHUNK_SIZE]
+        cur = conn.cursor()
+        cur.execute(
+            _maybe_qm('SELECT %s FROM %s WHERE %s IN (%s)' % (
+                columns, table, key, ','.join(['%s'] * len(chunk)))),
+            chunk
         )
+        yield from cur
+
+
+def _stored_hashes(conn, table, key, ids):
+    return dict(_select_in(
+        conn, '%s, content_hash' % key, table, key, ids))
+
+
+def _changed_rows(conn, table, key, rows, counts):
+    '''
+    Filter rows (with the key first and the content hash last) down to
+    those whose content differs from the stored row, tallying inserted,
+    updated and unchanged rows in counts.
+    '''
+    stored = _stored_hashes(conn, table, key, [row[0] for row in rows])
+    changed = []
+    for row in rows:
+        if row[0] not in stored:
+            counts['inserted'] += 1
+        elif stored[row[0]] != row[-1]:
+            counts['updated'] += 1
+        else:
+            counts['unchanged'] += 1
+            continue
+        changed.append(row)
+    return changed
+
+
+def _run_from_row(row, columns=RUN_COLUMNS):
+    run = {}
+    for (column, value) in zip(columns, row):
+        if value is None:
+            continue
+        run[column] = _from_epoch_ns(
+            value) if column in RUN_TIMESTAMPS else value
+    return run
 
 
 def _relation_keys(entities):
     for (typ, eid, entity) in entities:
-        if typ in RELATIONS:
-            for (relation, key) in RELATIONS[typ](entity):
-                yield ('%s:%s' % (typ, eid), relation, key)
+        for (name, (index_type, extractor)) in INDEXES.items():
+            if typ == index_type:
+                for key in extractor(entity):
+                    yield ('%s:%s' % (typ, eid), name, key)
 
 
 # pylint: disable = import-outside-toplevel
-def setup(driver, connargs, relations=None, sortkeys=None):
+def setup(driver, connargs, indexes=None, sortkeys=None, pool_min=1, pool_max=10,
+          pool_timeout=30.0, background_backfill=True, run_partition_months=0):
     '''
-    Setup the sqlite store. Defaults to creating an in-memory store.
+    Setup the store and its connection pool. pool_min and pool_max
+    bound the number of open connections and pool_timeout is the
+    number of seconds to wait for a connection before giving up.
+
+    indexes maps an index name to a (type, extractor) tuple, where
+    extractor returns the secondary keys of an entity of that type.
+    New indexes are backfilled from existing entities, in a background
+    thread unless background_backfill is False.
+
+    run_partition_months > 0 stores runs in range partitions on
+    created_at, each covering that many months (postgres and mysql
+    only). An existing runs table is converted on the first setup.
     '''
-    global CONN, DRIVER, RELATIONS, SORTKEYS
-    RELATIONS.update(relations or {})
+    global ADAPTER, POOL, DRIVER, INDEXES, SORTKEYS, RUN_PARTITION_MONTHS
+    if run_partition_months and driver == 'sqlite':
+        raise RuntimeError('Partitioned runs require mysql or postgres')
+    INDEXES = dict(indexes or {})
     SORTKEYS.update(sortkeys or {})
     if driver == 'mysql':
         from striv.rdbm_adapters import mysql
@@ -52,31 +253,908 @@ def setup(driver, connargs, relations=None, sortkeys=None):
         adapter = sqlite
     else:
         raise RuntimeError('Unknown database driver %s' % driver)
-    CONN = adapter.connection(connargs)
-    adapter.ensure_ddl(CONN)
+    if POOL is not None:
+        POOL.close()
+    pool_max = min(pool_max, adapter.max_connections(connargs) or pool_max)
+    POOL = ConnectionPool(
+        lambda: adapter.connection(dict(connargs)),
+        adapter.ping,
+        min_size=min(pool_min, pool_max),
+        max_size=pool_max,
+        timeout=pool_timeout
+    )
+    _LOCAL.conn = None
+    _LOCAL.in_transaction = False
+    ADAPTER = adapter
     DRIVER = driver
+    with connection() as conn:
+        adapter.ensure_ddl(conn)
+        _insert_missing(conn, 'sequences', ('name', 'value'), [('changes', 0)])
+    RUN_PARTITION_MONTHS = run_partition_months
+    if run_partition_months:
+        _partition_runs()
+    _migrate_runs()
+    _backfill_run_summaries()
+    _register_indexes()
+    with connection() as conn:
+        _insert_missing(conn, 'generations', ('type', 'generation'),
+                        [(typ, 0) for typ in CACHED_TYPES])
+    with _CACHE_LOCK:
+        _CACHE.clear()
+    if background_backfill:
+        threading.Thread(
+            target=_backfill_in_background,
+            args=(POOL,),
+            name='index-backfill',
+            daemon=True
+        ).start()
+    else:
+        backfill_indexes()
+
+
+def _period_start(ts, months):
+    index = (ts.year * 12 + ts.month - 1) // months * months
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def _add_months(ts, months):
+    index = ts.year * 12 + ts.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def _partition_bounds(first, last, months):
+    '''
+    (name, lower, upper) with bounds in epoch nanoseconds for each run
+    partition from the one holding first through the one holding last.
+    Partitions are aligned so that they never overlap.
+    '''
+    bounds = []
+    start = _period_start(first, months)
+    while start <= last:
+        end = _add_months(start, months)
+        bounds.append(('runs_p%04d%02d' % (start.year, start.month),
+                       _ns(start - EPOCH), _ns(end - EPOCH)))
+        start = end
+    return bounds
+
+
+def _partition_runs():
+    now = datetime.now(timezone.utc)
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT MIN(created_at) FROM runs')
+        (earliest,) = cur.fetchone()
+        first = now if earliest is None else min(
+            now, datetime.fromtimestamp(int(earliest) // 1000000000, tz=timezone.utc))
+        if ADAPTER.partition_runs(conn, _partition_bounds(first, now, RUN_PARTITION_MONTHS)):
+            logger.warning('Converted runs to partitioned storage [months=%d]',
+                           RUN_PARTITION_MONTHS)
+    ensure_run_partitions(now)
+
+
+def ensure_run_partitions(now=None):
+    '''
+    Create run partitions through RUN_PARTITIONS_AHEAD periods after
+    the current one, so that new runs never wait for partition DDL. A
+    no-op unless runs are partitioned.
+    '''
+    if not RUN_PARTITION_MONTHS:
+        return
+    now = now or datetime.now(timezone.utc)
+    last = _add_months(now, RUN_PARTITION_MONTHS * RUN_PARTITIONS_AHEAD)
+    with connection() as conn:
+        ADAPTER.add_run_partitions(
+            conn, _partition_bounds(now, last, RUN_PARTITION_MONTHS))
+
+
+def _drop_expired_partitions(conn, policies, default, archived_only, now):
+    '''
+    Drop run partitions in which every run has expired by age. This is
+    only possible when all executions have a max_age_days. Dropped
+    runs are tombstoned like deleted runs. Returns the number of
+    dropped runs.
+    '''
+    retained = list(policies.values()) + [default]
+    if not all(policy and policy.get('max_age_days') for policy in retained):
+        return 0
+    cutoff = _ns(now - timedelta(days=max(policy['max_age_days'] for policy in retained)) - EPOCH)
+    kept = 'status IS NULL OR status NOT IN (%s, %s)' + (
+        ' OR archived_at IS NULL' if archived_only else '')
+    dropped = 0
+    for (name, lower, upper) in ADAPTER.run_partitions(conn):
+        if upper > cutoff:
+            break
+        span = 'created_at < %s'
+        span_args = [upper]
+        if lower is not None:
+            span += ' AND created_at >= %s'
+            span_args.append(lower)
+        cur = conn.cursor()
+        cur.execute(_maybe_qm('SELECT COUNT(*) FROM runs WHERE %s AND (%s)' % (span, kept)),
+                    span_args + list(FINISHED_STATUSES))
+        if cur.fetchone()[0]:
+            continue
+        cur = conn.cursor()
+        cur.execute(_maybe_qm('SELECT run_id, job_id FROM runs WHERE %s' % span), span_args)
+        runs = dict(cur.fetchall())
+        # Dropping a partition is DDL, which mysql cannot roll back, so
+        # the tombstones follow in a transaction of their own.
+        ADAPTER.drop_run_partition(conn, name)
+        logger.info('Dropped expired run partition [name=%s, runs=%d]',
+                    name, len(runs))
+        with transaction():
+            _write_tombstones(conn, ['run:%s' % run_id for run_id in sorted(runs)])
+            _summarize_runs(conn, set(runs.values()), now)
+        dropped += len(runs)
+    return dropped
+
+
+def _insert_missing(conn, table, columns, rows):
+    '''
+    Insert rows, skipping those whose primary key (the first column)
+    already exists.
+    '''
+    if DRIVER == 'mysql':
+        conflict = 'ON DUPLICATE KEY UPDATE %s = %s' % (columns[0], columns[0])
+    else:
+        conflict = 'ON CONFLICT(%s) DO NOTHING' % columns[0]
+    ADAPTER.insert_values(
+        conn.cursor(),
+        'INSERT INTO %s (%s) VALUES %%s %s' % (
+            table, ', '.join(columns), conflict),
+        rows
+    )
+
+
+def _generations(conn):
+    '''
+    Generation counters are read at most once per connection checkout,
+    giving a request a consistent view of the cached types.
+    '''
+    generations = getattr(_LOCAL, 'generations', None)
+    if generations is None:
+        cur = conn.cursor()
+        cur.execute('SELECT type, generation FROM generations')
+        generations = dict(cur.fetchall())
+        _LOCAL.generations = generations
+    return generations
+
+
+def _bump_generations(conn, types):
+    types = sorted(set(types) & set(CACHED_TYPES))
+    for typ in types:
+        conn.cursor().execute(
+            _maybe_qm(
+                'UPDATE generations SET generation = generation + 1 WHERE type = %s'),
+            [typ]
+        )
+    if types:
+        _LOCAL.generations = None
+        with _CACHE_LOCK:
+            for typ in types:
+                _CACHE.pop(typ, None)
+
+
+def _cached_type(conn, typ):
+    '''
+    Return all entities of a cached type as a dict, or None when they
+    cannot be served from the cache. Within a transaction the cache is
+    bypassed, so that uncommitted data is never cached.
+    '''
+    if getattr(_LOCAL, 'in_transaction', False):
+        return None
+    generation = _generations(conn).get(typ)
+    with _CACHE_LOCK:
+        cached = _CACHE.get(typ)
+        if cached is not None and cached[0] == generation:
+            CACHE_STATS['hits'] += 1
+            return cached[1]
+        CACHE_STATS['misses'] += 1
+    cur = conn.cursor()
+    cur.execute(
+        _maybe_qm('SELECT typed_id, entity FROM entities WHERE type = %s'),
+        [typ]
+    )
+    entities = dict((typed_id[len(typ) + 1:], ADAPTER.load_json(entity))
+                    for (typed_id, entity) in cur)
+    with _CACHE_LOCK:
+        _CACHE[typ] = (generation, entities)
+    return entities
+
+
+def _register_indexes():
+    '''
+    Record declared indexes that the store has not seen before as
+    building and drop indexes that are no longer declared.
+    '''
+    with transaction() as conn:
+        _insert_missing(conn, 'index_state', ('name', 'state'),
+                        [(name, 'building') for name in sorted(INDEXES)])
+        states = _index_states(conn)
+        for name in states:
+            if name not in INDEXES:
+                _delete_in(conn, 'relations', 'relation', [name])
+                _delete_in(conn, 'index_state', 'name', [name])
+    READY_INDEXES.clear()
+    READY_INDEXES.update(
+        name for (name, state) in states.items() if state == 'ready')
+
+
+def _index_states(conn):
+    cur = conn.cursor()
+    cur.execute('SELECT name, state FROM index_state')
+    return dict(cur.fetchall())
+
+
+def _index_ready(conn, name):
+    '''
+    Indexes may be backfilled by another process, so an index not yet
+    known to be ready is looked up again.
+    '''
+    if name not in READY_INDEXES and _index_states(conn).get(name) == 'ready':
+        READY_INDEXES.add(name)
+    return name in READY_INDEXES
+
+
+def index_states():
+    '''
+    Return a dict mapping declared index names to building or ready.
+    '''
+    with connection() as conn:
+        states = _index_states(conn)
+    return dict((name, states.get(name, 'building')) for name in INDEXES)
+
+
+def _backfill_index(name, batch_size, pause):
+    typ, extractor = INDEXES[name]
+    last = ''
+    while True:
+        with transaction() as conn:
+            cur = conn.cursor()
+            cur.execute(_maybe_qm(
+                'SELECT typed_id, entity FROM entities WHERE type = %%s AND typed_id > %%s ORDER BY typed_id LIMIT %d%s' % (
+                    batch_size, ADAPTER.LOCK_ROWS)),
+                [typ, last])
+            rows = cur.fetchall()
+            if not rows:
+                conn.cursor().execute(
+                    _maybe_qm(
+                        "UPDATE index_state SET state = 'ready' WHERE name = %s"),
+                    [name]
+                )
+                READY_INDEXES.add(name)
+                return
+            _sync_relations(
+                conn,
+                [typed_id for (typed_id, _) in rows],
+                [(typed_id, name, key) for (typed_id, entity) in rows
+                 for key in extractor(ADAPTER.load_json(entity))],
+                relation=name
+            )
+        last = rows[-1][0]
+        time.sleep(pause)
+
+
+def backfill_indexes(batch_size=1000, pause=0.0):
+    '''
+    Build all indexes that are not yet ready from existing entities,
+    one batch of entities per transaction, sleeping pause seconds
+    between batches. Entities written meanwhile are indexed by
+    upsert_entities, so the store stays writable during backfill.
+    '''
+    for name in sorted(INDEXES):
+        with connection() as conn:
+            if _index_ready(conn, name):
+                continue
+        logger.info('Backfilling index %s', name)
+        _backfill_index(name, batch_size, pause)
+
+
+def _backfill_in_background(pool):
+    try:
+        backfill_indexes(pause=0.1)
+    except Exception:  # pylint: disable = broad-except
+        # A new setup() closes the pool that this backfill was started for
+        if POOL is pool:
+            logger.exception('Index backfill failed')
+
+
+def _migrate_runs(batch_size=1000):
+    '''
+    Runs used to be stored as generic entities. Move any such runs
+    into the runs table.
+    '''
+    while True:
+        with transaction() as conn:
+            cur = conn.cursor()
+            cur.execute(_maybe_qm(
+                'SELECT typed_id, entity FROM entities WHERE type = %%s LIMIT %d' % batch_size),
+                ['run'])
+            legacy = [(typed_id, ADAPTER.load_json(entity))
+                      for (typed_id, entity) in cur]
+            if not legacy:
+                break
+            _upsert_runs(conn, [_run_row(typed_id[4:], run)
+                                for (typed_id, run) in legacy])
+            ids = [typed_id for (typed_id, _) in legacy]
+            _delete_in(conn, 'entities', 'typed_id', ids)
+            _delete_in(conn, 'relations', 'typed_id', ids)
+
+
+def _delete_in(conn, table, key, ids):
+    deleted = 0
+    for offset in range(0, len(ids), IN_CHUNK_SIZE):
+        chunk = ids[offset:offset + IN_CHUNK_SIZE]
+        cur = conn.cursor()
+        cur.execute(
+            _maybe_qm('DELETE FROM %s WHERE %s IN (%s)' % (
+                table, key, ','.join(['%s'] * len(chunk)))),
+            chunk
+        )
+        deleted += cur.rowcount
+    return deleted
+
+
+def _load_runs(conn, run_ids):
+    rows = _select_in(conn, 'run_id, %s' % ', '.join(RUN_COLUMNS),
+                      'runs', 'run_id', run_ids)
+    return dict((row[0], _run_from_row(row[1:])) for row in rows)
+
+
+def _range_clauses(range, after, sortkey, key, encode):
+    '''
+    Translate range and after into SQL conditions over the (sortkey,
+    key) column pair, and a matching ORDER BY clause. after is an
+    exclusive (sortkey, key) position to continue from; since key is
+    unique, paging never repeats or skips rows with equal sortkeys.
+    '''
+    if range is None:
+        assert after is None, 'after requires a range'
+        return ([], [], '')
+    order, lower, upper = range
+    assert order.upper() in ['ASC', 'DESC']
+    conditions = []
+    args = []
+    if lower is not None:
+        conditions.append('%s >= %%s' % sortkey)
+        args.append(encode(lower))
+    if upper is not None:
+        conditions.append('%s <= %%s' % sortkey)
+        args.append(encode(upper))
+    if after is not None:
+        after_sortkey, after_key = after
+        conditions.append('(%s, %s) %s (%%s, %%s)' % (
+            sortkey, key, '<' if order.upper() == 'DESC' else '>'))
+        args += [encode(after_sortkey), after_key]
+    return (
+        conditions,
+        args,
+        ' ORDER BY %s %s, %s %s' % (sortkey, order, key, order)
+    )
+
+
+def _filter_clauses(where, columns):
+    '''
+    Translate where, a dict mapping column to a value or a collection
+    of accepted values, into SQL conditions.
+    '''
+    conditions = []
+    args = []
+    for (column, value) in sorted((where or {}).items()):
+        if column not in columns:
+            raise RuntimeError('Cannot filter on %s' % column)
+        if isinstance(value, (list, tuple, set, frozenset)):
+            values = sorted(value)
+            if not values:
+                conditions.append('1 = 0')
+                continue
+            conditions.append('%s IN (%s)' % (
+                column, ','.join(['%s'] * len(values))))
+            args += values
+        else:
+            conditions.append('%s = %%s' % column)
+            args.append(value)
+    return (conditions, args)
+
+
+def _related_pairs(related_to):
+    if not related_to:
+        return []
+    if isinstance(related_to, list):
+        return related_to
+    return [related_to]
+
+
+def _relation_clauses(conn, related_to):
+    '''
+    Translate related_to into conditions on the relations table, or
+    return None if one of the indexes involved is still building.
+    '''
+    pairs = _related_pairs(related_to)
+    for (name, _) in pairs:
+        if name not in INDEXES:
+            raise RuntimeError('Unknown index %s' % name)
+    if not all(_index_ready(conn, name) for (name, _) in pairs):
+        return None
+    conditions = [
+        'typed_id IN (SELECT typed_id FROM relations WHERE relation = %s AND secondary_key = %s)'
+    ] * len(pairs)
+    return (conditions, [value for pair in pairs for value in pair])
+
+
+def _run_clauses(related_to, where, finished_after):
+    conditions, args = _filter_clauses(where, RUN_FILTERS)
+    for (relation, key) in _related_pairs(related_to):
+        conditions.append('%s = %%s' % RUN_RELATIONS[relation])
+        args.append(key)
+    if finished_after is not None:
+        conditions.append('finished_at > %s')
+        args.append(_to_epoch_ns(finished_after))
+    return (conditions, args)
+
+
+def _find_runs(related_to, limit, range, after, where, finished_after):
+    query = 'SELECT run_id, %s FROM runs' % ', '.join(RUN_COLUMNS)
+    conditions, args = _run_clauses(related_to, where, finished_after)
+    range_conditions, range_args, order_by = _range_clauses(
+        range, after, 'created_at', 'run_id', _to_epoch_ns)
+    conditions += range_conditions
+    args += range_args
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += order_by
+    if limit is not None:
+        query += ' LIMIT %d' % limit
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute(_maybe_qm(query), args)
+        return dict((row[0], _run_from_row(row[1:])) for row in cur)
+
+
+def _percentile(ordered, fraction):
+    '''
+    Continuous percentile of an ordered list, as SQL percentile_cont.
+    '''
+    position = fraction * (len(ordered) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def run_stats(group_by=(), bucket=None, related_to=None, range=None, where=None,
+              finished_after=None, percentiles=(50, 95)):
+    '''
+    Aggregate runs in the database. group_by is a sequence of job,
+    execution and status. bucket is a number of seconds; when given,
+    runs are also grouped by created_at truncated to a multiple of it.
+    related_to, where and finished_after select runs as for
+    find_entities and range bounds created_at. Returns a list of dicts
+    with the group properties, a count of runs, successful and failed
+    counts and the mean and percentiles of run duration in seconds.
+    '''
+    columns = [STAT_GROUPS[name] for name in group_by]
+    keys = list(columns)
+    if bucket is not None:
+        columns.append(ADAPTER.bucket_expression('created_at', int(bucket * 1000000000)))
+        keys.append('bucket')
+    conditions, args = _run_clauses(related_to, where, finished_after)
+    range_conditions, range_args, _ = _range_clauses(
+        range and ('asc', range[1], range[2]), None, 'created_at', 'run_id', _to_epoch_ns)
+    conditions += range_conditions
+    args += range_args
+    where_clause = (' WHERE ' + ' AND '.join(conditions)) if conditions else ''
+    grouping = ''
+    if columns:
+        positions = ', '.join(str(n) for (n, _) in enumerate(columns, 1))
+        grouping = ' GROUP BY %s ORDER BY %s' % (positions, positions)
+    duration = '(finished_at - started_at)'
+    fractions = [p / 100.0 for p in percentiles]
+    aggregates = [
+        'COUNT(*)',
+        'SUM(CASE WHEN status = %s THEN 1 ELSE 0 END)',
+        'SUM(CASE WHEN status = %s THEN 1 ELSE 0 END)',
+        'AVG(%s)' % duration,
+    ]
+    in_sql = ADAPTER.percentiles_expression(duration, fractions) if fractions else None
+    if in_sql is not None:
+        aggregates.append(in_sql)
+    groups = {}
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute(_maybe_qm('SELECT %s FROM runs%s%s' % (
+            ', '.join(columns + aggregates), where_clause, grouping)),
+            list(FINISHED_STATUSES) + args)
+        for row in cur:
+            group, (count, successful, failed, mean, *in_sql_values) = \
+                tuple(row[:len(columns)]), row[len(columns):]
+            if not count:
+                continue
+            groups[group] = {
+                'count': count,
+                'successful': int(successful or 0),
+                'failed': int(failed or 0),
+                'duration': {'mean': None if mean is None else float(mean) / 1e9},
+            }
+            if in_sql_values:
+                values = in_sql_values[0] or [None] * len(fractions)
+                for (p, value) in zip(percentiles, values):
+                    groups[group]['duration']['p%g' % p] = \
+                        None if value is None else float(value) / 1e9
+        if fractions and in_sql is None:
+            _percentiles_in_python(conn, groups, columns, where_clause, args, percentiles)
+    stats = []
+    for (group, stat) in groups.items():
+        for (key, value) in zip(keys, group):
+            stat[key] = _from_epoch_ns(int(value)) if key == 'bucket' else value
+        stats.append(stat)
+    return stats
+
+
+def _percentiles_in_python(conn, groups, columns, where_clause, args, percentiles):
+    '''
+    Stream durations ordered by group and duration, so that only one
+    group of durations is held in memory at a time.
+    '''
+    duration = '(finished_at - started_at)'
+    conditions = 'started_at IS NOT NULL AND finished_at IS NOT NULL'
+    where_clause = (where_clause + ' AND ' if where_clause else ' WHERE ') + conditions
+    order = ', '.join(str(n) for n in range(1, len(columns) + 2))
+    cur = ADAPTER.stream_cursor(conn)
+    try:
+        cur.execute(_maybe_qm('SELECT %s FROM runs%s ORDER BY %s' % (
+            ', '.join(columns + [duration]), where_clause, order)), args)
+        for stat in groups.values():
+            for p in percentiles:
+                stat['duration']['p%g' % p] = None
+        for (group, rows) in itertools.groupby(cur, lambda row: tuple(row[:-1])):
+            ordered = [row[-1] for row in rows]
+            for p in percentiles:
+                groups[group]['duration']['p%g' % p] = \
+                    _percentile(ordered, p / 100.0) / 1e9
+    finally:
+        ADAPTER.close_stream(conn, cur)
+
+
+def mark_runs_archived(*run_ids, now=None):
+    '''
+    Record that the logs of run_ids have been archived, which makes
+    the runs eligible for purge_runs.
+    '''
+    archived_at = _ns((now or datetime.now(timezone.utc)) - EPOCH)
+    with transaction() as conn:
+        for offset in range(0, len(run_ids), IN_CHUNK_SIZE):
+            chunk = list(run_ids[offset:offset + IN_CHUNK_SIZE])
+            conn.cursor().execute(
+                _maybe_qm('UPDATE runs SET archived_at = %%s WHERE archived_at IS NULL AND run_id IN (%s)' % (
+                    ','.join(['%s'] * len(chunk)))),
+                [archived_at] + chunk
+            )
+
+
+def _retention_scopes(policies, default):
+    '''
+    Yield (policy, condition, args) where condition selects the runs
+    that policy applies to. Runs of executions without a policy of
+    their own fall under default.
+    '''
+    for (execution, policy) in sorted(policies.items()):
+        if policy:
+            yield (policy, 'execution = %s', [execution])
+    if default:
+        if policies:
+            yield (
+                default,
+                '(execution IS NULL OR execution NOT IN (%s))' % ','.join(['%s'] * len(policies)),
+                sorted(policies)
+            )
+        else:
+            yield (default, '1 = 1', [])
+
+
+def _expired_runs(conn, policies, default, batch_size, archived_only, now):
+    '''
+    Find up to batch_size finished runs which are older than max_age_days
+    or beyond the newest max_runs_per_job runs of their job.
+    '''
+    eligible = 'status IN (%s, %s)' + (' AND archived_at IS NOT NULL' if archived_only else '')
+    expired = {}
+    for (policy, scope, scope_args) in _retention_scopes(policies, default):
+        cutoffs = []
+        if policy.get('max_age_days'):
+            cutoffs.append(('', [], _ns(now - timedelta(days=policy['max_age_days']) - EPOCH)))
+        if policy.get('max_runs_per_job'):
+            cur = conn.cursor()
+            cur.execute(_maybe_qm('SELECT job_id FROM runs WHERE %s GROUP BY job_id HAVING COUNT(*) > %d' % (
+                scope, policy['max_runs_per_job'])), scope_args)
+            for (job_id,) in cur.fetchall():
+                cur = conn.cursor()
+                cur.execute(_maybe_qm(
+                    'SELECT created_at FROM runs WHERE %s AND job_id = %%s '
+                    'ORDER BY created_at DESC LIMIT 1 OFFSET %d' % (
+                        scope, policy['max_runs_per_job'] - 1)), scope_args + [job_id])
+                cutoffs.append((' AND job_id = %s', [job_id], cur.fetchone()[0]))
+        for (condition, args, cutoff) in cutoffs:
+            if len(expired) >= batch_size:
+                return expired
+            cur = conn.cursor()
+            cur.execute(_maybe_qm('SELECT run_id, job_id FROM runs WHERE %s AND %s%s AND created_at < %%s LIMIT %d' % (
+                scope, eligible, condition, batch_size - len(expired))),
+                scope_args + list(FINISHED_STATUSES) + args + [cutoff])
+            expired.update(cur.fetchall())
+    return expired
+
+
+def purge_runs(policies, default=None, batch_size=1000, archived_only=True, now=None):
+    '''
+    Delete one batch of at most batch_size runs that have outlived
+    their retention policy. policies maps execution id to a policy, a
+    dict with max_age_days and/or max_runs_per_job; runs of other
+    executions follow default. Only finished runs are deleted, and
+    with archived_only only those whose logs have been archived.
+    Candidates are found before the short delete transaction, so that
+    purging does not hold locks while scanning. With partitioned runs,
+    partitions that have expired as a whole are dropped instead.
+    Purged runs show up as deletions in changes(). Returns the number
+    of deleted runs.
+    '''
+    now = now or datetime.now(timezone.utc)
+    with connection() as conn:
+        if RUN_PARTITION_MONTHS:
+            dropped = _drop_expired_partitions(conn, policies, default, archived_only, now)
+            if dropped:
+                return dropped
+        expired = _expired_runs(conn, policies, default, batch_size, archived_only, now)
+        if not expired:
+            return 0
+        with transaction():
+            deleted = _delete_in(conn, 'runs', 'run_id', sorted(expired))
+            _write_tombstones(conn, ['run:%s' % run_id for run_id in sorted(expired)])
+            _summarize_runs(conn, set(expired.values()), now)
+    return deleted
+
+
+def _reserve_seqs(conn, count):
+    '''
+    Reserve count consecutive change sequence numbers and return the
+    first. The sequence row stays locked until the transaction ends, so
+    changes become visible in sequence order and a reader that has seen
+    a sequence number will not later find a lower one.
+    '''
+    assert getattr(_LOCAL, 'in_transaction', False), 'sequence numbers require a transaction'
+    cur = conn.cursor()
+    cur.execute(_maybe_qm("UPDATE sequences SET value = value + %s WHERE name = 'changes'"),
+                [count])
+    cur = conn.cursor()
+    cur.execute("SELECT value FROM sequences WHERE name = 'changes'")
+    return int(cur.fetchone()[0]) - count + 1
+
+
+def _stamp(conn, rows):
+    '''
+    Append a change sequence number to each row.
+    '''
+    if not rows:
+        return rows
+    first = _reserve_seqs(conn, len(rows))
+    return [row + (first + n,) for (n, row) in enumerate(rows)]
+
+
+def _write_tombstones(conn, typed_ids):
+    if not typed_ids:
+        return
+    _delete_in(conn, 'tombstones', 'typed_id', typed_ids)
+    ADAPTER.insert_values(
+        conn.cursor(),
+        'INSERT INTO tombstones (typed_id, type, seq) VALUES %s',
+        _stamp(conn, [(typed_id, typed_id.split(':', 1)[0]) for typed_id in typed_ids])
+    )
+
+
+def change_head():
+    '''
+    Return the latest change sequence number. Every change committed
+    after this call gets a higher one, so a poller can start following
+    changes() from here without reading the feed's history.
+    '''
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT value FROM sequences WHERE name = 'changes'")
+        return int(cur.fetchone()[0])
+
+
+def changes(since, types=None, limit=1000):
+    '''
+    Return up to limit changes with a sequence number above since, in
+    sequence order, as (seq, type, id, entity) tuples where entity is
+    None for deleted entities. types restricts changes to those entity
+    types. Only the latest change to each entity is kept, so a poller
+    that remembers the last seq it has seen can catch up on everything
+    that changed since.
+    '''
+    entity_types = None if types is None else sorted(set(types) - {'run'})
+    found = []
+    with connection() as conn:
+        if types is None or 'run' in types:
+            cur = conn.cursor()
+            cur.execute(_maybe_qm('SELECT seq, run_id, %s FROM runs WHERE seq > %%s ORDER BY seq LIMIT %d' % (
+                ', '.join(RUN_COLUMNS), limit)), [since])
+            found += [(int(row[0]), 'run', row[1], _run_from_row(row[2:])) for row in cur]
+        type_condition, type_args = _filter_clauses(
+            None if types is None else {'type': sorted(types)}, ('type',))
+        if entity_types is None or entity_types:
+            entity_condition, entity_args = _filter_clauses(
+                None if types is None else {'type': entity_types}, ('type',))
+            cur = conn.cursor()
+            cur.execute(_maybe_qm('SELECT seq, typed_id, entity FROM entities WHERE %s ORDER BY seq LIMIT %d' % (
+                ' AND '.join(['seq > %s'] + entity_condition), limit)), [since] + entity_args)
+            found += [(int(seq), *typed_id.split(':', 1), ADAPTER.load_json(entity))
+                      for (seq, typed_id, entity) in cur]
+        cur = conn.cursor()
+        cur.execute(_maybe_qm('SELECT seq, typed_id FROM tombstones WHERE %s ORDER BY seq LIMIT %d' % (
+            ' AND '.join(['seq > %s'] + type_condition), limit)), [since] + type_args)
+        found += [(int(seq), *typed_id.split(':', 1), None) for (seq, typed_id) in cur]
+    return sorted(found, key=lambda change: change[0])[:limit]
+
 
+def _upsert_runs(conn, rows):
+    rows = _stamp(conn, rows)
+    columns = ('run_id',) + RUN_COLUMNS + ('content_hash', 'seq')
+    if DRIVER == 'mysql':
+        conflict = 'ON DUPLICATE KEY UPDATE %s' % ', '.join(
+            '%s = VALUES(%s)' % (c, c) for c in columns[1:])
+    else:
+        # Partitioned runs are unique per partition key as well
+        conflict = 'ON CONFLICT(%s) DO UPDATE SET %s' % (
+            'run_id, created_at' if RUN_PARTITION_MONTHS else 'run_id',
+            ', '.join('%s = excluded.%s' % (c, c) for c in columns[1:]))
+    replace_runs = 'INSERT INTO runs (%s) VALUES %%s %s' % (
+        ', '.join(columns),
+        conflict
+    )
+    ADAPTER.insert_values(conn.cursor(), replace_runs, rows)
+
+
+def _ns(delta):
+    return delta // timedelta(microseconds=1) * 1000
+
+
+def _summarize_runs(conn, job_ids, now):
+    '''
+    Recompute the run summaries of job_ids. The counts only read runs
+    that finished within the longest window, while the last run and
+    the last finish time of each status come from single lookups on
+    the runs_job and runs_job_status indexes, so the cost does not grow
+    with the run history of a job. A summary expires when the oldest
+    run it counts leaves its window.
+    '''
+    now_ns = _ns(now - EPOCH)
+    starts = [now_ns - _ns(window) for (_, window) in SUMMARY_WINDOWS]
+    aggregates = []
+    aggregate_args = []
+    for start in starts:
+        for status in FINISHED_STATUSES:
+            aggregates.append(
+                'SUM(CASE WHEN status = %s AND finished_at > %s THEN 1 ELSE 0 END)')
+            aggregate_args += [status, start]
+        aggregates.append(
+            'MIN(CASE WHEN status IN (%s, %s) AND finished_at > %s THEN finished_at END)')
+        aggregate_args += [*FINISHED_STATUSES, start]
+    job_ids = sorted(job_id for job_id in job_ids if job_id is not None)
+    for offset in range(0, len(job_ids), IN_CHUNK_SIZE):
+        chunk = job_ids[offset:offset + IN_CHUNK_SIZE]
+        in_clause = ','.join(['%s'] * len(chunk))
+        cur = conn.cursor()
+        cur.execute(_maybe_qm(
+            'SELECT job_id, %s FROM runs WHERE job_id IN (%s) AND finished_at > %%s GROUP BY job_id' % (
+                ', '.join(aggregates), in_clause)),
+            aggregate_args + chunk + [min(starts)])
+        windows = dict((job_id, values) for (job_id, *values) in cur)
+        rows = []
+        for job_id in chunk:
+            cur = conn.cursor()
+            cur.execute(_maybe_qm(
+                'SELECT run_id, status FROM runs WHERE job_id = %s '
+                'ORDER BY created_at DESC, run_id DESC LIMIT 1'), [job_id])
+            latest = cur.fetchone()
+            if latest is None:
+                continue
+            summary = {
+                'last_run_id': latest[0],
+                'last_status': latest[1],
+            }
+            expires_at = None
+            values = windows.get(job_id, [None] * len(aggregates))
+            for (start, (label, window)) in zip(starts, SUMMARY_WINDOWS):
+                successful, failed, oldest, *values = values
+                summary['successful_%s' % label] = int(successful or 0)
+                summary['failed_%s' % label] = int(failed or 0)
+                if oldest is not None:
+                    expiry = int(oldest) + _ns(window)
+                    expires_at = expiry if expires_at is None else min(expires_at, expiry)
+            for status in FINISHED_STATUSES:
+                cur = conn.cursor()
+                cur.execute(_maybe_qm(
+                    'SELECT MAX(finished_at) FROM runs WHERE job_id = %s AND status = %s'),
+                    [job_id, status])
+                (finished_at,) = cur.fetchone()
+                summary['last_%s_at' % status] = \
+                    None if finished_at is None else _from_epoch_ns(int(finished_at))
+            rows.append(('job:%s' % job_id, json.dumps(summary), expires_at))
+        _delete_in(conn, 'run_summaries', 'job_key', ['job:%s' % job_id for job_id in chunk])
+        ADAPTER.insert_values(
+            conn.cursor(),
+            'INSERT INTO run_summaries (job_key, summary, expires_at) VALUES %s',
+            rows
+        )
+
+
+def _backfill_run_summaries():
+    '''
+    Summarize jobs that have runs but no run summary, e.g. runs that
+    were stored before run summaries were introduced.
+    '''
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT DISTINCT job_id FROM runs WHERE job_id IS NOT NULL')
+        job_ids = set(job_id for (job_id,) in cur)
+        cur = conn.cursor()
+        cur.execute('SELECT job_key FROM run_summaries')
+        job_ids -= set(job_key[4:] for (job_key,) in cur)
+        _summarize_runs(conn, job_ids, datetime.now(timezone.utc))
 
-def load_entities(*query):
+
+def refresh_run_summaries(now=None):
+    '''
+    Run summaries are kept up to date as runs are written, but their
+    counts also change as runs age out of SUMMARY_WINDOWS. Recompute
+    the summaries where that has happened. Returns the number of
+    recomputed summaries.
+    '''
+    now = now or datetime.now(timezone.utc)
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            _maybe_qm('SELECT job_key FROM run_summaries WHERE expires_at <= %s'),
+            [_ns(now - EPOCH)]
+        )
+        job_ids = [job_key[4:] for (job_key,) in cur]
+        _summarize_runs(conn, job_ids, now)
+    return len(job_ids)
+
+
+def load_entities(*query, ignore_missing=False):
     '''
     Load a series of entities from the store. The query is a list of
     (type, id) tuples. Entities are guaranteed to be returned in the
     order they were queried and loading will fail if one or more tuples
-    fail to retrieve an entity.
+    fail to retrieve an entity, unless ignore_missing is set, in which
+    case missing entities are returned as None.
     '''
     typed_ids = ['%s:%s' % (typ, eid) for (typ, eid) in query]
-    qs = ','.join(['%s'] * len(typed_ids))
-    cur = _cursor()
-    cur.execute(
-        _maybe_qm(
-            'SELECT typed_id, entity FROM entities WHERE typed_id IN (%s)' % qs),
-        typed_ids
-    )
+    run_ids = [eid for (typ, eid) in query if typ == 'run']
     candidates = {}
-    for (typed_id, entity) in cur:
-        candidates[typed_id] = json.loads(entity)
+    with connection() as conn:
+        cached = dict((typ, _cached_type(conn, typ))
+                      for typ in set(typ for (typ, _) in query) & set(CACHED_TYPES))
+        entity_ids = []
+        for (typed_id, (typ, eid)) in zip(typed_ids, query):
+            if typ == 'run':
+                continue
+            if cached.get(typ) is None:
+                entity_ids.append(typed_id)
+            elif eid in cached[typ]:
+                candidates[typed_id] = copy.deepcopy(cached[typ][eid])
+        rows = _select_in(conn, 'typed_id, entity',
+                          'entities', 'typed_id', entity_ids)
+        for (typed_id, entity) in rows:
+            candidates[typed_id] = ADAPTER.load_json(entity)
+        for (run_id, run) in _load_runs(conn, run_ids).items():
+            candidates['run:%s' % run_id] = run
     entities = []
     for typed_id in typed_ids:
+        if ignore_missing:
+            entities.append(candidates.get(typed_id))
+            continue
         try:
             entities.append(candidates[typed_id])
         except KeyError as err:
@@ -84,67 +1162,281 @@ def load_entities(*query):
     return entities
 
 
-def find_entities(typ, related_to=None, limit=None, range=None):
+def find_entities(typ, related_to=None, limit=None, range=None, after=None, where=None,
+                  finished_after=None):
     '''
     Retrieve all entities of a particular type. Returns a dict mapping
-    id to entity. related_to is a (relation, key) tuple and can be used
-    to scope the result to just a single relation. limit can be used to
+    id to entity. related_to is a (relation, key) tuple, or a list of
+    such tuples which must all match, and can be used to scope the
+    result to entities with those relations. limit can be used to
     constrain the number of returned results. range is a (asc | desc,
     inclusive lower, inclusive upper) tuple which returns a slice of
-    entities in a certain sort order.
+    entities in a certain sort order. after is a (sortkey, id) tuple
+    naming the last entity of the previous page; the result starts
+    with the entity following it in range order. where maps property
+    names to a value or a collection of accepted values; only
+    RUN_FILTERS and ENTITY_FILTERS can be filtered on. finished_after
+    selects runs that finished after the given timestamp.
+    '''
+    if typ == 'run':
+        return _find_runs(related_to, limit, range, after, where, finished_after)
+    assert finished_after is None, 'finished_after only applies to runs'
+    if typ in CACHED_TYPES and not (related_to or limit or range or where):
+        with connection() as conn:
+            cached = _cached_type(conn, typ)
+        if cached is not None:
+            return copy.deepcopy(cached)
+    conditions, args = _filter_clauses(where, ENTITY_FILTERS)
+    if after is not None:
+        after = (after[0], '%s:%s' % (typ, after[1]))
+    range_conditions, range_args, order_by = _range_clauses(
+        range, after, 'sortkey', 'typed_id', lambda v: v)
+    conditions += range_conditions
+    args += range_args
+    with connection() as conn:
+        relations = _relation_clauses(conn, related_to)
+        if relations is None:
+            return _scan_entities(conn, typ, related_to, limit, conditions,
+                                  args, order_by)
+        conditions += relations[0]
+        args += relations[1]
+        query = 'SELECT typed_id, entity FROM entities WHERE type = %s'
+        for condition in conditions:
+            query += ' AND ' + condition
+        query += order_by
+        if limit is not None:
+            query += ' LIMIT %d' % limit
+        cur = conn.cursor()
+        cur.execute(_maybe_qm(query), [typ, *args])
+        return dict((typed_id[len(typ) + 1:], ADAPTER.load_json(entity)) for (typed_id, entity) in cur)
+
+
+def _scan_entities(conn, typ, related_to, limit, conditions, args, order_by):
+    '''
+    Serve a related_to query while an index is still building by
+    applying the index extractors to every entity of the type.
+    '''
+    pairs = _related_pairs(related_to)
+    query = 'SELECT typed_id, entity FROM entities WHERE type = %s'
+    for condition in conditions:
+        query += ' AND ' + condition
+    query += order_by
+    if not pairs and limit is not None:
+        query += ' LIMIT %d' % limit
+    cur = conn.cursor()
+    cur.execute(_maybe_qm(query), [typ, *args])
+    found = {}
+    try:
+        for (typed_id, entity) in cur:
+            if limit is not None and len(found) >= limit:
+                break
+            entity = ADAPTER.load_json(entity)
+            if all(key in INDEXES[name][1](entity) for (name, key) in pairs):
+                found[typed_id[len(typ) + 1:]] = entity
+    finally:
+        # Stopping at limit leaves rows unread, which blocks further
+        # statements on an unbuffered mysql connection
+        ADAPTER.close_stream(conn, cur)
+    return found
+
+
+def stream_entities(typ, related_to=None, limit=None, range=None, after=None, where=None,
+                    fields=None, finished_after=None, with_run_summary=False):
     '''
-    if related_to:
-        flter = 'typed_id IN (SELECT typed_id FROM relations WHERE relation = %s AND secondary_key = %s)'
-        args = [*related_to]
+    Like find_entities, but rows are read through a server-side cursor
+    instead of being collected in a dict. Returns (entities, last),
+    where entities is an iterator of (id, entity) pairs. last is the
+    (sortkey, id) of the last entity on this page when limit cuts the
+    result short, or None. limit requires range. fields is a
+    collection of top-level properties to project entities down to.
+    with_run_summary adds the run summary of each job as run_summary,
+    joined in by the same query. The caller must hold connection() open until entities is exhausted
+    or closed.
+    '''
+    assert getattr(_LOCAL, 'conn', None) is not None, \
+        'stream_entities requires an open connection()'
+    conn = _LOCAL.conn
+    assert typ == 'job' or not with_run_summary, 'Only jobs have run summaries'
+    project = None
+    if typ == 'run':
+        table, key, sortkey = 'runs', 'run_id', 'created_at'
+        columns = [c for c in RUN_COLUMNS if fields is None or c in fields]
+        select, select_args = ', '.join([key] + columns), []
+        conditions, args = _run_clauses(related_to, where, finished_after)
+        encode, decode = _to_epoch_ns, _from_epoch_ns
+        prefix = ''
+
+        def entity_from_row(row):
+            return _run_from_row(row[1:], columns)
     else:
-        flter = 'typed_id LIKE %s'
-        args = ['%s:%%' % typ]
-    query = 'SELECT typed_id, entity FROM entities WHERE %s' % flter
-    if range is not None:
-        order, lower, upper = range
-        assert order.upper() in ['ASC', 'DESC']
-        if lower is not None:
-            query += ' AND sortkey >= %s'
-            args += [lower]
-        if upper is not None:
-            query += ' AND sortkey <= %s'
-            args += [upper]
-        query += ' ORDER BY sortkey %s' % order
+        assert finished_after is None, 'finished_after only applies to runs'
+        relations = _relation_clauses(conn, related_to)
+        if relations is None:
+            entities, last = _page_from_dict(
+                typ, find_entities(typ, related_to, limit and limit + 1, range, after, where),
+                limit, fields)
+            if with_run_summary:
+                entities = _with_run_summaries(conn, list(entities))
+            return (entities, last)
+        table, key, sortkey = 'entities', 'typed_id', 'sortkey'
+        select, select_args = '%s, entity' % key, []
+        if fields is not None:
+            projection = ADAPTER.project_json(sorted(fields))
+            if projection is None:
+                project = fields
+            else:
+                select = '%s, %s' % (key, projection)
+                select_args = sorted(fields)
+        conditions, args = _filter_clauses(where, ENTITY_FILTERS)
+        conditions.insert(0, 'type = %s')
+        args.insert(0, typ)
+        conditions += relations[0]
+        args += relations[1]
+        encode = decode = lambda v: v
+        prefix = '%s:' % typ
+
+        def entity_from_row(row):
+            entity = ADAPTER.load_json(row[1])
+            if project is not None:
+                entity = _project(entity, project)
+            if with_run_summary:
+                entity['run_summary'] = row[2] and json.loads(row[2])
+            return entity
+        if after is not None:
+            after = (after[0], prefix + after[1])
+    range_conditions, range_args, order_by = _range_clauses(
+        range, after, sortkey, key, encode)
+    conditions += range_conditions
+    args += range_args
+    where_clause = (' WHERE ' + ' AND '.join(conditions)) if conditions else ''
+    last = None
     if limit is not None:
-        query += ' LIMIT %d' % limit
-    cur = _cursor()
-    cur.execute(_maybe_qm(query), args)
-    return dict((typed_id[len(typ) + 1:], json.loads(entity)) for (typed_id, entity) in cur)
+        assert range is not None and limit > 0
+        # Find the last key of the page with a narrow query. Bounding
+        # the streamed rows by that key, rather than by limit, keeps the
+        # page and the position of the next page in agreement even if
+        # rows are inserted in between.
+        cur = conn.cursor()
+        cur.execute(_maybe_qm('SELECT %s, %s FROM %s%s%s LIMIT 2 OFFSET %d' % (
+            sortkey, key, table, where_clause, order_by, limit - 1)), args)
+        keys = cur.fetchall()
+        if len(keys) == 2:
+            last_sortkey, last_key = keys[0]
+            last = (decode(last_sortkey), last_key[len(prefix):])
+            conditions.append('(%s, %s) %s (%%s, %%s)' % (
+                sortkey, key, '>=' if range[0].upper() == 'DESC' else '<='))
+            args += [last_sortkey, last_key]
+            where_clause = ' WHERE ' + ' AND '.join(conditions)
+    if with_run_summary:
+        select += ', summary'
+        table += ' LEFT JOIN run_summaries ON job_key = typed_id'
+    cur = ADAPTER.stream_cursor(conn)
+    cur.execute(_maybe_qm('SELECT %s FROM %s%s%s' % (
+        select, table, where_clause, order_by)), select_args + args)
+    return (_stream_rows(conn, cur, prefix, entity_from_row), last)
+
+
+def _project(entity, fields):
+    return dict((k, v) for (k, v) in entity.items() if k in fields)
+
+
+def _page_from_dict(typ, entities, limit, fields):
+    '''
+    Turn a find_entities result fetched with limit + 1 into a page.
+    '''
+    last = None
+    if limit is not None and len(entities) > limit:
+        entities.popitem()
+        last_id = list(entities)[-1]
+        last = (SORTKEYS[typ](entities[last_id]), last_id)
+    if fields is not None:
+        entities = dict((eid, _project(entity, fields))
+                        for (eid, entity) in entities.items())
+    return (iter(entities.items()), last)
+
+
+def _with_run_summaries(conn, entities):
+    summaries = dict(_select_in(conn, 'job_key, summary', 'run_summaries', 'job_key',
+                                ['job:%s' % eid for (eid, _) in entities]))
+    for (eid, entity) in entities:
+        summary = summaries.get('job:%s' % eid)
+        entity['run_summary'] = summary and json.loads(summary)
+    return iter(entities)
+
+
+def _stream_rows(conn, cur, prefix, entity_from_row):
+    try:
+        for row in cur:
+            yield (row[0][len(prefix):], entity_from_row(row))
+    finally:
+        ADAPTER.close_stream(conn, cur)
+
+
+def _sync_relations(conn, typed_ids, relation_keys, relation=None):
+    '''
+    Bring the stored relations of typed_ids in line with relation_keys,
+    deleting and inserting only the relations that differ. If relation
+    is given, other relations of typed_ids are left alone.
+    '''
+    stored = set(row for row in _select_in(
+        conn, 'typed_id, relation, secondary_key', 'relations', 'typed_id', typed_ids)
+        if relation is None or row[1] == relation)
+    wanted = set(relation_keys)
+    conn.cursor().executemany(
+        _maybe_qm(
+            'DELETE FROM relations WHERE typed_id = %s AND relation = %s AND secondary_key = %s'),
+        sorted(stored - wanted)
+    )
+    ADAPTER.insert_values(
+        conn.cursor(),
+        'INSERT INTO relations (typed_id, relation, secondary_key) VALUES %s',
+        sorted(wanted - stored)
+    )
 
 
 def upsert_entities(*entities):
     '''
     Store entities in the store, overwriting any previous entity with
     the same eid. Input is a series of (type, id, entity). Entity is any
-    jsonable value. Updates relations indexes as defined in the relations
-    argument passed to setup.
+    jsonable value. Updates the indexes passed to setup. Entities whose
+    content is identical to the stored entity are not written. Returns
+    a dict counting inserted, updated and unchanged entities.
     '''
     if DRIVER == 'mysql':
         replace_entities = '''
-        INSERT INTO entities (typed_id, sortkey, entity) VALUES (%s, %s, %s)
-        ON DUPLICATE KEY UPDATE sortkey = VALUES(sortkey), entity = VALUES(entity)
+        INSERT INTO entities (typed_id, type, sortkey, entity, content_hash, seq)
+        VALUES %s
+        ON DUPLICATE KEY UPDATE sortkey = VALUES(sortkey), entity = VALUES(entity),
+            content_hash = VALUES(content_hash), seq = VALUES(seq)
         '''
     else:
         replace_entities = '''
-        INSERT INTO entities (typed_id, sortkey, entity) VALUES (%s, %s, %s)
+        INSERT INTO entities (typed_id, type, sortkey, entity, content_hash, seq)
+        VALUES %s
         ON CONFLICT(typed_id)
-        DO UPDATE SET sortkey = excluded.sortkey, entity = excluded.entity
+        DO UPDATE SET sortkey = excluded.sortkey, entity = excluded.entity,
+            content_hash = excluded.content_hash, seq = excluded.seq
         '''
-    old_relations = '''
-    DELETE FROM relations WHERE typed_id = %s
-    '''
-    new_relations = '''
-    INSERT INTO relations (typed_id, relation, secondary_key) VALUES (%s, %s, %s)
-    '''
-    ids = (('%s:%s' % (typ, eid),) for (typ, eid, _) in entities)
-    _cursor().executemany(_maybe_qm(replace_entities), list(_prepare_entities(entities)))
-    _cursor().executemany(_maybe_qm(old_relations), list(ids))
-    _cursor().executemany(_maybe_qm(new_relations), list(_relation_keys(entities)))
+    run_rows = [_run_row(eid, entity)
+                for (typ, eid, entity) in entities if typ == 'run']
+    entities = [e for e in entities if e[0] != 'run']
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    with transaction() as conn:
+        run_rows = _changed_rows(conn, 'runs', 'run_id', run_rows, counts)
+        rows = _changed_rows(
+            conn, 'entities', 'typed_id', list(_prepare_entities(entities)), counts)
+        changed_ids = [row[0] for row in rows]
+        changed = set(changed_ids)
+        entities = [(typ, eid, entity) for (typ, eid, entity) in entities
+                    if '%s:%s' % (typ, eid) in changed]
+        _upsert_runs(conn, run_rows)
+        _summarize_runs(conn, set(row[1] for row in run_rows), datetime.now(timezone.utc))
+        ADAPTER.insert_values(conn.cursor(), replace_entities, _stamp(conn, rows))
+        _delete_in(conn, 'tombstones', 'typed_id',
+                   changed_ids + ['run:%s' % row[0] for row in run_rows])
+        _sync_relations(conn, changed_ids, _relation_keys(entities))
+        _bump_generations(conn, [row[1] for row in rows])
+    return counts
 
 
 def delete_entities(*query):
@@ -152,30 +1444,56 @@ def delete_entities(*query):
     Delete entities from the store. The query is a list of (type, id) 
     tuples. Raises EntityNotFound when asked to delete non-existent entities.
     '''
-    load_entities(*query)
-    delete_entities = 'DELETE FROM entities WHERE typed_id = %s'
-    delete_relations = 'DELETE FROM relations WHERE typed_id = %s'
-    ids = [('%s:%s' % (typ, eid),) for (typ, eid) in query]
-    _cursor().executemany(_maybe_qm(delete_entities), ids)
-    _cursor().executemany(_maybe_qm(delete_relations), ids)
+    run_ids = [eid for (typ, eid) in query if typ == 'run']
+    ids = ['%s:%s' % (typ, eid) for (typ, eid) in query if typ != 'run']
+    with transaction() as conn:
+        found = load_entities(*query)
+        _delete_in(conn, 'runs', 'run_id', run_ids)
+        _delete_in(conn, 'entities', 'typed_id', ids)
+        _delete_in(conn, 'relations', 'typed_id', ids)
+        _delete_in(conn, 'run_summaries', 'job_key',
+                   [typed_id for typed_id in ids if typed_id.startswith('job:')])
+        _summarize_runs(
+            conn,
+            set(entity.get('job_id') for ((typ, _), entity) in zip(query, found)
+                if typ == 'run'),
+            datetime.now(timezone.utc)
+        )
+        _write_tombstones(conn, ['%s:%s' % (typ, eid) for (typ, eid) in query])
+        _bump_generations(conn, [typ for (typ, _) in query])
 
 
-# TODO: replace_type needs to know what index to chuck out
 def replace_type(typ, entities):
     '''
     Drop all entities of one type, and replace them with the provided
-    list.
+    list. Relations are updated to match the new entities.
     '''
-    delete_cur = _cursor()
-    delete_cur.execute(
-        _maybe_qm('DELETE FROM entities WHERE typed_id LIKE %s'),
-        [typ + ':%']
-    )
-    rows = (('%s:%s' % (typ, eid), json.dumps(entity))
-            for (eid, entity) in entities.items())
-    insert_cur = _cursor()
-    insert_cur.executemany(
-        _maybe_qm('INSERT INTO entities (typed_id, entity) VALUES (%s, %s)'),
-        list(rows)
-    )
-    return (delete_cur.rowcount, insert_cur.rowcount)
+    entities = [(typ, eid, entity) for (eid, entity) in entities.items()]
+    rows = list(_prepare_entities(entities))
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            _maybe_qm('SELECT typed_id FROM entities WHERE type = %s'),
+            [typ]
+        )
+        typed_ids = [typed_id for (typed_id,) in cur]
+        delete_cur = conn.cursor()
+        delete_cur.execute(
+            _maybe_qm('DELETE FROM entities WHERE type = %s'),
+            [typ]
+        )
+        ADAPTER.insert_values(
+            conn.cursor(),
+            'INSERT INTO entities (typed_id, type, sortkey, entity, content_hash, seq) VALUES %s',
+            _stamp(conn, rows)
+        )
+        new_ids = set(row[0] for row in rows)
+        _delete_in(conn, 'tombstones', 'typed_id', sorted(new_ids))
+        _write_tombstones(conn, [typed_id for typed_id in typed_ids if typed_id not in new_ids])
+        _sync_relations(
+            conn,
+            typed_ids + [row[0] for row in rows],
+            _relation_keys(entities)
+        )
+        _bump_generations(conn, [typ])
+        return (delete_cur.rowcount, len(rows))
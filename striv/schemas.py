@@ -22,6 +22,15 @@ class Dimension(Schema):
     )
 
 
+class RetentionPolicy(Schema):
+    '''
+    How long runs are kept. Runs older than max_age_days or beyond the
+    newest max_runs_per_job runs of their job are purged.
+    '''
+    max_age_days = fields.Integer(validate=validate.Range(min=1))
+    max_runs_per_job = fields.Integer(validate=validate.Range(min=1))
+
+
 class Execution(Schema):
     '''
     One conceptual model for how to execute tasks or services on a
@@ -33,6 +42,7 @@ class Execution(Schema):
     driver_config = fields.Dict()
     default_params = ParamsDefinition
     payload_template = fields.String(required=True)
+    retention = fields.Nested(RetentionPolicy)
 
 
 class Job(Schema):
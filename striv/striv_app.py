@@ -2,6 +2,8 @@
 
 import time
 import base64
+import hashlib
+import itertools
 import json
 import logging
 import os.path
@@ -11,12 +13,19 @@ import urllib.parse
 import uuid
 from argparse import ArgumentParser
 from datetime import datetime, timezone
+from types import GeneratorType
 
 import marshmallow
 from bottle import Bottle, HTTPResponse, request, response, static_file
 from striv import crypto, errors, schemas, templating
+from striv.entity_loader import EntityLoader
+from striv.rdbm_pool import PoolTimeout
 
 DEFAULT_LIMIT = 1000
+# Streamed responses are written in chunks of about this many bytes
+STREAM_CHUNK_SIZE = 64 * 1024
+# Bucket sizes in seconds for /runs/stats
+BUCKET_SIZES = {'minute': 60, 'hour': 3600, 'day': 86400}
 
 logger = logging.getLogger('striv')
 handler = logging.StreamHandler(sys.stderr)
@@ -46,6 +55,16 @@ def error_handler(func):
                 status=404,
                 headers={'Content-type': 'application/json'}
             )
+        except PoolTimeout as err:
+            logger.warning('Store connection pool exhausted [err=%s]', err)
+            return HTTPResponse(
+                body=json.dumps({
+                    'title': 'Service unavailable',
+                    'detail': str(err),
+                }),
+                status=503,
+                headers={'Content-type': 'application/json'}
+            )
         except Exception as err:
             logger.warning('Exception raised [err=%s]', err, exc_info=True)
             return HTTPResponse(
@@ -67,6 +86,41 @@ def cors_headers(func):
     return wrapper
 
 
+def store_connection(func):
+    '''
+    Check out one store connection and create one entity loader per
+    request. Streamed responses keep the connection until the response
+    body has been written.
+    '''
+    def wrapper(*args, **kwargs):
+        checkout = app.store.connection()
+        checkout.__enter__()
+        try:
+            request.environ['striv.loader'] = EntityLoader(app.store)
+            result = func(*args, **kwargs)
+        except BaseException:
+            checkout.__exit__(*sys.exc_info())
+            raise
+        if isinstance(result, GeneratorType):
+            return _release_after(result, checkout)
+        checkout.__exit__(None, None, None)
+        return result
+    return wrapper
+
+
+def _release_after(chunks, checkout):
+    failure = (None, None, None)
+    try:
+        yield from chunks
+    except Exception:
+        failure = sys.exc_info()
+        raise
+    finally:
+        # Also reached when the server closes the response early
+        chunks.close()
+        checkout.__exit__(*failure)
+
+
 def marshmallow_validation(func):
     '''
     Translate marshmallow validation errors to 422s
@@ -110,13 +164,22 @@ def templating_validation(func):
 
 app.install(error_handler)
 app.install(cors_headers)
+app.install(store_connection)
 app.install(marshmallow_validation)
 app.install(templating_validation)
 
 
-def _job_to_payload(job, value_parsers):
+def _load(*keys):
+    return request.environ['striv.loader'].load(*keys)
+
+
+def _job_layers(job):
+    '''
+    Load the execution of a job and its params layers, as (name, params)
+    in merge order.
+    '''
     selected_dimensions = job.get('dimensions', {})
-    execution, *dimensions = app.store.load_entities(
+    execution, *dimensions = _load(
         ('execution', job['execution']),
         *[('dimension', name) for name in selected_dimensions.keys()]
     )
@@ -126,28 +189,64 @@ def _job_to_payload(job, value_parsers):
             (d['priority'], k, d['values'][v]['params'])
         )
     selected_params.sort()
-    params_snippet = templating.merge_layers(
-        templating.materialize_layer(
-            'default', execution['default_params'], value_parsers),
+    layers = [
+        ('default', execution['default_params']),
+        *[(name, params) for (_, name, params) in selected_params],
+        (job['name'], job.get('params', {})),
+    ]
+    return execution, layers
+
+
+def _job_to_payload(job, value_parsers):
+    execution, layers = _job_layers(job)
+    params_json = templating.merge_layers(
         *[templating.materialize_layer(name, params, value_parsers)
-          for (_, name, params) in selected_params],
-        templating.materialize_layer(
-            job['name'],
-            job.get('params', {}),
-            value_parsers
-        )
+          for (name, params) in layers]
     )
     payload = templating.evaluate(
         execution['payload_template'],
-        params_snippet
+        params_json
     )
-    return execution, payload, params_snippet
+    return execution, payload, params_json
 
 
-def _apply_job(job_id, job):
-    execution, payload, _ = _job_to_payload(job, app.apply_value_parsers)
-    backend = app.backends[execution['driver']]
-    backend.sync_job(execution['driver_config'], job_id, payload)
+def _payload_fingerprint(execution, layers):
+    '''
+    Fingerprint everything that goes into the rendered payload, taking
+    params as stored so that secrets are only seen encrypted. Layer
+    names only show up in error messages and are left out.
+    '''
+    canonical = json.dumps(
+        [execution['driver'], execution.get('driver_config'), execution['payload_template'],
+         [params for (_, params) in layers]],
+        sort_keys=True,
+        separators=(',', ':')
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+# Job properties maintained by striv for its own use
+PRIVATE_JOB_FIELDS = ('payload_fingerprint',)
+
+
+def _public_job(job):
+    return dict((k, v) for (k, v) in job.items() if k not in PRIVATE_JOB_FIELDS)
+
+
+def _apply_job(job_id, job, previous=None, force=False):
+    '''
+    Render the job and sync it to its backend, unless its inputs are
+    the same as when previous was synced.
+    '''
+    execution, layers = _job_layers(job)
+    fingerprint = _payload_fingerprint(execution, layers)
+    if force or (previous or {}).get('payload_fingerprint') != fingerprint:
+        _, payload, _ = _job_to_payload(job, app.apply_value_parsers)
+        backend = app.backends[execution['driver']]
+        backend.sync_job(execution['driver_config'], job_id, payload)
+    else:
+        logger.debug('Payload inputs unchanged, skipping sync [job_id=%s]', job_id)
+    job['payload_fingerprint'] = fingerprint
     job['modified_at'] = datetime.now(
         timezone.utc).strftime('%Y-%m-%dT%H:%M:%S%z')
     app.store.upsert_entities(('job', job_id, job))
@@ -162,8 +261,9 @@ def _decode_page_token(encoded):
     return json.loads(base64.b64decode(urllib.parse.unquote(encoded)))
 
 
-def _range_and_adjusted_limit(request):
-    rnge = ['desc', None, None]
+def _range_and_limit(request, order='desc'):
+    rnge = [order, None, None]
+    after = None
     if ('lower' in request.query or 'upper' in request.query):
         if 'page_token' in request.query:
             raise HTTPResponse(
@@ -172,20 +272,121 @@ def _range_and_adjusted_limit(request):
                     'title': 'pagination cannot be combined with range'
                 })
             )
-        rnge = ['desc', request.query.get('lower'), request.query.get('upper')]
+        rnge = [order, request.query.get('lower'), request.query.get('upper')]
     elif 'page_token' in request.query:
-        rnge = _decode_page_token(request.query['page_token'])
+        *rnge, after = _decode_page_token(request.query['page_token'])
     limit = int(request.query.get('limit', DEFAULT_LIMIT))
-    limit = min(limit, DEFAULT_LIMIT) + 1
-    return (rnge, limit)
+    limit = max(1, min(limit, DEFAULT_LIMIT))
+    return (rnge, after, limit)
+
+
+def _link_next(path, rnge, last):
+    '''
+    Point the Link header to the page continuing after last, a
+    (sortkey, id) pair. Filters and fields of the current request are
+    carried over to the next page.
+    '''
+    token = _encode_page_token(*rnge, list(last))
+    carried = [(k, v) for (k, v) in request.query.decode().allitems()
+               if k not in ('page_token', 'lower', 'upper', 'limit')]
+    query = ('&' + urllib.parse.urlencode(carried)) if carried else ''
+    response.headers['Link'] = '<%s?page_token=%s%s>; rel="next"' % (
+        path, token, query)
+
+
+def _run_filters(request):
+    '''
+    Return (where, finished_after) from the status and finished_after
+    query parameters of a runs listing. Status may be repeated.
+    '''
+    where = {}
+    statuses = request.query.getall('status')
+    if statuses:
+        where['status'] = statuses
+    finished_after = request.query.get('finished_after')
+    if finished_after is not None:
+        try:
+            datetime.strptime(finished_after, '%Y-%m-%dT%H:%M:%S%z')
+        except ValueError as exc:
+            raise HTTPResponse(
+                status=400,
+                body=json.dumps({
+                    'title': 'finished_after must be a timestamp like 2020-01-01T00:00:00+0000'
+                })
+            ) from exc
+    return (where, finished_after)
+
+
+def _fields(request):
+    '''
+    The fields query parameter selects which top-level properties of
+    each entity to return. It takes comma-separated names and may be
+    repeated. Returns None when all properties are wanted.
+    '''
+    fields = set()
+    for value in request.query.getall('fields'):
+        fields.update(f.strip() for f in value.split(',') if f.strip())
+    return fields or None
+
+
+def _comma_separated(request, name):
+    values = set()
+    for value in request.query.getall(name):
+        values.update(v for v in value.split(',') if v)
+    return values
+
+
+def _include(request):
+    '''
+    The include query parameter names comma-separated extras to add to
+    each entity. Only summary is known.
+    '''
+    include = _comma_separated(request, 'include')
+    if include - {'summary'}:
+        raise HTTPResponse(
+            status=400,
+            body=json.dumps({
+                'title': 'unknown include: %s' % ', '.join(sorted(include - {'summary'}))
+            })
+        )
+    return include
 
 
-@app.get('/')
+def _project(entities, fields):
+    for (eid, entity) in entities:
+        if fields is not None:
+            entity = dict((k, v) for (k, v) in entity.items() if k in fields)
+        yield (eid, entity)
+
+
+def _stream_json(entities):
+    '''
+    Serialize (id, entity) pairs as a JSON object, one chunk at a time.
+    '''
+    chunk = ['{']
+    size = 0
+    separator = ''
+    for (eid, entity) in entities:
+        part = '%s%s: %s' % (separator, json.dumps(eid), json.dumps(entity))
+        chunk.append(part)
+        size += len(part)
+        separator = ', '
+        if size >= STREAM_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    chunk.append('}')
+    yield ''.join(chunk)
+
+
+# Static files need no store connection, so they do not compete with
+# API requests for the connection pool
+@app.get('/', skip=[store_connection])
 def index():
     return static_file('index.html', root='dist')
 
 
-@app.get('/<path:re:(css/|js/|.*\.png|favicon.ico).*>')
+@app.get('/<path:re:(css/|js/|.*\.png|favicon.ico).*>', skip=[store_connection])
 def static_files(path):
     return static_file(path, root='dist')
 
@@ -193,9 +394,37 @@ def static_files(path):
 @app.get('/jobs')
 def list_jobs():
     '''
-    Retrieve a list of jobs. Returns a dict mapping id to entity.
+    Retrieve a list of jobs ordered by name. Returns a dict mapping id
+    to entity. dimension=env:prod (repeatable) selects jobs with all
+    the given dimension values and execution=<id> selects jobs of one
+    execution. With limit, page_token, lower or upper, the listing is
+    paginated like /runs, with lower and upper bounding the job name;
+    otherwise all jobs are returned. Use fields=name,execution to return only some properties
+    of each job. include=summary adds a run_summary to each job with
+    its last run and counts of recently finished runs.
     '''
-    return app.store.find_entities('job')
+    rnge, after, limit = _range_and_limit(request, order='asc')
+    if not any(k in request.query for k in ('limit', 'page_token', 'lower', 'upper')):
+        limit = None
+    include = _include(request)
+    where = {}
+    if 'execution' in request.query:
+        where['execution'] = request.query['execution']
+    jobs, last = app.store.stream_entities(
+        'job',
+        related_to=[('dvalue', dvalue)
+                    for dvalue in request.query.getall('dimension')],
+        range=rnge,
+        after=after,
+        limit=limit,
+        where=where,
+        fields=_fields(request),
+        with_run_summary='summary' in include
+    )
+    if last is not None:
+        _link_next('/jobs', rnge, last)
+    response.content_type = 'application/json'
+    return _stream_json((eid, _public_job(job)) for (eid, job) in jobs)
 
 
 @app.post('/jobs')
@@ -216,10 +445,9 @@ def evaluate_job():
     the payload for debugging.
     '''
     job = schemas.Job().load(request.json)
-    _, payload, params_snippet = _job_to_payload(
+    _, payload, params_json = _job_to_payload(
         job, app.evaluate_value_parsers)
-    params = json.loads(templating.evaluate(params_snippet, 'null'))
-    return {'payload': payload, 'params': params}
+    return {'payload': payload, 'params': json.loads(params_json)}
 
 
 @app.get('/job/:job_id')
@@ -227,18 +455,19 @@ def get_job(job_id):
     '''
     Retrieve a single job definition.
     '''
-    return app.store.load_entities(('job', job_id))[0]
+    return _public_job(_load(('job', job_id))[0])
 
 
 @app.put('/job/:job_id')
 def put_job(job_id):
     '''
     Update an existing job definition. This method cannot be used to
-    create new jobs.
+    create new jobs. The job is only synced to its backend when its
+    rendered payload has changed; pass force=true to always sync.
     '''
-    app.store.load_entities(('job', job_id))[0]
+    previous = _load(('job', job_id))[0]
     job = schemas.Job().load(request.json)
-    _apply_job(job_id, job)
+    _apply_job(job_id, job, previous, force=request.query.get('force') == 'true')
     return {'id': job_id}
 
 
@@ -256,8 +485,8 @@ def run_job_now(job_id):
     '''
     Trigger an immediate run of this job.
     '''
-    job = app.store.load_entities(('job', job_id))[0]
-    execution = app.store.load_entities(('execution', job['execution']))[0]
+    job = _load(('job', job_id))[0]
+    execution = _load(('execution', job['execution']))[0]
     backend = app.backends[execution['driver']]
     backend.run_once(execution['driver_config'], job_id)
 
@@ -265,22 +494,47 @@ def run_job_now(job_id):
 @app.get('/job/:job_id/runs')
 def list_job_runs(job_id):
     '''
-    Return a dict with all runs for this job.
+    Return a dict with all runs for this job. Accepts the same
+    parameters as /runs.
     '''
-    rnge, limit = _range_and_adjusted_limit(request)
-    app.store.load_entities(('job', job_id))
-    runs = app.store.find_entities(
+    rnge, after, limit = _range_and_limit(request)
+    where, finished_after = _run_filters(request)
+    runs, last = app.store.stream_entities(
         'run',
         related_to=('job', job_id),
         range=rnge,
-        limit=limit
+        after=after,
+        limit=limit,
+        where=where,
+        finished_after=finished_after,
+        fields=_fields(request)
     )
-    if len(runs) == limit:
-        (_, last_run) = runs.popitem()
-        response.headers['Link'] = '</runs?page_token=%s>; rel="next"' % (
-            _encode_page_token('desc', None, last_run['created_at'])
-        )
-    return runs
+    first = next(runs, None)
+    if first is None:
+        # Only an empty page needs to tell unknown jobs apart
+        runs.close()
+        _load(('job', job_id))
+        runs = iter([])
+    else:
+        runs = itertools.chain([first], runs)
+    if last is not None:
+        _link_next('/job/%s/runs' % job_id, rnge, last)
+    response.content_type = 'application/json'
+    return _stream_json(runs)
+
+
+@app.get('/metrics')
+def get_metrics():
+    '''
+    Returns operational counters for monitoring.
+    '''
+    return {
+        'store_pool': app.store.pool_metrics(),
+        'store_indexes': app.store.index_states(),
+        'store_cache': app.store.cache_metrics(),
+        'template_layer_cache': templating.layer_cache_metrics(),
+        'template_workers': templating.evaluation_metrics(),
+    }
 
 
 @app.get('/public-key')
@@ -303,8 +557,8 @@ def get_public_key():
 def refresh_runs():
     '''
     Request run updates from all backend systems. Runs will be created
-    and updated as necessary. Returns metrics on created and updated
-    runs.
+    and updated as necessary. Returns metrics on inserted, updated and
+    unchanged runs.
     '''
     identities = {}
     for execution in app.store.find_entities('execution').values():
@@ -313,16 +567,18 @@ def refresh_runs():
             execution['driver_config']
         )
         identities[identity] = (backend, execution['driver_config'])
+    app.store.ensure_run_partitions()
     jobs = app.store.find_entities('job')
-    total_runs = 0
+    runs = {}
     for (_backend, driver_config) in identities.values():
-        runs = _backend.fetch_runs(driver_config, jobs).items()
-        for _, run in runs:
-            run['execution'] = jobs[run['job_id']]['execution']
-        app.store.upsert_entities(*(('run', run_id, run)
-                                    for run_id, run in runs))
-        total_runs += len(runs)
-    return {'processed': total_runs}
+        runs.update(_backend.fetch_runs(driver_config, jobs))
+    for run in runs.values():
+        run['execution'] = jobs[run['job_id']]['execution']
+    with app.store.transaction():
+        counts = app.store.upsert_entities(*(('run', run_id, run)
+                                             for run_id, run in runs.items()))
+        app.store.refresh_run_summaries()
+    return dict(counts, processed=len(runs))
 
 
 @app.get('/runs')
@@ -331,16 +587,66 @@ def list_runs():
     Retrieve runs. Number of runs can be controlled by limit, but there
     is a hard max (1000 by default). If there are more runs than limit
     allows, a Link header is returned which can be used to request the
-    next page.
-    '''
-    rnge, limit = _range_and_adjusted_limit(request)
-    runs = app.store.find_entities('run', range=rnge, limit=limit)
-    if len(runs) == limit:
-        (_, last_run) = runs.popitem()
-        response.headers['Link'] = '</runs?page_token=%s>; rel="next"' % (
-            _encode_page_token('desc', None, last_run['created_at'])
+    next page. Use fields=status,created_at to return only some
+    properties of each run. Runs can be filtered by status (may be
+    repeated) and by finished_after, a timestamp.
+    '''
+    rnge, after, limit = _range_and_limit(request)
+    where, finished_after = _run_filters(request)
+    runs, last = app.store.stream_entities(
+        'run',
+        range=rnge,
+        after=after,
+        limit=limit,
+        where=where,
+        finished_after=finished_after,
+        fields=_fields(request)
+    )
+    if last is not None:
+        _link_next('/runs', rnge, last)
+    response.content_type = 'application/json'
+    return _stream_json(runs)
+
+
+@app.get('/runs/stats')
+def get_run_stats():
+    '''
+    Aggregate runs. group_by takes comma-separated job, execution,
+    status and bucket, where bucket groups runs by creation time in
+    buckets of bucket_size (minute, hour or day, default hour).
+    percentiles (default 50,95) selects which run duration percentiles
+    to return. Runs are selected with job, lower, upper, status and
+    finished_after. Returns {"groups": [...]} with run counts and
+    durations in seconds for each group.
+    '''
+    group_by = _comma_separated(request, 'group_by')
+    unknown = group_by - set(app.store.STAT_GROUPS) - {'bucket'}
+    bucket_size = request.query.get('bucket_size', 'hour')
+    try:
+        percentiles = sorted(set(float(p) for p in (
+            _comma_separated(request, 'percentiles') or ['50', '95'])))
+    except ValueError:
+        percentiles = None
+    if unknown or bucket_size not in BUCKET_SIZES or percentiles is None or \
+            not all(0 <= p <= 100 for p in percentiles):
+        raise HTTPResponse(
+            status=400,
+            body=json.dumps({
+                'title': 'group_by takes %s and bucket, bucket_size one of %s and percentiles numbers 0-100' % (
+                    ', '.join(sorted(app.store.STAT_GROUPS)), ', '.join(BUCKET_SIZES))
+            })
         )
-    return runs
+    where, finished_after = _run_filters(request)
+    stats = app.store.run_stats(
+        group_by=[name for name in ('job', 'execution', 'status') if name in group_by],
+        bucket=BUCKET_SIZES[bucket_size] if 'bucket' in group_by else None,
+        related_to=('job', request.query['job']) if 'job' in request.query else None,
+        range=('asc', request.query.get('lower'), request.query.get('upper')),
+        where=where,
+        finished_after=finished_after,
+        percentiles=percentiles
+    )
+    return {'groups': stats}
 
 
 @app.get('/run/:run_id')
@@ -348,7 +654,7 @@ def get_run(run_id):
     '''
     Returns a single run.
     '''
-    return app.store.load_entities(('run', run_id))[0]
+    return _load(('run', run_id))[0]
 
 
 @app.get('/run/:run_id/logs')
@@ -359,11 +665,11 @@ def get_run_log(run_id):
     kwargs = {}
     if 'max_size' in request.query:
         kwargs['max_size'] = int(request.query['max_size'])
-    run = app.store.load_entities(('run', run_id))[0]
-    execution = app.store.load_entities(('execution', run['execution']))[0]
+    run = _load(('run', run_id))[0]
+    execution = _load(('execution', run['execution']))[0]
     logstore = app.logstores[execution['logstore']]
     try:
-        return logstore.fetch_logs(execution['driver_config'], run_id, run, **kwargs)
+        logs = logstore.fetch_logs(execution['driver_config'], run_id, run, **kwargs)
     except errors.RunNotFound as err:
         return HTTPResponse(
             status=410,
@@ -373,6 +679,75 @@ def get_run_log(run_id):
             }),
             headers={'Content-type': 'application/json'},
         )
+    if app.archiving and run.get('status') in app.store.FINISHED_STATUSES:
+        # Once archived, the run can be purged without losing its logs
+        app.store.mark_runs_archived(run_id)
+    return logs
+
+
+@app.post('/runs/purge')
+def purge_runs():
+    '''
+    Delete one batch of runs that have outlived their retention policy,
+    either the retention of their execution or the configured default.
+    When logs are archived, only runs with archived logs are deleted.
+    Pass batch_size to control the size of the batch (default 1000).
+    Returns the number of deleted runs.
+    '''
+    batch_size = max(1, min(int(request.query.get('batch_size', 1000)), 10000))
+    policies = dict(
+        (eid, dict(app.run_retention, **execution.get('retention', {})))
+        for (eid, execution) in app.store.find_entities('execution').items()
+    )
+    deleted = app.store.purge_runs(
+        policies,
+        default=app.run_retention,
+        batch_size=batch_size,
+        archived_only=app.archiving
+    )
+    return {'deleted': deleted}
+
+
+@app.get('/changes')
+def list_changes():
+    '''
+    Retrieve entities and runs that changed after sequence number since,
+    in sequence order. Each change carries type, id and seq and either
+    the entity or deleted: true. Pass types (comma-separated) to only
+    get some entity types. Returns {"changes": [...], "last_seq": N,
+    "head": M} where last_seq is the since to use when polling next and
+    head is the latest sequence number when the request started, the
+    since to use for following only future changes. When there may be
+    more changes, a Link header points to the next page.
+    '''
+    try:
+        since = int(request.query['since'])
+    except (KeyError, ValueError) as exc:
+        raise HTTPResponse(
+            status=400,
+            body=json.dumps({
+                'title': 'since must be a sequence number, start from 0'
+            })
+        ) from exc
+    types = _comma_separated(request, 'types') or None
+    limit = int(request.query.get('limit', DEFAULT_LIMIT))
+    limit = max(1, min(limit, DEFAULT_LIMIT))
+    head = app.store.change_head()
+    changes = []
+    for (seq, typ, eid, entity) in app.store.changes(since, types=types, limit=limit):
+        change = {'type': typ, 'id': eid, 'seq': seq}
+        if entity is None:
+            change['deleted'] = True
+        else:
+            change['entity'] = _public_job(entity) if typ == 'job' else entity
+        changes.append(change)
+    last_seq = changes[-1]['seq'] if changes else since
+    if len(changes) == limit:
+        carried = [(k, v) for (k, v) in request.query.decode().allitems()
+                   if k != 'since']
+        response.headers['Link'] = '</changes?%s>; rel="next"' % urllib.parse.urlencode(
+            [('since', last_seq)] + carried)
+    return {'changes': changes, 'last_seq': last_seq, 'head': head}
 
 
 @app.get('/state')
@@ -381,12 +756,21 @@ def dump_state():
     Returns a json object with all config level information suitable for
     posting to /state. The dump is guaranteed to be internally
     consistent and in order to guarantee this, writes may fail during
-    dumping.
+    dumping. fields projects executions and dimensions as for /jobs,
+    but such a dump cannot be posted back.
     '''
-    return {
-        'dimensions': app.store.find_entities('dimension'),
-        'executions': app.store.find_entities('execution')
-    }
+    fields = _fields(request)
+    dimensions = app.store.find_entities('dimension')
+    executions = app.store.find_entities('execution')
+
+    def dump():
+        yield '{"dimensions": '
+        yield from _stream_json(_project(dimensions.items(), fields))
+        yield ', "executions": '
+        yield from _stream_json(_project(executions.items(), fields))
+        yield '}'
+    response.content_type = 'application/json'
+    return dump()
 
 
 @app.post('/state')
@@ -396,23 +780,25 @@ def load_state():
     passed in. The payload is supposed to be a json object on the format
     {"executions": [{...}, ...], "dimensions": [{...}, ...]}. Include
     only the types that you want to replace. The load operation is
-    guaranteed to be atomic, but not instantaneous (i.e. other endpoints may
-    temporarily 500).
+    performed in a single transaction.
     '''
     state = schemas.State().load(request.json)
     changes = {}
-    if 'dimensions' in state.keys():
-        deleted, inserted = app.store.replace_type(
-            'dimension',
-            state['dimensions']
-        )
-        changes['dimensions'] = {'deleted': deleted, 'inserted': inserted}
-    if 'executions' in state.keys():
-        deleted, inserted = app.store.replace_type(
-            'execution',
-            state['executions']
-        )
-        changes['executions'] = {'deleted': deleted, 'inserted': inserted}
+    with app.store.transaction():
+        if 'dimensions' in state.keys():
+            deleted, inserted = app.store.replace_type(
+                'dimension',
+                state['dimensions']
+            )
+            changes['dimensions'] = {
+                'deleted': deleted, 'inserted': inserted}
+        if 'executions' in state.keys():
+            deleted, inserted = app.store.replace_type(
+                'execution',
+                state['executions']
+            )
+            changes['executions'] = {
+                'deleted': deleted, 'inserted': inserted}
     return changes
 
 
@@ -452,6 +838,96 @@ parser.add_argument(
     ),
     help='JSON object with store config parameters',
 )
+parser.add_argument(
+    '--store-pool-min',
+    type=int,
+    default=os.environ.get(
+        'STRIV_STORE_POOL_MIN',
+        1
+    ),
+    help='Number of store connections to keep open',
+)
+parser.add_argument(
+    '--store-pool-max',
+    type=int,
+    default=os.environ.get(
+        'STRIV_STORE_POOL_MAX',
+        10
+    ),
+    help='Max number of concurrently open store connections',
+)
+parser.add_argument(
+    '--store-pool-timeout',
+    type=float,
+    default=os.environ.get(
+        'STRIV_STORE_POOL_TIMEOUT',
+        30.0
+    ),
+    help='Seconds to wait for a free store connection',
+)
+parser.add_argument(
+    '--template-layer-cache-size',
+    type=int,
+    default=os.environ.get(
+        'STRIV_TEMPLATE_LAYER_CACHE_SIZE',
+        1000
+    ),
+    help='Max number of materialized param layers to cache, 0 disables',
+)
+parser.add_argument(
+    '--template-workers',
+    type=int,
+    default=os.environ.get(
+        'STRIV_TEMPLATE_WORKERS',
+        0
+    ),
+    help='Number of processes evaluating templates, 0 evaluates inline',
+)
+parser.add_argument(
+    '--template-timeout',
+    type=float,
+    default=os.environ.get(
+        'STRIV_TEMPLATE_TIMEOUT',
+        10.0
+    ),
+    help='Seconds a template evaluation may take, when using template workers',
+)
+parser.add_argument(
+    '--template-memory-limit',
+    type=int,
+    default=os.environ.get(
+        'STRIV_TEMPLATE_MEMORY_LIMIT',
+        1024
+    ),
+    help='Max memory in megabytes of each template worker',
+)
+parser.add_argument(
+    '--store-run-partition-months',
+    type=int,
+    default=os.environ.get(
+        'STRIV_STORE_RUN_PARTITION_MONTHS',
+        0
+    ),
+    help='Store runs in partitions of this many months (mysql and postgres only, 0 to disable)',
+)
+parser.add_argument(
+    '--run-max-age-days',
+    type=int,
+    default=os.environ.get(
+        'STRIV_RUN_MAX_AGE_DAYS',
+        None
+    ),
+    help='Default number of days to keep runs; executions may override',
+)
+parser.add_argument(
+    '--run-max-runs-per-job',
+    type=int,
+    default=os.environ.get(
+        'STRIV_RUN_MAX_RUNS_PER_JOB',
+        None
+    ),
+    help='Default number of runs to keep per job; executions may override',
+)
 parser.add_argument(
     '--log-level',
     default=os.environ.get(
@@ -468,14 +944,15 @@ def configure_encryption(app, private_key_pem):
         return
     app.private_key = crypto.deserialize_private_key(private_key_pem)
     app.public_key_pem = crypto.recover_pubkey(app.private_key)
-    app.apply_value_parsers['secret'] = \
-        lambda v: crypto.decrypt_value(app.private_key, v['encrypted'])
+    app.apply_value_parsers['secret'] = templating.sensitive(
+        lambda v: crypto.decrypt_value(app.private_key, v['encrypted']))
     app.evaluate_value_parsers['secret'] = \
         lambda v: '<redacted>'
 
 
 def configure_logstores(app, archive_config):  # pylint: disable = import-outside-toplevel
     from striv import nomad_logstore
+    app.archiving = bool(archive_config)
     if archive_config:
         typ = archive_config['type']
         if typ == 'file':
@@ -499,21 +976,35 @@ def configure(app, args):
     }
     app.evaluate_value_parsers = app.apply_value_parsers.copy()
     configure_encryption(app, args.encryption_key)
+    templating.setup_layer_cache(args.template_layer_cache_size)
+    templating.setup_evaluation(
+        workers=args.template_workers,
+        timeout=args.template_timeout,
+        memory_limit=args.template_memory_limit * 1024 * 1024
+    )
     from striv import nomad_backend, rdbm_store  # pylint: disable = import-outside-toplevel
     app.store = rdbm_store
     app.backends['nomad'] = nomad_backend
     configure_logstores(app, args.archive_config)
+    app.run_retention = dict(
+        (k, v) for (k, v) in [
+            ('max_age_days', args.run_max_age_days),
+            ('max_runs_per_job', args.run_max_runs_per_job),
+        ] if v
+    )
     app.store.setup(
         args.store_type,
         json.loads(args.store_config),
-        relations={
-            'run': lambda run: [('job', run['job_id'])],
-            'job': lambda job: [('dvalue', '%s:%s' % (n, v)) for (n, v) in job.get('dimensions', {}).items()]
+        indexes={
+            'dvalue': ('job', lambda job: ['%s:%s' % (n, v) for (n, v) in job.get('dimensions', {}).items()]),
         },
         sortkeys={
             'job': lambda job: job['name'],
-            'run': lambda run: run['created_at']
-        }
+        },
+        pool_min=args.store_pool_min,
+        pool_max=args.store_pool_max,
+        pool_timeout=args.store_pool_timeout,
+        run_partition_months=args.store_run_partition_months
     )
 
 
@@ -0,0 +1,183 @@
+import multiprocessing
+import resource
+import threading
+import time
+
+import _jsonnet
+
+
+class EvaluationTimeout(RuntimeError):
+    '''
+    The evaluation did not finish, or did not get a worker, within the
+    evaluation timeout.
+    '''
+
+
+def _serve(conn, memory_limit):
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    while True:
+        try:
+            name, snippet, kwargs = conn.recv()
+        except EOFError:
+            return
+        try:
+            conn.send((True, _jsonnet.evaluate_snippet(name, snippet, **kwargs)))
+        except RuntimeError as exc:
+            conn.send((False, exc.args))
+        except MemoryError:
+            conn.send((False, ('Template evaluation exceeded the memory limit',)))
+
+
+class EvaluatorPool:
+    '''
+    A bounded, thread-safe pool of processes evaluating jsonnet
+    snippets, so that heavy templates use all cores and do not block
+    the API. Each evaluation gets timeout seconds, including any wait
+    for a free worker. A worker which runs out of time is killed and
+    replaced, cancelling its evaluation; if no replacement can be
+    started, the pool shrinks. memory_limit caps the address space of
+    each worker in bytes.
+    '''
+
+    def __init__(self, size, timeout=10.0, memory_limit=None):
+        assert 0 < size
+        self.size = size
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        # Forking a threaded server is unsafe; forkserver starts
+        # workers from a clean single-threaded process.
+        self.context = multiprocessing.get_context('forkserver')
+        self.queued = 0
+        self.closed = False
+        self.stats = {
+            'evaluations': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'crashes': 0,
+            'restarts': 0,
+            'start_failures': 0,
+        }
+        self.lock = threading.Condition()
+        self.idle = [self._start() for _ in range(size)]
+
+    def _start(self):
+        parent, child = self.context.Pipe()
+        process = self.context.Process(
+            target=_serve,
+            args=(child, self.memory_limit),
+            name='jsonnet-worker',
+            daemon=True
+        )
+        process.start()
+        child.close()
+        return (process, parent)
+
+    @staticmethod
+    def _stop(worker):
+        process, conn = worker
+        process.kill()
+        process.join()
+        conn.close()
+
+    def _acquire(self, deadline, timeout):
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('Template evaluator pool is closed')
+            if not self.idle:
+                self.stats['waits'] += 1
+            self.queued += 1
+            try:
+                while not self.idle:
+                    if self.size == 0:
+                        raise RuntimeError('Template evaluator pool has no workers left')
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.stats['timeouts'] += 1
+                        raise EvaluationTimeout(
+                            'No template worker available after %.1fs' % timeout)
+                    self.lock.wait(remaining)
+                return self.idle.pop()
+            finally:
+                self.queued -= 1
+
+    def _release(self, worker):
+        with self.lock:
+            if not self.closed:
+                self.idle.append(worker)
+                self.lock.notify()
+                return
+        self._stop(worker)
+
+    def _replace(self, worker):
+        self._stop(worker)
+        try:
+            replacement = self._start()
+        except OSError:
+            # Give up the slot rather than leaking it, so that waiters
+            # do not wait for a worker which will never be released.
+            with self.lock:
+                self.stats['start_failures'] += 1
+                self.size -= 1
+                self.lock.notify_all()
+            return
+        with self.lock:
+            self.stats['restarts'] += 1
+        self._release(replacement)
+
+    def evaluate_snippet(self, name, snippet, timeout=None, **kwargs):
+        '''
+        Evaluate a jsonnet snippet in a worker. Takes the same arguments
+        as evaluate_snippet from the jsonnet module and likewise raises
+        RuntimeError when evaluation fails. timeout overrides the pool
+        timeout for this evaluation.
+        '''
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        worker = self._acquire(deadline, timeout)
+        (_, conn) = worker
+        try:
+            conn.send((name, snippet, kwargs))
+            if not conn.poll(max(0, deadline - time.monotonic())):
+                with self.lock:
+                    self.stats['timeouts'] += 1
+                self._replace(worker)
+                raise EvaluationTimeout(
+                    'Template evaluation timed out after %.1fs' % timeout)
+            (ok, result) = conn.recv()
+        except (EOFError, OSError) as exc:
+            with self.lock:
+                self.stats['crashes'] += 1
+            self._replace(worker)
+            raise RuntimeError('Template worker died, likely from exceeding its memory limit') from exc
+        self._release(worker)
+        with self.lock:
+            self.stats['evaluations'] += 1
+        if ok:
+            return result
+        raise RuntimeError(*result)
+
+    def metrics(self):
+        '''
+        Return a dict with counters, current utilization and the number
+        of evaluations waiting for a worker.
+        '''
+        with self.lock:
+            return dict(
+                self.stats,
+                size=self.size,
+                idle=len(self.idle),
+                busy=self.size - len(self.idle),
+                queued=self.queued,
+            )
+
+    def close(self):
+        '''
+        Stop all idle workers. Busy workers are stopped when their
+        evaluation completes.
+        '''
+        with self.lock:
+            idle, self.idle = self.idle, []
+            self.closed = True
+        for worker in idle:
+            self._stop(worker)
@@ -1,7 +1,26 @@
+import hashlib
 import io
 import json
+import threading
+from collections import OrderedDict
+
 import _jsonnet
 
+from striv.template_pool import EvaluatorPool
+
+# When set up with workers, jsonnet is evaluated in a pool of worker
+# processes rather than in the calling thread.
+POOL = None
+
+# Many jobs select the same dimension values, so materialized layers
+# are kept in an LRU cache keyed by their content and value parsers.
+# Layers with values from a sensitive() parser are never cached, so
+# that decrypted secrets do not linger in memory.
+LAYER_CACHE_SIZE = 1000
+_LAYER_CACHE = OrderedDict()
+_LAYER_CACHE_LOCK = threading.Lock()
+LAYER_CACHE_STATS = {'hits': 0, 'misses': 0, 'uncached': 0}
+
 
 def _collate(tree, path, value):
     if len(path) == 1:
@@ -39,14 +58,41 @@ def _find_parser(value, value_parsers):
     return parser
 
 
-def materialize_layer(name, params, value_parsers):
+def sensitive(parser):
     '''
-    Convert a params dict to a jsonnet snippet, evaluating any value
-    objects as per the provided parsers.
+    Mark a value parser whose output must not be cached, e.g. because
+    it decrypts secrets.
+    '''
+    parser.sensitive = True
+    return parser
+
+
+def setup_layer_cache(size):
     '''
+    Set the max number of cached layers. 0 disables the cache.
+    '''
+    global LAYER_CACHE_SIZE
+    with _LAYER_CACHE_LOCK:
+        LAYER_CACHE_SIZE = size
+        _LAYER_CACHE.clear()
+
+
+def layer_cache_metrics():
+    '''
+    Hit and miss counters for the cache of materialized layers.
+    '''
+    with _LAYER_CACHE_LOCK:
+        return dict(LAYER_CACHE_STATS, size=len(_LAYER_CACHE), max_size=LAYER_CACHE_SIZE)
+
+
+def _content_hash(value):
+    canonical = json.dumps(value, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def _materialize(params, parsers):
     tree = {}
-    for (key, value) in params.items():
-        parser = _find_parser(value, value_parsers)
+    for ((key, value), parser) in zip(params.items(), parsers):
         try:
             parsed = parser(value)
         except Exception as exc:
@@ -54,7 +100,36 @@ def materialize_layer(name, params, value_parsers):
         _collate(tree, key.split('.'), parsed)
     buf = io.StringIO()
     _write_jsonnet(buf, tree)
-    return (name, buf.getvalue())
+    return buf.getvalue()
+
+
+def materialize_layer(name, params, value_parsers):
+    '''
+    Convert a params dict to a jsonnet snippet, evaluating any value
+    objects as per the provided parsers.
+    '''
+    parsers = [_find_parser(value, value_parsers) for value in params.values()]
+    if any(getattr(parser, 'sensitive', False) for parser in parsers):
+        with _LAYER_CACHE_LOCK:
+            LAYER_CACHE_STATS['uncached'] += 1
+        return (name, _materialize(params, parsers))
+    # The parsers themselves are part of the key; holding on to them
+    # ensures that their ids are not reused by other parsers.
+    key = (name, _content_hash(params), frozenset(value_parsers.items()))
+    with _LAYER_CACHE_LOCK:
+        snippet = _LAYER_CACHE.get(key)
+        if snippet is not None:
+            _LAYER_CACHE.move_to_end(key)
+            LAYER_CACHE_STATS['hits'] += 1
+            return (name, snippet)
+        LAYER_CACHE_STATS['misses'] += 1
+    snippet = _materialize(params, parsers)
+    with _LAYER_CACHE_LOCK:
+        if LAYER_CACHE_SIZE > 0:
+            _LAYER_CACHE[key] = snippet
+            while len(_LAYER_CACHE) > LAYER_CACHE_SIZE:
+                _LAYER_CACHE.popitem(last=False)
+    return (name, snippet)
 
 
 class ValidationError(Exception):
@@ -66,35 +141,77 @@ class ValidationError(Exception):
         self.message = message
 
 
-def _evaluate(name, snippet):
+def setup_evaluation(workers=0, timeout=10.0, memory_limit=None):
+    '''
+    Evaluate jsonnet in a pool of worker processes, each evaluation
+    limited to timeout seconds and memory_limit bytes. With 0 workers,
+    jsonnet is evaluated inline, without limits.
+    '''
+    global POOL
+    if POOL is not None:
+        POOL.close()
+    POOL = EvaluatorPool(workers, timeout, memory_limit) if workers else None
+
+
+def evaluation_metrics():
+    '''
+    Counters and queue depth of the evaluation pool, if any.
+    '''
+    return POOL.metrics() if POOL is not None else {'size': 0}
+
+
+def _evaluate(name, snippet, **kwargs):
     try:
-        return _jsonnet.evaluate_snippet(name, snippet)
+        if POOL is not None:
+            return POOL.evaluate_snippet(name, snippet, **kwargs)
+        return _jsonnet.evaluate_snippet(name, snippet, **kwargs)
     except RuntimeError as exc:
         raise ValidationError(  # pylint: disable = raise-missing-from
             snippet, *exc.args)
 
 
-def _validate(layer, *layers):
-    name1, snippet1 = layer
-    _evaluate(name1, snippet1)
-    if len(layers) > 0:
-        name2, snippet2 = layers[0]
-        _validate((name2, '%s + %s' % (snippet1, snippet2)), *layers[1:])
+def _merge(layers):
+    return ' + '.join([snippet for (_, snippet) in layers])
+
+
+def _validate(*layers):
+    '''
+    Validate layers with a single evaluation of the merged layers and
+    return the result. Only when that fails do we bisect the layers to
+    find the first one whose merge fails, so that the error points to
+    that layer.
+    '''
+    try:
+        return _evaluate(layers[-1][0], _merge(layers))
+    except ValidationError as exc:
+        error = exc
+    lower, upper = 1, len(layers)
+    while lower < upper:
+        middle = (lower + upper) // 2
+        try:
+            _evaluate(layers[middle - 1][0], _merge(layers[:middle]))
+            lower = middle + 1
+        except ValidationError as exc:
+            upper = middle
+            error = exc
+    raise error
 
 
 def merge_layers(*layers):
     '''
-    Produce a merged and validated param snippet from a list of (name, snippet)
-    tuples. Raises ValidationError pointing to the snippet which failed
-    evaluation.
+    Merge and validate a list of (name, snippet) tuples, returning the
+    merged params as a json string. Raises ValidationError pointing to
+    the snippet which failed evaluation.
     '''
-    _validate(*layers)
-    return ' + '.join([snippet for (_, snippet) in layers])
+    return _validate(*layers)
 
 
-def evaluate(template, params_snippet):
+def evaluate(template, params_json):
     '''
-    Evaluate a template against some params. Returns a json string.
+    Evaluate a template against some params, a json string. Returns a
+    json string.
     '''
-    snippet = '(function(params) %s)(%s)' % (template, params_snippet)
-    return _evaluate('payload_template', snippet)
+    # Params are passed as a string and parsed natively by jsonnet,
+    # which is much faster than having jsonnet parse them as source.
+    snippet = 'function(params_json) local params = std.parseJson(params_json); %s' % template
+    return _evaluate('payload_template', snippet, tla_vars={'params_json': params_json})
@@ -0,0 +1,38 @@
+'''
+Benchmark merge_layers over growing numbers of layers and evaluate
+over growing params. Run with python -m test.bench_templating [repeat].
+'''
+import json
+import sys
+import timeit
+
+from striv import templating
+
+
+def _layers(count):
+    return [
+        templating.materialize_layer(
+            'layer%d' % n,
+            dict(('prip%d.prop%d' % (n, m), 'value-%d' % m) for m in range(20)),
+            {'default': lambda v: v}
+        )
+        for n in range(count)
+    ]
+
+
+def main(repeat):
+    print('%8s %12s' % ('layers', 'ms/merge'))
+    for count in (2, 4, 8, 16, 32, 64):
+        layers = _layers(count)
+        elapsed = timeit.timeit(lambda: templating.merge_layers(*layers), number=repeat)
+        print('%8d %12.2f' % (count, elapsed * 1000 / repeat))
+    print('%8s %12s' % ('keys', 'ms/evaluate'))
+    for count in (10, 100, 1000, 10000):
+        params = json.dumps({'blob': dict(('key%d' % n, list(range(20))) for n in range(count))})
+        elapsed = timeit.timeit(
+            lambda: templating.evaluate('{keys: std.length(params.blob)}', params), number=repeat)
+        print('%8d %12.2f' % (count, elapsed * 1000 / repeat))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -8,10 +8,14 @@ from hamcrest import *  # pylint: disable = unused-wildcard-import
 from striv import archivist
 from . import utils
 
-run_1 = {'status': 'running', 'created_at': '2020-10-31T23:40:02+0000'}
-run_2 = {'status': 'successful', 'created_at': '2020-10-31T23:40:01+0000'}
-run_3 = {'status': 'failed', 'created_at': '2020-10-31T23:40:00+0000'}
-run_4 = {'status': 'running', 'created_at': '2020-10-31T23:39:00+0000'}
+run_2 = {'status': 'successful', 'created_at': '2020-10-31T23:30:01+0000',
+         'finished_at': '2020-10-31T23:40:01+0000'}
+run_3 = {'status': 'failed', 'created_at': '2020-10-31T23:30:00+0000',
+         'finished_at': '2020-10-31T23:40:00+0000'}
+run_5 = {'status': 'successful', 'created_at': '2020-10-31T23:50:00+0000',
+         'finished_at': '2020-11-01T00:10:00+0000'}
+
+RUNS_QUERY = '/runs?status=successful&status=failed&finished_after='
 
 
 @pytest.fixture
@@ -20,23 +24,32 @@ def striv():
         yield mock
 
 
-class TestRunsSince:
+class TestFinishedRunsSince:
     def test_it_follows_link_headers(self, striv):
         striv.get(
-            '/runs?lower=2020-10-31T23:40:00+0000',
+            RUNS_QUERY + '2020-10-31T23:40:00%2B0000',
             headers={'Link': '</runs?page_token=ze-token>; rel="next"'},
-            json={'run-1': run_1, 'run-2': run_2}
+            json={'run-2': run_2}
         )
         striv.get(
             '/runs?page_token=ze-token',
             json={'run-3': run_3}
         )
-        assert len(list(archivist.runs_since('http://localhost',
-                                             '2020-10-31T23:40:00+0000'))) == 3
+        assert len(list(archivist.finished_runs_since(
+            'http://localhost', '2020-10-31T23:40:00+0000'))) == 2
+
+    def test_asks_for_finished_runs_only(self, striv):
+        striv.get('/runs', json={})
+        list(archivist.finished_runs_since(
+            'http://localhost', '2020-10-31T23:40:00+0000'))
+        assert_that(striv.request_history[0].qs, has_entries(
+            status=['successful', 'failed'],
+            finished_after=['2020-10-31t23:40:00+0000'],
+        ))
 
     def test_aborts_on_500(self, striv):
         striv.get('/runs', status_code=500)
-        generator = archivist.runs_since(
+        generator = archivist.finished_runs_since(
             'http://localhost', '2020-10-31T23:40:00+0000')
         assert_that(
             calling(generator.__next__),
@@ -44,102 +57,98 @@ class TestRunsSince:
         )
 
 
-class TestUniqueFinishedRuns:
-    def test_run_reported_only_when_finished(self):
-        filter = archivist.UniqueFinishedRuns()
-        assert list(filter.process([('run-1', run_1)])) == []
-        assert list(filter.process([('run-1', run_2)])) == [('run-1', run_2)]
-
-    def test_emits_finished_run_once(self):
-        filter = archivist.UniqueFinishedRuns()
-        assert list(filter.process([('run-2', run_2)])) == [('run-2', run_2)]
-        assert list(filter.process([('run-2', run_2)])) == []
-
-    def test_finished_runs_are_pruned_from_memory(self):
-        filter = archivist.UniqueFinishedRuns()
-        output = list(filter.process([('run-2', run_2), ('run-3', run_3)]))
-        assert len(output) == 2
-        filter.prune('2020-10-31T23:40:01+0000')
-        output = list(filter.process([('run-2', run_2), ('run-3', run_3)]))
-        assert output == [('run-3', run_3)]
+class TestFeedHead:
+    def test_returns_head(self, striv):
+        striv.get('/changes?since=0&types=run&limit=1',
+                  json={'changes': [], 'last_seq': 0, 'head': 17})
+        assert archivist.feed_head('http://localhost') == 17
 
+    def test_aborts_on_500(self, striv):
+        striv.get('/changes', status_code=500)
+        assert_that(
+            calling(archivist.feed_head).with_args('http://localhost'),
+            raises(RuntimeError)
+        )
 
-class TestOldestUnfinishedRun:
-    def test_forwards_input(self):
-        filter = archivist.OldestUnfinishedRun()
-        input = [('run-1', run_1), ('run-4', run_4)]
-        output = list(filter.process(input))
-        assert input == output
 
-    def test_no_oldest_when_no_input(self):
-        filter = archivist.OldestUnfinishedRun()
-        filter.process([])
-        assert filter.next_start() == None
+class TestRunChangesSince:
+    def test_it_follows_link_headers(self, striv):
+        striv.get(
+            '/changes?since=0&types=run',
+            headers={'Link': '</changes?since=1&types=run&limit=1>; rel="next"'},
+            json={'changes': [{'type': 'run', 'id': 'run-2', 'seq': 1, 'entity': run_2}],
+                  'last_seq': 1}
+        )
+        striv.get(
+            '/changes?since=1&types=run&limit=1',
+            json={'changes': [{'type': 'run', 'id': 'run-3', 'seq': 2, 'deleted': True}],
+                  'last_seq': 2}
+        )
+        assert list(archivist.run_changes_since('http://localhost', 0)) == [
+            (1, 'run-2', run_2), (2, 'run-3', None)]
 
-    def test_when_only_finished_runs_it_says_first_is_oldest(self):
-        filter = archivist.OldestUnfinishedRun()
-        list(filter.process([('run-3', run_3)]))
-        assert filter.next_start() == '2020-10-31T23:40:00+0000'
+    def test_aborts_on_500(self, striv):
+        striv.get('/changes', status_code=500)
+        generator = archivist.run_changes_since('http://localhost', 0)
+        assert_that(
+            calling(generator.__next__),
+            raises(RuntimeError)
+        )
 
-    def test_oldest_unfinished_runs(self):
-        filter = archivist.OldestUnfinishedRun()
-        list(filter.process([('run-1', run_1), ('run-4', run_4)]))
-        assert filter.next_start() == '2020-10-31T23:39:00+0000'
 
-    def test_remembers_oldest_from_previous_runs(self):
-        filter = archivist.OldestUnfinishedRun()
-        list(filter.process([('run-3', run_3)]))
-        list(filter.process([]))
-        assert filter.next_start() == '2020-10-31T23:40:00+0000'
+def _changes(*runs):
+    return {
+        'changes': [{'type': 'run', 'id': run_id, 'seq': seq, 'entity': run}
+                    for (seq, (run_id, run)) in enumerate(runs, 1)],
+        'last_seq': len(runs),
+        'head': len(runs),
+    }
 
 
 @pytest.fixture()
 def striv_with_runs(striv):
-    striv.get('/runs', json={'run-1': run_1, 'run-2': run_2, 'run-3': run_3})
+    striv.get('/runs', json={'run-2': run_2, 'run-3': run_3})
+    striv.get('/changes', json=_changes(
+        ('run-1', {'status': 'running'}), ('run-2', run_2), ('run-3', run_3), ('run-5', run_5)))
     striv.get('/run/run-2/logs', json={})
     striv.get('/run/run-3/logs', json={})
-
-
-@pytest.fixture()
-def start():
-    return '2020-10-31T23:40:00+0000'
-
-
-@pytest.fixture()
-def unique_filter():
-    return archivist.UniqueFinishedRuns()
-
-
-@pytest.fixture()
-def remember_oldest():
-    return archivist.OldestUnfinishedRun()
+    striv.get('/run/run-5/logs', json={})
 
 
 @pytest.mark.usefixtures('striv_with_runs')
 class TestRunOnce:
-    def test_requests_logs_for_done_runs(self, striv, start, unique_filter, remember_oldest):
-        archivist.run_once(start, unique_filter,
-                           remember_oldest, 'http://localhost')
+    def test_requests_logs_for_finished_runs(self, striv):
+        assert archivist.run_once(0, 'http://localhost') == 4
         assert [
-            'http://localhost/runs?lower=2020-10-31T23:40:00+0000',
+            'http://localhost/changes?since=0&types=run',
             'http://localhost/run/run-2/logs?max_size=0',
-            'http://localhost/run/run-3/logs?max_size=0'
+            'http://localhost/run/run-3/logs?max_size=0',
+            'http://localhost/run/run-5/logs?max_size=0',
         ] == [r.url for r in striv.request_history]
 
-    def test_prunes_finished_runs(self, start, unique_filter, remember_oldest):
-        archivist.run_once(start, unique_filter,
-                           remember_oldest, 'http://localhost')
-        assert len(unique_filter.seen_runs) == 0
-
-    def test_returns_new_start(self, start, unique_filter, remember_oldest):
-        new_start = archivist.run_once(start, unique_filter,
-                                       remember_oldest, 'http://localhost')
-        assert new_start == '2020-10-31T23:40:02+0000'
+    def test_skips_bootstrapped_runs(self, striv):
+        skip = archivist.bootstrap('http://localhost', '2020-10-31T23:40:00+0000')
+        assert skip == {'run-2', 'run-3'}
+        archivist.run_once(0, 'http://localhost', skip=skip)
+        assert [r.path for r in striv.request_history][-2:] == [
+            '/changes', '/run/run-5/logs']
+
+    def test_archives_run_reported_late(self, striv):
+        since = archivist.run_once(0, 'http://localhost')
+        late = dict(run_2, finished_at='2020-10-31T22:00:00+0000')
+        striv.get('/changes?since=4&types=run', json={
+            'changes': [{'type': 'run', 'id': 'run-6', 'seq': 5, 'entity': late}],
+            'last_seq': 5,
+        })
+        striv.get('/run/run-6/logs', json={})
+        assert archivist.run_once(since, 'http://localhost') == 5
+        assert striv.request_history[-1].path == '/run/run-6/logs'
 
 
 @pytest.mark.usefixtures('striv_with_runs')
 class TestRun:
     def test_running(self, striv):
+        striv.get('/changes?since=4&types=run', json={'changes': [], 'last_seq': 4, 'head': 4})
         args = utils.Args(
             max_age=10,
             worker_base_url='http://localhost',
@@ -155,4 +164,6 @@ class TestRun:
         time.sleep(0.1)
         running.pop()
         t.join(0.1)
-        assert len(striv.request_history) == 3
+        assert [r.path for r in striv.request_history] == [
+            '/changes', '/runs', '/run/run-2/logs', '/run/run-3/logs', '/changes']
+        assert striv.request_history[-1].qs['since'] == ['4']
@@ -0,0 +1,54 @@
+# pylint: disable = missing-class-docstring, missing-function-docstring, no-self-use, redefined-outer-name
+import pytest
+
+from hamcrest import *  # pylint: disable = unused-wildcard-import
+from striv.entity_loader import EntityLoader
+from striv.errors import EntityNotFound
+
+
+class RecordingStore:
+    def __init__(self, entities):
+        self.entities = entities
+        self.queries = []
+
+    def load_entities(self, *query, ignore_missing=False):
+        assert ignore_missing
+        self.queries.append(query)
+        return [self.entities.get(key) for key in query]
+
+
+@pytest.fixture()
+def store():
+    return RecordingStore({
+        ('job', 'job-1'): {'name': 'job-1'},
+        ('execution', 'nomad'): {'name': 'nomad'},
+    })
+
+
+def test_batches_primed_keys(store):
+    loader = EntityLoader(store)
+    loader.prime(('execution', 'nomad'))
+    assert loader.load(('job', 'job-1')) == [{'name': 'job-1'}]
+    assert loader.load(('execution', 'nomad')) == [{'name': 'nomad'}]
+    assert store.queries == [(('execution', 'nomad'), ('job', 'job-1'))]
+
+
+def test_memoizes_and_deduplicates(store):
+    loader = EntityLoader(store)
+    loader.load(('job', 'job-1'), ('job', 'job-1'))
+    loader.load(('job', 'job-1'))
+    assert store.queries == [(('job', 'job-1'),)]
+
+
+def test_raises_for_first_missing_key(store):
+    loader = EntityLoader(store)
+    assert_that(
+        calling(loader.load).with_args(
+            ('job', 'job-1'), ('job', 'job-2'), ('execution', 'other')),
+        raises(EntityNotFound, 'job:job-2')
+    )
+    assert_that(
+        calling(loader.load).with_args(('job', 'job-2')),
+        raises(EntityNotFound)
+    )
+    assert len(store.queries) == 1
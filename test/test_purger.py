@@ -0,0 +1,40 @@
+import pytest
+import requests_mock
+
+from hamcrest import *  # pylint: disable = unused-wildcard-import
+from striv import purger
+from . import utils
+
+
+@pytest.fixture
+def striv():
+    with requests_mock.Mocker() as mock:
+        yield mock
+
+
+@pytest.fixture
+def args():
+    return utils.Args(
+        worker_base_url='http://localhost',
+        purge_batch_size=2,
+        purge_pause=0,
+    )
+
+
+class TestPurgeOnce:
+    def test_purges_until_batch_comes_back_short(self, striv, args):
+        striv.post('/runs/purge', [
+            {'json': {'deleted': 2}},
+            {'json': {'deleted': 2}},
+            {'json': {'deleted': 1}},
+        ])
+        assert purger.purge_once(args) == 5
+        assert [r.url for r in striv.request_history] == \
+            ['http://localhost/runs/purge?batch_size=2'] * 3
+
+    def test_aborts_on_500(self, striv, args):
+        striv.post('/runs/purge', status_code=500)
+        assert_that(
+            calling(purger.purge_once).with_args(args),
+            raises(RuntimeError)
+        )
@@ -0,0 +1,95 @@
+# pylint: disable = missing-class-docstring, missing-function-docstring, no-self-use, redefined-outer-name
+import threading
+
+import pytest
+from hamcrest import *  # pylint: disable = unused-wildcard-import
+
+from striv.rdbm_pool import ConnectionPool, PoolTimeout
+
+
+class FakeConnection:
+    def __init__(self, n):
+        self.n = n
+        self.alive = True
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class Connector:
+    def __init__(self):
+        self.connections = []
+
+    def __call__(self):
+        conn = FakeConnection(len(self.connections))
+        self.connections.append(conn)
+        return conn
+
+
+@pytest.fixture()
+def connector():
+    return Connector()
+
+
+def make_pool(connector, **kwargs):
+    return ConnectionPool(connector, lambda conn: conn.alive, **kwargs)
+
+
+def test_opens_min_size_connections(connector):
+    make_pool(connector, min_size=2, max_size=3)
+    assert len(connector.connections) == 2
+
+
+def test_reuses_released_connections(connector):
+    pool = make_pool(connector, min_size=0, max_size=3)
+    with pool.checkout() as conn1:
+        pass
+    with pool.checkout() as conn2:
+        pass
+    assert conn1 is conn2
+    assert_that(pool.metrics(), has_entries({'checkouts': 2, 'created': 1}))
+
+
+def test_times_out_when_exhausted(connector):
+    pool = make_pool(connector, max_size=1, timeout=0.05)
+    with pool.checkout():
+        assert_that(
+            calling(pool.checkout().__enter__),
+            raises(PoolTimeout)
+        )
+    assert_that(pool.metrics(), has_entries({'waits': 1, 'timeouts': 1}))
+
+
+def test_waiting_thread_gets_released_connection(connector):
+    pool = make_pool(connector, max_size=1, timeout=5)
+    checked_out = []
+    with pool.checkout() as conn:
+        thread = threading.Thread(
+            target=lambda: checked_out.append(pool.checkout().__enter__()))
+        thread.start()
+        thread.join(0.05)
+        assert checked_out == []
+    thread.join(1)
+    assert checked_out == [conn]
+
+
+def test_replaces_dead_idle_connection(connector):
+    pool = make_pool(connector, max_size=1, ping_interval=0)
+    connector.connections[0].alive = False
+    with pool.checkout() as conn:
+        assert conn.n == 1
+    assert connector.connections[0].closed
+    assert_that(pool.metrics(), has_entries({'size': 1, 'discarded': 1}))
+
+
+def test_discards_connection_broken_during_use(connector):
+    pool = make_pool(connector, max_size=1)
+
+    def break_connection():
+        with pool.checkout() as conn:
+            conn.alive = False
+            raise RuntimeError('connection lost')
+    assert_that(calling(break_connection), raises(RuntimeError))
+    with pool.checkout() as conn:
+        assert conn.n == 1
@@ -1,4 +1,7 @@
 # pylint: disable = missing-class-docstring, missing-function-docstring, no-self-use, redefined-outer-name
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
 import pytest
 
 from hamcrest import *  # pylint: disable = unused-wildcard-import
@@ -14,18 +17,24 @@ def store(request):
     rdbm_store.setup(
         driver,
         connargs,
-        relations={
-            'run': lambda run: [('job', run['job_id'])],
-            'job': lambda job: [('dvalue', '%s:%s' % (n, v)) for (n, v) in job.get('dimensions', {}).items()]
+        indexes={
+            'dvalue': ('job', lambda job: ['%s:%s' % (n, v) for (n, v) in job.get('dimensions', {}).items()]),
         },
         sortkeys={
             'job': lambda job: job['name'],
-        }
+        },
+        background_backfill=False
     )
     yield rdbm_store
-    # TODO: Teach replace_type about relations
-    rdbm_store.CONN.cursor().execute('DELETE FROM entities')
-    rdbm_store.CONN.cursor().execute('DELETE FROM relations')
+    with rdbm_store.connection() as conn:
+        conn.cursor().execute('DELETE FROM entities')
+        conn.cursor().execute('DELETE FROM relations')
+        conn.cursor().execute('DELETE FROM runs')
+        conn.cursor().execute('DELETE FROM run_summaries')
+        conn.cursor().execute('DELETE FROM tombstones')
+        conn.cursor().execute('DELETE FROM sequences')
+        conn.cursor().execute('DELETE FROM index_state')
+        conn.cursor().execute('DELETE FROM generations')
 
 
 @pytest.fixture()
@@ -72,6 +81,12 @@ class TestLoadEntities:
             raises(EntityNotFound, pattern='job:job-10')
         )
 
+    def test_ignore_missing(self, store):
+        entities = store.load_entities(
+            ('job', 'job-01'), ('job', 'job-99'), ignore_missing=True)
+        assert_that(entities, contains_exactly(
+            has_entry('name', 'job-01'), none()))
+
 
 @pytest.mark.usefixtures('five_jobs')
 class TestFindEntities:
@@ -134,6 +149,24 @@ class TestFindEntities:
         )
         assert found.keys() == {'job-01', 'job-02', 'job-03'}
 
+    def test_continues_after_position(self, store):
+        found = store.find_entities(
+            'job',
+            range=('asc', None, None),
+            after=('job-02', 'job-02'),
+            limit=2
+        )
+        assert list(found.keys()) == ['job-03', 'job-04']
+
+    def test_breaks_sortkey_ties_on_id(self, store):
+        store.upsert_entities(('job', 'job-00', {'name': 'job-02'}))
+        found = store.find_entities(
+            'job',
+            range=('desc', None, None),
+            after=('job-02', 'job-02'),
+        )
+        assert list(found.keys()) == ['job-00', 'job-01']
+
     def test_arbitrary_chars_in_range(self, store):
         found = store.find_entities('job', range=('desc', None, ';'))
         assert list(found) == []
@@ -141,6 +174,38 @@ class TestFindEntities:
         assert list(found) == []
 
 
+@pytest.mark.usefixtures('five_jobs')
+class TestFilters:
+    def test_filters_on_extracted_field(self, store):
+        store.upsert_entities(
+            ('job', 'job-06', {'name': 'job-06', 'execution': 'other'}))
+        found = store.find_entities('job', where={'execution': 'other'})
+        assert found.keys() == {'job-06'}
+
+    def test_filters_on_set_of_values(self, store):
+        found = store.find_entities(
+            'job', where={'name': ['job-01', 'job-04']})
+        assert found.keys() == {'job-01', 'job-04'}
+        assert store.find_entities('job', where={'name': []}) == {}
+
+    def test_combines_with_index_and_range(self, store):
+        found = store.find_entities(
+            'job',
+            related_to=('dvalue', 'shared:value-1'),
+            where={'name': ['job-01', 'job-03', 'job-04']},
+            range=('desc', None, None),
+            limit=1
+        )
+        assert list(found) == ['job-03']
+
+    def test_fails_on_unknown_field(self, store):
+        assert_that(
+            calling(store.find_entities).with_args(
+                'job', where={'dimensions': 'x'}),
+            raises(RuntimeError)
+        )
+
+
 @pytest.mark.usefixtures('five_jobs')
 def test_upsert_entities_updates_sortkey(store):
     store.upsert_entities(('job', 'job-01', {'name': 'job-00'}))
@@ -148,6 +213,197 @@ def test_upsert_entities_updates_sortkey(store):
     assert found.keys() == {'job-01'}
 
 
+@pytest.mark.usefixtures('five_jobs')
+class TestUpsertEntities:
+    def test_counts_inserted_updated_and_unchanged(self, store):
+        counts = store.upsert_entities(
+            ('job', 'job-01', {'name': 'job-01', 'dimensions': {
+                'unique': 'value-1', 'shared': 'value-1'}}),
+            ('job', 'job-02', {'name': 'job-02b'}),
+            ('job', 'job-10', {'name': 'job-10'}),
+        )
+        assert counts == {'inserted': 1, 'updated': 1, 'unchanged': 1}
+
+    def test_skips_unchanged_runs(self, store):
+        run = {'job_id': 'job-01', 'created_at': '2020-10-31T23:40:01+0000'}
+        assert store.upsert_entities(('run', 'run-1', run))['inserted'] == 1
+        assert store.upsert_entities(('run', 'run-1', run))['unchanged'] == 1
+        run = dict(run, status='running')
+        assert store.upsert_entities(('run', 'run-1', run))['updated'] == 1
+        assert store.load_entities(('run', 'run-1'))[0]['status'] == 'running'
+
+    def test_updates_relations_of_changed_entities(self, store):
+        store.upsert_entities(('job', 'job-01', {'name': 'job-01'}))
+        found = store.find_entities(
+            'job', related_to=('dvalue', 'unique:value-1'))
+        assert list(found) == []
+
+    def test_keeps_unchanged_relations(self, store):
+        store.upsert_entities(('job', 'job-01', {'name': 'job-01', 'dimensions': {
+            'shared': 'value-1', 'unique': 'value-01'}}))
+        with store.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT relation, secondary_key FROM relations WHERE typed_id = 'job:job-01'")
+            assert sorted(cur.fetchall()) == [
+                ('dvalue', 'shared:value-1'),
+                ('dvalue', 'unique:value-01'),
+            ]
+
+
+@pytest.mark.usefixtures('five_jobs')
+class TestIndexes:
+    def test_backfilled_index_is_ready(self, store):
+        assert store.index_states() == {'dvalue': 'ready'}
+
+    def test_limited_scan_leaves_connection_usable(self, store):
+        with store.connection() as conn:
+            conn.cursor().execute("UPDATE index_state SET state = 'building'")
+            store.READY_INDEXES.clear()
+            found = store.find_entities(
+                'job', related_to=('dvalue', 'shared:value-1'), limit=1,
+                range=('asc', None, None))
+            assert list(found) == ['job-01']
+            cur = conn.cursor()
+            cur.execute('SELECT COUNT(*) FROM entities')
+            assert cur.fetchall() == [(5,)]
+
+    def test_building_index_falls_back_to_scan(self, store):
+        with store.connection() as conn:
+            conn.cursor().execute("UPDATE index_state SET state = 'building'")
+            conn.cursor().execute('DELETE FROM relations')
+        store.READY_INDEXES.clear()
+        assert store.index_states() == {'dvalue': 'building'}
+        found = store.find_entities(
+            'job', related_to=('dvalue', 'shared:value-1'), limit=2,
+            range=('asc', None, None))
+        assert list(found) == ['job-01', 'job-03']
+        store.backfill_indexes(batch_size=2)
+        assert store.index_states() == {'dvalue': 'ready'}
+        with store.connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT COUNT(*) FROM relations')
+            assert cur.fetchall() == [(10,)]
+        found = store.find_entities(
+            'job', related_to=('dvalue', 'shared:value-1'))
+        assert found.keys() == {'job-01', 'job-03', 'job-05'}
+
+    def test_fails_on_unknown_index(self, store):
+        assert_that(
+            calling(store.find_entities).with_args(
+                'job', related_to=('nonesuch', 'value')),
+            raises(RuntimeError)
+        )
+
+
+def test_drops_undeclared_index(tmp_path):
+    connargs = {'database': str(tmp_path / 'striv.db')}
+    rdbm_store.setup('sqlite', connargs, indexes={
+        'name': ('job', lambda job: [job['name']]),
+    }, background_backfill=False)
+    rdbm_store.upsert_entities(('job', 'job-01', {'name': 'job-01'}))
+    rdbm_store.setup('sqlite', connargs, background_backfill=False)
+    assert rdbm_store.index_states() == {}
+    with rdbm_store.connection() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT COUNT(*) FROM relations')
+        assert cur.fetchall() == [(0,)]
+
+
+class TestCache:
+    @pytest.fixture(autouse=True)
+    def executions(self, store):
+        store.upsert_entities(('execution', 'nomad', {'name': 'nomad'}))
+
+    def test_serves_config_types_from_cache(self, store):
+        misses = store.CACHE_STATS['misses']
+        store.load_entities(('execution', 'nomad'))
+        hits = store.CACHE_STATS['hits']
+        assert store.find_entities('execution') == {'nomad': {'name': 'nomad'}}
+        assert store.CACHE_STATS['hits'] == hits + 1
+        assert store.CACHE_STATS['misses'] == misses + 1
+
+    def test_returns_copies(self, store):
+        store.load_entities(('execution', 'nomad'))[0]['name'] = 'changed'
+        assert store.load_entities(('execution', 'nomad'))[0]['name'] == 'nomad'
+
+    def test_reloads_on_generation_change(self, store):
+        store.load_entities(('execution', 'nomad'))
+        with store.connection() as conn:
+            conn.cursor().execute(
+                "UPDATE entities SET entity = '{\"name\": \"other\"}' WHERE typed_id = 'execution:nomad'")
+            assert store.load_entities(('execution', 'nomad'))[0]['name'] == 'nomad'
+        with store.connection() as conn:
+            conn.cursor().execute(
+                "UPDATE generations SET generation = generation + 1 WHERE type = 'execution'")
+        assert store.load_entities(('execution', 'nomad'))[0]['name'] == 'other'
+
+    def test_replace_type_invalidates(self, store):
+        store.find_entities('execution')
+        store.replace_type('execution', {'other': {'name': 'other'}})
+        assert store.find_entities('execution').keys() == {'other'}
+        assert_that(
+            calling(store.load_entities).with_args(('execution', 'nomad')),
+            raises(EntityNotFound)
+        )
+
+@pytest.mark.usefixtures('five_jobs')
+class TestReplaceType:
+    def test_replaces_relations(self, store):
+        store.replace_type('job', {'job-06': {
+            'name': 'job-06',
+            'dimensions': {'shared': 'value-0'},
+        }})
+        found = store.find_entities(
+            'job', related_to=('dvalue', 'shared:value-0'))
+        assert found.keys() == {'job-06'}
+        found = store.find_entities(
+            'job', related_to=('dvalue', 'unique:value-1'))
+        assert found == {}
+
+    def test_sets_sortkey(self, store):
+        store.replace_type('job', {'job-06': {'name': 'job-06'}})
+        found = store.find_entities('job', range=('asc', 'job-05', None))
+        assert found.keys() == {'job-06'}
+
+
+
+class TestTransaction:
+    def test_commits_on_success(self, store):
+        with store.transaction():
+            store.upsert_entities(('job', 'job-01', {'name': 'job-01'}))
+            store.upsert_entities(('job', 'job-02', {'name': 'job-02'}))
+        assert store.find_entities('job').keys() == {'job-01', 'job-02'}
+
+    def test_rolls_back_on_error(self, store):
+        def failing_batch():
+            with store.transaction():
+                store.upsert_entities(('job', 'job-01', {'name': 'job-01'}))
+                raise RuntimeError('boom')
+        assert_that(calling(failing_batch), raises(RuntimeError))
+        assert store.find_entities('job') == {}
+
+    def test_nested_transaction_joins_outer(self, store):
+        def failing_batch():
+            with store.transaction():
+                with store.transaction():
+                    store.upsert_entities(
+                        ('job', 'job-01', {'name': 'job-01'}))
+                raise RuntimeError('boom')
+        assert_that(calling(failing_batch), raises(RuntimeError))
+        assert store.find_entities('job') == {}
+
+    def test_writes_large_batches(self, store):
+        runs = [('run', 'run-%d' % n, {
+            'job_id': 'job-01',
+            'created_at': '2020-10-31T23:40:00+0000',
+        }) for n in range(2500)]
+        assert store.upsert_entities(*runs)['inserted'] == 2500
+        assert store.upsert_entities(*runs)['unchanged'] == 2500
+        store.delete_entities(*[(typ, eid) for (typ, eid, _) in runs])
+        assert store.find_entities('run') == {}
+
+
 @pytest.mark.usefixtures('five_jobs')
 class TestDeleteEntities:
     def test_delete_job(self, store):
@@ -160,3 +416,546 @@ class TestDeleteEntities:
             .with_args(('job', 'job-99')),
             raises(EntityNotFound)
         )
+
+
+def test_migrates_entities_without_type_column(tmp_path):
+    path = str(tmp_path / 'legacy.db')
+    conn = sqlite3.connect(path)
+    conn.execute(
+        'CREATE TABLE entities (typed_id TEXT PRIMARY KEY, sortkey TEXT, entity TEXT)')
+    conn.executemany('INSERT INTO entities VALUES (?, ?, ?)', [
+        ('job:job-01', 'job-01', '{"name": "job-01"}'),
+        ('execution:nomad', None, '{"name": "nomad"}'),
+    ])
+    conn.commit()
+    conn.close()
+    rdbm_store.setup('sqlite', {'database': path})
+    assert rdbm_store.find_entities('job') == {'job-01': {'name': 'job-01'}}
+    assert rdbm_store.find_entities('execution').keys() == {'nomad'}
+    found = rdbm_store.find_entities('execution', where={'name': 'nomad'})
+    assert found.keys() == {'nomad'}
+
+
+def test_migration_removes_duplicate_relations(tmp_path):
+    path = str(tmp_path / 'legacy.db')
+    conn = sqlite3.connect(path)
+    conn.execute(
+        'CREATE TABLE relations (typed_id TEXT, relation TEXT, secondary_key TEXT)')
+    conn.executemany('INSERT INTO relations VALUES (?, ?, ?)', [
+        ('job:job-01', 'dvalue', 'env:prod'),
+        ('job:job-01', 'dvalue', 'env:prod'),
+    ])
+    conn.commit()
+    conn.close()
+    rdbm_store.setup('sqlite', {'database': path})
+    with rdbm_store.connection() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT COUNT(*) FROM relations')
+        assert cur.fetchall() == [(1,)]
+        assert_that(
+            calling(cur.execute).with_args(
+                "INSERT INTO relations VALUES ('job:job-01', 'dvalue', 'env:prod')"),
+            raises(sqlite3.IntegrityError)
+        )
+
+
+@pytest.fixture()
+def three_runs(store):
+    store.upsert_entities(
+        *[(
+            'run',
+            'run-%d' % n,
+            {
+                'job_id': 'job-%02d' % (n % 2),
+                'execution': 'nomad',
+                'status': 'successful',
+                'created_at': '2020-10-31T23:40:0%d+0000' % n,
+                'started_at': '2020-10-31T23:41:0%d+0000' % n,
+                'finished_at': '2020-10-31T23:42:0%d+0000' % n,
+            }
+        ) for n in range(1, 4)]
+    )
+
+
+@pytest.mark.usefixtures('three_runs')
+class TestRuns:
+    def test_roundtrip(self, store):
+        assert store.load_entities(('run', 'run-1')) == [{
+            'job_id': 'job-01',
+            'execution': 'nomad',
+            'status': 'successful',
+            'created_at': '2020-10-31T23:40:01+0000',
+            'started_at': '2020-10-31T23:41:01+0000',
+            'finished_at': '2020-10-31T23:42:01+0000',
+        }]
+
+    def test_omits_missing_properties(self, store):
+        store.upsert_entities(('run', 'run-4', {
+            'job_id': 'job-01',
+            'created_at': '2020-10-31T23:40:04+0000',
+        }))
+        assert store.load_entities(('run', 'run-4')) == [{
+            'job_id': 'job-01',
+            'created_at': '2020-10-31T23:40:04+0000',
+        }]
+
+    def test_stores_epoch_nanoseconds(self, store):
+        with store.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT created_at FROM runs WHERE run_id = 'run-1'")
+            assert cur.fetchall() == [(1604187601000000000,)]
+
+    def test_loads_mixed_types_in_order(self, store, five_jobs):
+        entities = store.load_entities(('run', 'run-2'), ('job', 'job-01'))
+        assert_that(entities, contains_exactly(
+            has_entry('job_id', 'job-00'),
+            has_entry('name', 'job-01'),
+        ))
+
+    def test_find_related_to_job(self, store):
+        found = store.find_entities('run', related_to=('job', 'job-01'))
+        assert found.keys() == {'run-1', 'run-3'}
+
+    def test_streams_page_and_last_key(self, store):
+        with store.connection():
+            runs, last = store.stream_entities(
+                'run', range=('desc', None, None), limit=2)
+            assert [run_id for (run_id, _) in runs] == ['run-3', 'run-2']
+            assert last == ('2020-10-31T23:40:02+0000', 'run-2')
+            runs, last = store.stream_entities(
+                'run', range=('desc', None, None), after=last, limit=2)
+            assert_that(list(runs), contains_exactly(
+                contains_exactly('run-1', has_entry('job_id', 'job-01'))))
+            assert last is None
+
+    def test_streams_projected_fields(self, store, five_jobs):
+        with store.connection():
+            jobs, _ = store.stream_entities(
+                'job', fields={'dimensions', 'nonesuch'}, where={'name': 'job-01'})
+            assert list(jobs) == [('job-01', {'dimensions': {
+                'shared': 'value-1', 'unique': 'value-1'}})]
+            runs, _ = store.stream_entities(
+                'run', related_to=('job', 'job-01'), fields={'status'})
+            assert dict(runs) == {
+                'run-1': {'status': 'successful'},
+                'run-3': {'status': 'successful'},
+            }
+
+    def test_closing_stream_releases_cursor(self, store, five_jobs):
+        with store.connection():
+            jobs, _ = store.stream_entities('job')
+            assert next(jobs)[0] == 'job-01'
+            jobs.close()
+            assert len(store.find_entities('job')) == 5
+
+    def test_streams_inside_and_outside_transactions(self, store, five_jobs):
+        with store.connection():
+            with store.transaction():
+                jobs, _ = store.stream_entities('job')
+                assert len(list(jobs)) == 5
+                store.upsert_entities(('job', 'job-06', {'name': 'job-06'}))
+            jobs, _ = store.stream_entities('job')
+            assert next(jobs)[0] == 'job-01'
+            jobs.close()
+            store.delete_entities(('job', 'job-06'))
+        assert len(store.find_entities('job')) == 5
+
+    def test_find_by_status(self, store):
+        store.upsert_entities(('run', 'run-4', {
+            'job_id': 'job-01',
+            'status': 'failed',
+            'created_at': '2020-10-31T23:40:04+0000',
+        }))
+        found = store.find_entities(
+            'run', related_to=('job', 'job-01'), where={'status': ['failed', 'running']})
+        assert found.keys() == {'run-4'}
+
+    def test_find_finished_after(self, store):
+        found = store.find_entities(
+            'run', finished_after='2020-10-31T23:42:01+0000')
+        assert found.keys() == {'run-2', 'run-3'}
+        with store.connection():
+            runs, _ = store.stream_entities(
+                'run',
+                related_to=('job', 'job-01'),
+                where={'status': 'successful'},
+                finished_after='2020-10-31T23:42:01+0000'
+            )
+            assert [run_id for (run_id, _) in runs] == ['run-3']
+
+    def test_find_range_and_limit(self, store):
+        found = store.find_entities(
+            'run',
+            range=('desc', '2020-10-31T23:40:01+0000', None),
+            limit=2
+        )
+        assert list(found.keys()) == ['run-3', 'run-2']
+
+    def test_continues_after_position(self, store):
+        store.upsert_entities(('run', 'run-0', {
+            'job_id': 'job-00',
+            'created_at': '2020-10-31T23:40:02+0000',
+        }))
+        found = store.find_entities(
+            'run',
+            range=('desc', None, None),
+            after=('2020-10-31T23:40:02+0000', 'run-2')
+        )
+        assert list(found.keys()) == ['run-0', 'run-1']
+
+    def test_accepts_iso_timestamps_with_fractions(self, store):
+        found = store.find_entities(
+            'run',
+            range=('desc', None, '2020-10-31T23:40:02.000Z')
+        )
+        assert list(found.keys()) == ['run-2', 'run-1']
+
+    def test_delete_run(self, store):
+        store.delete_entities(('run', 'run-1'))
+        assert store.find_entities('run').keys() == {'run-2', 'run-3'}
+
+
+@pytest.mark.usefixtures('three_runs')
+class TestRunStats:
+    @pytest.fixture(autouse=True)
+    def more_runs(self, store):
+        store.upsert_entities(
+            ('run', 'run-4', {
+                'job_id': 'job-01',
+                'status': 'failed',
+                'created_at': '2020-10-31T23:40:04+0000',
+                'started_at': '2020-10-31T23:40:04+0000',
+                'finished_at': '2020-10-31T23:40:14+0000',
+            }),
+            ('run', 'run-5', {
+                'job_id': 'job-01',
+                'status': 'running',
+                'created_at': '2020-11-01T00:00:05+0000',
+            }),
+        )
+
+    def test_aggregates_all_runs(self, store):
+        assert store.run_stats(percentiles=[0, 50, 100]) == [{
+            'count': 5,
+            'successful': 3,
+            'failed': 1,
+            'duration': {'mean': 47.5, 'p0': 10.0, 'p50': 60.0, 'p100': 60.0},
+        }]
+
+    def test_groups_by_job_and_status(self, store):
+        stats = store.run_stats(group_by=['job', 'status'], percentiles=[50])
+        assert_that(stats, contains_exactly(
+            has_entries(job_id='job-00', status='successful', count=1),
+            has_entries(job_id='job-01', status='failed', count=1,
+                        duration={'mean': 10.0, 'p50': 10.0}),
+            has_entries(job_id='job-01', status='running', count=1,
+                        duration={'mean': None, 'p50': None}),
+            has_entries(job_id='job-01', status='successful', count=2),
+        ))
+
+    def test_groups_by_time_bucket(self, store):
+        stats = store.run_stats(bucket=3600, where={'status': ['failed', 'running']})
+        assert_that(stats, contains_exactly(
+            has_entries(bucket='2020-10-31T23:00:00+0000', count=1, failed=1),
+            has_entries(bucket='2020-11-01T00:00:00+0000', count=1, failed=0),
+        ))
+
+    def test_selects_runs(self, store):
+        stats = store.run_stats(
+            related_to=('job', 'job-01'),
+            range=('asc', '2020-10-31T23:40:02+0000', None)
+        )
+        assert_that(stats, contains_exactly(has_entries(count=3)))
+
+
+class TestPurgeRuns:
+    @pytest.fixture(autouse=True)
+    def archived(self, store, three_runs):
+        store.mark_runs_archived('run-1', 'run-2', 'run-3')
+
+    def test_purges_runs_older_than_max_age(self, store):
+        deleted = store.purge_runs(
+            {}, default={'max_age_days': 1}, now=datetime(2020, 11, 2, tzinfo=timezone.utc))
+        assert deleted == 3
+        assert store.find_entities('run') == {}
+
+    def test_keeps_newest_runs_per_job(self, store):
+        store.upsert_entities(('run', 'run-4', {
+            'job_id': 'job-01',
+            'status': 'successful',
+            'created_at': '2020-10-31T23:40:04+0000',
+        }))
+        assert store.purge_runs({}, default={'max_runs_per_job': 1}) == 2
+        assert store.find_entities('run').keys() == {'run-2', 'run-4'}
+
+    def test_execution_policy_overrides_default(self, store):
+        store.upsert_entities(('run', 'run-4', {
+            'job_id': 'job-01',
+            'execution': 'other',
+            'status': 'successful',
+            'created_at': '2020-10-31T23:40:04+0000',
+        }))
+        store.mark_runs_archived('run-4')
+        deleted = store.purge_runs(
+            {'nomad': {}},
+            default={'max_age_days': 1},
+            now=datetime(2020, 11, 2, tzinfo=timezone.utc)
+        )
+        assert deleted == 1
+        assert store.find_entities('run').keys() == {'run-1', 'run-2', 'run-3'}
+
+    def test_only_purges_archived_runs(self, store):
+        with store.connection() as conn:
+            conn.cursor().execute(
+                "UPDATE runs SET archived_at = NULL WHERE run_id = 'run-1'")
+        assert store.purge_runs({}, default={'max_runs_per_job': 1}) == 0
+        assert store.purge_runs(
+            {}, default={'max_runs_per_job': 1}, archived_only=False) == 1
+
+    def test_purged_runs_are_tombstoned(self, store):
+        since = store.change_head()
+        store.purge_runs(
+            {}, default={'max_age_days': 1}, now=datetime(2020, 11, 2, tzinfo=timezone.utc))
+        assert_that(store.changes(since), contains_inanyorder(*[
+            contains_exactly(greater_than(since), 'run', run_id, None)
+            for run_id in ('run-1', 'run-2', 'run-3')
+        ]))
+
+    def test_purges_in_batches(self, store):
+        policy = {'max_age_days': 1}
+        now = datetime(2020, 11, 2, tzinfo=timezone.utc)
+        assert store.purge_runs({}, default=policy, batch_size=2, now=now) == 2
+        assert store.purge_runs({}, default=policy, batch_size=2, now=now) == 1
+        assert store.purge_runs({}, default=policy, batch_size=2, now=now) == 0
+
+
+class TestChanges:
+    def test_lists_changes_in_sequence_order(self, store):
+        store.upsert_entities(('job', 'job-1', {'name': 'a'}))
+        store.upsert_entities(('run', 'run-1', {'job_id': 'job-1', 'status': 'pending'}))
+        store.upsert_entities(('job', 'job-2', {'name': 'b'}))
+        changes = store.changes(0)
+        assert_that([(typ, eid) for (_, typ, eid, _) in changes], contains_exactly(
+            ('job', 'job-1'), ('run', 'run-1'), ('job', 'job-2')))
+        assert_that([seq for (seq, _, _, _) in changes], contains_exactly(1, 2, 3))
+        assert changes[1][3]['status'] == 'pending'
+
+    def test_lists_only_changes_after_since(self, store):
+        store.upsert_entities(('job', 'job-1', {'name': 'a'}), ('job', 'job-2', {'name': 'b'}))
+        since = store.changes(0)[-1][0]
+        store.upsert_entities(('job', 'job-1', {'name': 'c'}), ('job', 'job-2', {'name': 'b'}))
+        assert_that(store.changes(since), contains_exactly(
+            (since + 1, 'job', 'job-1', {'name': 'c'})))
+
+    def test_lists_deletions_as_tombstones(self, store):
+        store.upsert_entities(('job', 'job-1', {'name': 'a'}))
+        store.delete_entities(('job', 'job-1'))
+        assert_that(store.changes(0), contains_exactly((2, 'job', 'job-1', None)))
+        store.upsert_entities(('job', 'job-1', {'name': 'a'}))
+        assert_that(store.changes(0), contains_exactly((3, 'job', 'job-1', {'name': 'a'})))
+
+    def test_replace_type_tombstones_removed_entities(self, store):
+        store.upsert_entities(('dimension', 'd1', {}), ('dimension', 'd2', {}))
+        store.replace_type('dimension', {'d2': {'x': 1}})
+        assert_that(store.changes(2), contains_inanyorder(
+            (3, 'dimension', 'd2', {'x': 1}), (4, 'dimension', 'd1', None)))
+
+    def test_head_is_latest_sequence_number(self, store):
+        assert store.change_head() == 0
+        store.upsert_entities(('job', 'job-1', {'name': 'a'}), ('job', 'job-2', {'name': 'b'}))
+        head = store.change_head()
+        assert head == 2
+        store.upsert_entities(('job', 'job-3', {'name': 'c'}))
+        assert_that(store.changes(head), contains_exactly(
+            (head + 1, 'job', 'job-3', {'name': 'c'})))
+
+    def test_filters_by_type_and_limits(self, store):
+        store.upsert_entities(
+            ('job', 'job-1', {'name': 'a'}),
+            ('job', 'job-2', {'name': 'b'}),
+            ('run', 'run-1', {'job_id': 'job-1'}),
+        )
+        assert_that(store.changes(0, types=['run']), has_length(1))
+        assert_that(store.changes(0, types=['job'], limit=1), has_length(1))
+        assert_that(store.changes(0, limit=2), has_length(2))
+
+
+NOW = datetime.now(timezone.utc)
+
+
+def _ago(**delta):
+    return (NOW - timedelta(**delta)).strftime('%Y-%m-%dT%H:%M:%S%z')
+
+
+@pytest.mark.usefixtures('five_jobs')
+class TestRunSummaries:
+    @pytest.fixture(autouse=True)
+    def runs(self, store):
+        store.upsert_entities(*[
+            ('run', run_id, {
+                'job_id': 'job-01',
+                'status': status,
+                'created_at': _ago(hours=hours + 1),
+                'finished_at': _ago(hours=hours),
+            }) for (run_id, status, hours) in [
+                ('run-1', 'failed', 48),
+                ('run-2', 'successful', 30),
+                ('run-3', 'successful', 2),
+                ('run-4', 'running', 0),
+            ]
+        ])
+
+    def summary(self, store, job_id='job-01'):
+        with store.connection():
+            jobs, _ = store.stream_entities(
+                'job', where={'name': job_id}, with_run_summary=True)
+            return dict(jobs)[job_id]['run_summary']
+
+    def test_summarizes_runs_of_job(self, store):
+        assert_that(self.summary(store), has_entries({
+            'last_run_id': 'run-4',
+            'last_status': 'running',
+            'last_successful_at': _ago(hours=2),
+            'last_failed_at': _ago(hours=48),
+            'successful_24h': 1,
+            'failed_24h': 0,
+            'successful_7d': 2,
+            'failed_7d': 1,
+        }))
+
+    def test_job_without_runs_has_no_summary(self, store):
+        assert self.summary(store, 'job-02') is None
+
+    def test_follows_updated_runs(self, store):
+        store.upsert_entities(('run', 'run-4', {
+            'job_id': 'job-01',
+            'status': 'failed',
+            'created_at': _ago(hours=1),
+            'finished_at': _ago(hours=0),
+        }))
+        assert_that(self.summary(store), has_entries(
+            last_status='failed', failed_24h=1))
+
+    def test_keeps_last_finish_times_outside_windows(self, store):
+        later = NOW + timedelta(days=30)
+        store.refresh_run_summaries(now=later)
+        assert_that(self.summary(store), has_entries({
+            'last_run_id': 'run-4',
+            'last_successful_at': _ago(hours=2),
+            'last_failed_at': _ago(hours=48),
+            'successful_7d': 0,
+            'failed_7d': 0,
+        }))
+
+    def test_refresh_recomputes_expired_windows(self, store):
+        assert store.refresh_run_summaries() == 0
+        later = NOW + timedelta(hours=23)
+        assert store.refresh_run_summaries(now=later) == 1
+        assert_that(self.summary(store), has_entries(
+            successful_24h=0, successful_7d=2))
+
+    def test_follows_deleted_runs(self, store):
+        store.delete_entities(('run', 'run-3'), ('run', 'run-4'))
+        assert_that(self.summary(store), has_entries(
+            last_run_id='run-2', successful_7d=1))
+        store.delete_entities(('job', 'job-01'))
+        with store.connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT job_key FROM run_summaries')
+            assert cur.fetchall() == []
+
+    def test_summary_while_index_builds(self, store):
+        with store.connection() as conn:
+            conn.cursor().execute("UPDATE index_state SET state = 'building'")
+            store.READY_INDEXES.clear()
+            jobs, _ = store.stream_entities(
+                'job', related_to=('dvalue', 'unique:value-1'), with_run_summary=True)
+            assert_that(dict(jobs)['job-01']['run_summary'],
+                        has_entries(last_run_id='run-4'))
+
+
+@pytest.fixture(params=[c for c in rdbm_support.configurations if c[0] != 'sqlite'])
+def partitioned_config(request):
+    yield request.param
+    with rdbm_store.connection() as conn:
+        conn.cursor().execute('DROP TABLE runs')
+        conn.cursor().execute('DELETE FROM run_summaries')
+        conn.cursor().execute('DELETE FROM tombstones')
+        conn.cursor().execute('DELETE FROM sequences')
+        conn.cursor().execute('DELETE FROM index_state')
+        conn.cursor().execute('DELETE FROM generations')
+    rdbm_store.RUN_PARTITION_MONTHS = 0
+
+
+class TestRunPartitions:
+    def test_bounds_are_aligned_to_period(self):
+        bounds = rdbm_store._partition_bounds(
+            datetime(2020, 11, 15, tzinfo=timezone.utc),
+            datetime(2021, 2, 1, tzinfo=timezone.utc),
+            3
+        )
+        assert [name for (name, _, _) in bounds] == ['runs_p202010', 'runs_p202101']
+        assert bounds[0][2] == bounds[1][1] == 1609459200000000000
+
+    def test_sqlite_cannot_partition(self):
+        assert_that(
+            calling(rdbm_store.setup).with_args(
+                'sqlite', {'database': ':memory:'}, run_partition_months=1),
+            raises(RuntimeError)
+        )
+
+    def test_unpartitioned_store_ignores_partition_maintenance(self, store):
+        store.ensure_run_partitions()
+
+    def test_creates_partitions_ahead(self, partitioned_config):
+        rdbm_store.setup(*partitioned_config, background_backfill=False, run_partition_months=1)
+        with rdbm_store.connection() as conn:
+            names = [name for (name, _, _) in rdbm_store.ADAPTER.run_partitions(conn)]
+        later = NOW.replace(day=1) + timedelta(days=32 * 3)
+        assert 'runs_p%04d%02d' % (later.year, later.month) in names
+
+    def test_converts_runs_and_drops_expired_partitions(self, partitioned_config):
+        rdbm_store.setup(*partitioned_config, background_backfill=False)
+        rdbm_store.upsert_entities(*[
+            ('run', 'run-%d' % days, {
+                'job_id': 'job-01',
+                'status': 'successful',
+                'created_at': _ago(days=days),
+            }) for days in (0, 200)
+        ])
+        rdbm_store.setup(*partitioned_config, background_backfill=False, run_partition_months=1)
+        old = datetime.strptime(_ago(days=200), '%Y-%m-%dT%H:%M:%S%z')
+        with rdbm_store.connection() as conn:
+            names = [name for (name, _, _) in rdbm_store.ADAPTER.run_partitions(conn)]
+        assert 'runs_p%04d%02d' % (old.year, old.month) in names
+        assert rdbm_store.purge_runs(
+            {}, default={'max_age_days': 100}, archived_only=False) == 1
+        with rdbm_store.connection() as conn:
+            names = [name for (name, _, _) in rdbm_store.ADAPTER.run_partitions(conn)]
+        assert 'runs_p%04d%02d' % (old.year, old.month) not in names
+        assert rdbm_store.find_entities('run').keys() == {'run-0'}
+        assert_that(rdbm_store.changes(0, types=['run']), has_item(
+            contains_exactly(anything(), 'run', 'run-200', None)))
+
+
+def test_migrates_runs_out_of_entities(tmp_path):
+    path = str(tmp_path / 'legacy.db')
+    conn = sqlite3.connect(path)
+    conn.execute(
+        'CREATE TABLE entities (typed_id TEXT PRIMARY KEY, sortkey TEXT, entity TEXT)')
+    conn.execute('INSERT INTO entities VALUES (?, ?, ?)', (
+        'run:run-1',
+        '2020-10-31T23:40:01+0000',
+        '{"job_id": "job-01", "created_at": "2020-10-31T23:40:01+0000"}'
+    ))
+    conn.commit()
+    conn.close()
+    rdbm_store.setup('sqlite', {'database': path})
+    assert rdbm_store.find_entities('run') == {'run-1': {
+        'job_id': 'job-01',
+        'created_at': '2020-10-31T23:40:01+0000',
+    }}
+    with rdbm_store.connection() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT COUNT(*) FROM entities')
+        assert cur.fetchall() == [(0,)]
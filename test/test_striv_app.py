@@ -61,6 +61,16 @@ def app(request, backend, logstore):
         log_level='DEBUG',
         store_type=driver,
         store_config=json.dumps(connargs),
+        store_pool_min=1,
+        store_pool_max=2,
+        store_pool_timeout=1.0,
+        store_run_partition_months=0,
+        template_layer_cache_size=1000,
+        template_workers=0,
+        template_timeout=10.0,
+        template_memory_limit=1024,
+        run_max_age_days=None,
+        run_max_runs_per_job=None,
         encryption_key=crypto.generate_key(),
     )
     striv_app.configure(striv_app.app, args)
@@ -74,9 +84,12 @@ def basicdb(app):
     app.app.store.upsert_entities(('execution', 'nomad', AN_EXECUTION))
     app.app.store.upsert_entities(('dimension', 'maturity', A_DIMENSION))
     yield
-    # TODO: Teach replace_type about relations
-    app.app.store.CONN.cursor().execute('DELETE FROM entities')
-    app.app.store.CONN.cursor().execute('DELETE FROM relations')
+    with app.app.store.connection() as conn:
+        conn.cursor().execute('DELETE FROM entities')
+        conn.cursor().execute('DELETE FROM relations')
+        conn.cursor().execute('DELETE FROM runs')
+        conn.cursor().execute('DELETE FROM run_summaries')
+        conn.cursor().execute('DELETE FROM tombstones')
 
 
 @pytest.fixture()
@@ -111,6 +124,63 @@ class TestListJobs:
         response = app.get('/jobs')
         assert response.json.keys() == {'job-1', 'job-2'}
 
+    def test_paginates_only_when_asked(self, app, monkeypatch):
+        monkeypatch.setattr(striv_app, 'DEFAULT_LIMIT', 1)
+        response = app.get('/jobs')
+        assert response.json.keys() == {'job-1', 'job-2'}
+        assert 'Link' not in response.headers
+        response = app.get('/jobs?limit=1')
+        assert response.json.keys() == {'job-1'}
+        assert 'Link' in response.headers
+
+    def test_projects_fields(self, app):
+        response = app.get('/jobs?fields=name')
+        assert response.json['job-1'] == {'name': 'ze-name'}
+
+    def test_includes_run_summary(self, app):
+        response = app.get('/jobs?fields=name&include=summary')
+        assert_that(response.json['job-1'], has_entries(
+            name='ze-name',
+            run_summary=has_entries(last_run_id='run-3', successful_7d=0)
+        ))
+
+    def test_refuses_unknown_include(self, app):
+        app.get('/jobs?include=nonesuch', status=400)
+
+
+@pytest.mark.usefixtures('basicdb')
+class TestFilterJobs:
+    @pytest.fixture(autouse=True)
+    def jobs(self, app):
+        app.app.store.upsert_entities(*[
+            ('job', 'job-%d' % n, {
+                'name': 'job-%d' % n,
+                'execution': 'nomad' if n < 4 else 'other',
+                'dimensions': {'env': 'prod' if n % 2 else 'test', 'maturity': 'operational'},
+            }) for n in range(1, 6)
+        ])
+
+    def test_filters_on_dimension_values(self, app):
+        response = app.get('/jobs?dimension=env:prod')
+        assert list(response.json) == ['job-1', 'job-3', 'job-5']
+        response = app.get(
+            '/jobs?dimension=env:prod&dimension=maturity:operational')
+        assert list(response.json) == ['job-1', 'job-3', 'job-5']
+        response = app.get('/jobs?dimension=env:prod&dimension=env:test')
+        assert response.json == {}
+
+    def test_filters_on_execution(self, app):
+        response = app.get('/jobs?execution=other&dimension=env:prod')
+        assert list(response.json) == ['job-5']
+
+    def test_paginates_by_name(self, app):
+        response = app.get('/jobs?dimension=env:prod&limit=2')
+        assert list(response.json) == ['job-1', 'job-3']
+        url = re.match('<(.*)>; rel="next"', response.headers['link'])[1]
+        response = app.get(url + '&limit=2')
+        assert list(response.json) == ['job-5']
+        assert not response.headers.get('link')
+
 
 @pytest.mark.usefixtures('basicdb')
 class TestEvaluateJob:
@@ -267,6 +337,51 @@ class TestPutJob:
             ('sync', {'some': 'config'}, 'job-1', '"ze_template"\n')
         ]
 
+    def test_put_job_skips_sync_of_unchanged_payload(self, app, backend):
+        app.app.store.upsert_entities(('job', 'job-1', A_JOB))
+        app.put_json('/job/job-1', A_JOB)
+        app.put_json('/job/job-1', dict(A_JOB, name='renamed'))
+        assert len(backend.actions) == 1
+        stored_job = app.app.store.load_entities(('job', 'job-1'))[0]
+        assert stored_job['name'] == 'renamed'
+        assert_that(stored_job, has_key('payload_fingerprint'))
+
+    def test_put_job_syncs_changed_payload(self, app, backend):
+        app.app.store.upsert_entities(('job', 'job-1', A_JOB))
+        app.put_json('/job/job-1', A_JOB)
+        app.app.store.upsert_entities(('execution', 'nomad', dict(
+            AN_EXECUTION, payload_template='"new_template"')))
+        app.put_json('/job/job-1', A_JOB)
+        assert len(backend.actions) == 2
+
+    def test_put_job_syncs_changed_params(self, app, backend):
+        app.app.store.upsert_entities(('job', 'job-1', A_JOB))
+        app.put_json('/job/job-1', A_JOB)
+        app.put_json('/job/job-1', dict(A_JOB, params={'ze_param': 'job'}))
+        assert len(backend.actions) == 2
+
+    def test_put_job_does_not_render_unchanged_job(self, app, backend, monkeypatch):
+        app.app.store.upsert_entities(('job', 'job-1', A_JOB))
+        app.put_json('/job/job-1', A_JOB)
+        parsed = []
+        monkeypatch.setitem(app.app.apply_value_parsers, 'default', parsed.append)
+        app.put_json('/job/job-1', A_JOB)
+        assert parsed == []
+
+    def test_fingerprint_is_not_exposed(self, app):
+        app.app.store.upsert_entities(('job', 'job-1', A_JOB))
+        app.put_json('/job/job-1', A_JOB)
+        assert_that(app.get('/job/job-1').json, is_not(has_key('payload_fingerprint')))
+        assert_that(app.get('/jobs').json['job-1'], is_not(has_key('payload_fingerprint')))
+        assert_that(app.get('/changes?since=0&types=job').json['changes'][-1]['entity'],
+                    is_not(has_key('payload_fingerprint')))
+
+    def test_put_job_syncs_unchanged_payload_when_forced(self, app, backend):
+        app.app.store.upsert_entities(('job', 'job-1', A_JOB))
+        app.put_json('/job/job-1', A_JOB)
+        app.put_json('/job/job-1?force=true', A_JOB)
+        assert len(backend.actions) == 2
+
     def test_put_job_returns_404_on_nonexistent_job(self, app):
         app.put_json('/job/nonsense', {}, status=404)
 
@@ -314,6 +429,15 @@ class TestListJobRuns:
     def test_returns_404_for_unknown_job(self, app):
         app.get('/job/job-3/runs', status=404)
 
+    def test_returns_empty_page_for_job_without_runs(self, app):
+        app.app.store.upsert_entities(('job', 'job-3', A_JOB))
+        assert app.get('/job/job-3/runs').json == {}
+
+    def test_projects_fields(self, app):
+        response = app.get('/job/job-1/runs?fields=created_at')
+        assert response.json['run-1'] == {
+            'created_at': '2020-10-31T23:40:00+0000'}
+
     def test_accepts_limit_and_returns_youngest_first(self, app):
         response = app.get('/job/job-1/runs?limit=2')
         assert response.json.keys() == {'run-3', 'run-2'}
@@ -340,6 +464,34 @@ class TestListJobRuns:
         app.get('/runs', {'lower': 'asdf', 'page_token': 'asdf'}, status=400)
 
 
+class TestMetrics:
+    def test_reports_pool_metrics(self, app):
+        response = app.get('/metrics')
+        assert_that(
+            response.json['store_pool'],
+            has_entries({'checkouts': greater_than(0), 'timeouts': 0})
+        )
+
+    def test_static_files_do_not_check_out_connections(self, app):
+        checkouts = app.app.store.pool_metrics()['checkouts']
+        app.get('/favicon.ico', status='*')
+        assert app.app.store.pool_metrics()['checkouts'] == checkouts
+
+    def test_reports_index_states(self, app):
+        response = app.get('/metrics')
+        assert_that(
+            response.json['store_indexes'],
+            has_entries({'dvalue': any_of('building', 'ready')})
+        )
+
+    def test_reports_cache_metrics(self, app):
+        response = app.get('/metrics')
+        assert_that(
+            response.json['store_cache'],
+            has_entries({'hits': instance_of(int), 'misses': instance_of(int)})
+        )
+
+
 class TestPublicKey:
     def test_returns_public_key(self, app):
         response = app.get('/public-key')
@@ -361,7 +513,22 @@ class TestRefreshRuns:
             'job_id': 'job-1',
             'execution': 'nomad'
         }))
-        assert response.json == {'processed': 1}
+        assert response.json == {
+            'processed': 1,
+            'inserted': 1,
+            'updated': 0,
+            'unchanged': 0
+        }
+
+    def test_reports_unchanged_runs(self, app, backend):
+        app.app.store.upsert_entities(('job', 'job-1', A_JOB))
+        backend.runs['alloc-1'] = dict(A_RUN, status='running')
+        app.post('/runs/refresh-all')
+        response = app.post('/runs/refresh-all')
+        assert_that(response.json, has_entries({'unchanged': 1, 'updated': 0}))
+        backend.runs['alloc-1'] = dict(A_RUN, status='successful')
+        response = app.post('/runs/refresh-all')
+        assert_that(response.json, has_entries({'unchanged': 0, 'updated': 1}))
 
 
 @pytest.mark.usefixtures('basicdb', 'four_runs')
@@ -373,7 +540,16 @@ class TestListRuns:
 
     def test_accepts_limit_and_returns_youngest_first(self, app):
         response = app.get('/runs?limit=2')
-        assert response.json.keys() == {'run-3', 'run-4'}
+        assert list(response.json) == ['run-4', 'run-3']
+
+    def test_projects_fields(self, app):
+        response = app.get('/runs?fields=job_id,status&fields=nonesuch')
+        assert response.json['run-1'] == {'job_id': 'job-1'}
+
+    def test_releases_connection_after_streaming(self, app):
+        response = app.get('/runs')
+        assert response.content_type == 'application/json'
+        assert app.app.store.pool_metrics()['in_use'] == 0
 
     def test_respects_paginates(self, app):
         response = app.get('/runs?limit=2')
@@ -397,6 +573,117 @@ class TestListRuns:
     def test_refuses_range_and_page_token(self, app):
         app.get('/runs', {'lower': 'asdf', 'page_token': 'asdf'}, status=400)
 
+    def test_pages_through_runs_created_in_the_same_second(self, app):
+        app.app.store.upsert_entities(*[
+            ('run', 'burst-%d' % n, {
+                'job_id': 'job-2',
+                'created_at': '2020-10-31T23:40:03+0000',
+            }) for n in range(3)
+        ])
+        seen = []
+        url = '/runs?limit=2'
+        while url:
+            response = app.get(url)
+            seen += list(response.json.keys())
+            link = response.headers.get('link')
+            url = link and re.match('<(.*)>; rel="next"', link)[1] + '&limit=2'
+        assert len(seen) == len(set(seen)) == 7
+
+    def test_filters_by_status_and_finish_time(self, app):
+        app.app.store.upsert_entities(
+            ('run', 'run-1', {
+                'job_id': 'job-1',
+                'status': 'failed',
+                'created_at': '2020-10-31T23:40:00+0000',
+                'finished_at': '2020-10-31T23:50:00+0000',
+            }),
+            ('run', 'run-2', {
+                'job_id': 'job-1',
+                'status': 'successful',
+                'created_at': '2020-10-31T23:40:01+0000',
+                'finished_at': '2020-10-31T23:45:00+0000',
+            }),
+        )
+        response = app.get('/runs', [
+            ('status', 'successful'),
+            ('status', 'failed'),
+        ])
+        assert response.json.keys() == {'run-1', 'run-2'}
+        response = app.get('/job/job-1/runs', [
+            ('status', 'successful'),
+            ('status', 'failed'),
+            ('finished_after', '2020-10-31T23:45:00+0000'),
+        ])
+        assert response.json.keys() == {'run-1'}
+
+    def test_refuses_malformed_finished_after(self, app):
+        app.get('/runs', {'finished_after': 'yesterday'}, status=400)
+
+    def test_pagination_keeps_lower_bound(self, app):
+        response = app.get('/runs', {
+            'limit': 1,
+            'lower': '2020-10-31T23:40:02+0000',
+        })
+        url = re.match('<(.*)>; rel="next"', response.headers['link'])[1]
+        response = app.get(url + '&limit=2')
+        assert response.json.keys() == {'run-3'}
+        assert not response.headers.get('link')
+
+
+@pytest.mark.usefixtures('basicdb', 'four_runs')
+class TestRunStats:
+    def test_groups_by_job_and_bucket(self, app):
+        response = app.get('/runs/stats?group_by=job,bucket&bucket_size=day')
+        assert_that(response.json['groups'], contains_exactly(
+            has_entries(job_id='job-1', bucket='2020-10-31T00:00:00+0000', count=3),
+            has_entries(job_id='job-2', bucket='2020-10-31T00:00:00+0000', count=1),
+        ))
+
+    def test_filters_runs(self, app):
+        response = app.get('/runs/stats?job=job-1&upper=2020-10-31T23:40:01%2B0000')
+        assert response.json['groups'][0]['count'] == 2
+
+    @pytest.mark.parametrize('query', [
+        'group_by=nonesuch',
+        'bucket_size=week',
+        'percentiles=101',
+        'percentiles=high',
+    ])
+    def test_refuses_bad_parameters(self, app, query):
+        app.get('/runs/stats?' + query, status=400)
+
+
+@pytest.mark.usefixtures('basicdb')
+class TestPurgeRuns:
+    @pytest.fixture(autouse=True)
+    def finished_runs(self, app):
+        app.app.store.upsert_entities(*[
+            ('run', 'run-%d' % n, dict(
+                A_RUN, execution='nomad', status='successful',
+                created_at='2020-10-31T23:40:0%d+0000' % n))
+            for n in range(3)
+        ])
+
+    def test_applies_execution_retention(self, app):
+        app.app.store.upsert_entities(('execution', 'nomad', dict(
+            AN_EXECUTION, retention={'max_runs_per_job': 2})))
+        assert app.post('/runs/purge').json == {'deleted': 1}
+        assert app.get('/runs').json.keys() == {'run-1', 'run-2'}
+
+    def test_keeps_runs_without_retention(self, app):
+        assert app.post('/runs/purge').json == {'deleted': 0}
+
+    def test_only_purges_archived_runs_when_archiving(self, app):
+        app.app.archiving = True
+        app.app.run_retention = {'max_runs_per_job': 1}
+        try:
+            assert app.post('/runs/purge').json == {'deleted': 0}
+            app.get('/run/run-0/logs')
+            assert app.post('/runs/purge?batch_size=10').json == {'deleted': 1}
+        finally:
+            app.app.archiving = False
+            app.app.run_retention = {}
+
 
 @pytest.mark.usefixtures('basicdb', 'four_runs')
 class TestGetRun:
@@ -443,6 +730,12 @@ class TestDumpState:
             'executions': {'nomad': AN_EXECUTION}
         }
 
+    def test_projects_fields(self, app):
+        assert app.get('/state?fields=name,priority').json == {
+            'dimensions': {'maturity': {'priority': 10}},
+            'executions': {'nomad': {'name': 'Production Nomad'}}
+        }
+
     def test_roundtrip(self, app):
         state = app.get('/state').json
         assert app.post_json('/state', state).json == {
@@ -486,3 +779,37 @@ class TestLoadState:
         assert app.app.store.load_entities(
             ('execution', 'another-execution')
         ) == [AN_EXECUTION]
+
+
+@pytest.mark.usefixtures('basicdb')
+class TestChanges:
+    def test_lists_changes_since(self, app):
+        last_seq = app.get('/changes?since=0').json['last_seq']
+        job_id = app.post_json('/jobs', A_JOB).json['id']
+        response = app.get('/changes?since=%d&types=job' % last_seq)
+        assert_that(response.json['changes'], contains_exactly(
+            has_entries({'type': 'job', 'id': job_id, 'seq': last_seq + 1, 'entity': has_key('name')})))
+        app.delete('/job/%s' % job_id)
+        response = app.get('/changes?since=%d&types=job' % last_seq)
+        assert_that(response.json['changes'], contains_exactly(
+            has_entries({'type': 'job', 'id': job_id, 'seq': last_seq + 2, 'deleted': True})))
+
+    def test_links_next_page(self, app):
+        response = app.get('/changes?since=0&limit=1')
+        first_seq = response.json['last_seq']
+        assert response.headers['Link'] == '</changes?since=%d&limit=1>; rel="next"' % first_seq
+        last_seq = app.get('/changes?since=0').json['last_seq']
+        response = app.get('/changes?since=%d' % last_seq)
+        assert response.json == {'changes': [], 'last_seq': last_seq, 'head': last_seq}
+        assert 'Link' not in response.headers
+
+    def test_reports_head(self, app):
+        head = app.get('/changes?since=0&limit=1').json['head']
+        assert head == app.get('/changes?since=0').json['last_seq']
+        job_id = app.post_json('/jobs', A_JOB).json['id']
+        response = app.get('/changes?since=%d' % head)
+        assert_that(response.json['changes'], contains_exactly(has_entries(id=job_id)))
+
+    def test_requires_since(self, app):
+        app.get('/changes', status=400)
+        app.get('/changes?since=x', status=400)
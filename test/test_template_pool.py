@@ -0,0 +1,101 @@
+# pylint: disable = missing-class-docstring, missing-function-docstring, no-self-use, redefined-outer-name
+import json
+import threading
+import time
+
+import pytest
+from hamcrest import *  # pylint: disable = unused-wildcard-import
+
+from striv.template_pool import EvaluationTimeout, EvaluatorPool
+
+SLOW_SNIPPET = 'local fib(n) = if n < 2 then n else fib(n - 1) + fib(n - 2); fib(40)'
+
+
+@pytest.fixture()
+def pool():
+    pool = EvaluatorPool(2, timeout=1.0, memory_limit=512 * 1024 * 1024)
+    yield pool
+    pool.close()
+
+
+def test_evaluates_snippet(pool):
+    assert json.loads(pool.evaluate_snippet('ze-snippet', '{prip: 1 + 1}')) == {'prip': 2}
+    assert_that(pool.metrics(), has_entries(evaluations=1, idle=2, busy=0, queued=0))
+
+
+def test_raises_evaluation_errors(pool):
+    assert_that(
+        calling(pool.evaluate_snippet).with_args('ze-snippet', '{prip: "}'),
+        raises(RuntimeError, pattern='ze-snippet.*unterminated string')
+    )
+    assert pool.metrics()['restarts'] == 0
+
+
+def test_replaces_worker_on_timeout(pool):
+    assert_that(
+        calling(pool.evaluate_snippet).with_args('ze-snippet', SLOW_SNIPPET),
+        raises(EvaluationTimeout)
+    )
+    assert_that(pool.metrics(), has_entries(timeouts=1, restarts=1, idle=2))
+    assert pool.evaluate_snippet('ze-snippet', '1') == '1\n'
+
+
+def test_times_out_waiting_for_worker(pool):
+    slow = [threading.Thread(target=lambda: pytest.raises(
+        EvaluationTimeout, pool.evaluate_snippet, 'slow', SLOW_SNIPPET, timeout=3.0)) for _ in range(2)]
+    for thread in slow:
+        thread.start()
+    while pool.metrics()['busy'] < 2:
+        time.sleep(0.01)
+    assert_that(
+        calling(pool.evaluate_snippet).with_args('ze-snippet', '1', timeout=0.1),
+        raises(EvaluationTimeout, pattern='No template worker available after 0.1s')
+    )
+    for thread in slow:
+        thread.join()
+    assert pool.metrics()['waits'] == 1
+
+
+def test_shrinks_when_worker_cannot_be_replaced(pool, monkeypatch):
+    def fail():
+        raise OSError('Resource temporarily unavailable')
+    monkeypatch.setattr(pool, '_start', fail)
+    for _ in range(2):
+        assert_that(
+            calling(pool.evaluate_snippet).with_args('ze-snippet', SLOW_SNIPPET, timeout=0.1),
+            raises(EvaluationTimeout)
+        )
+    assert_that(pool.metrics(), has_entries(start_failures=2, restarts=0, size=0, busy=0))
+    assert_that(
+        calling(pool.evaluate_snippet).with_args('ze-snippet', '1'),
+        raises(RuntimeError, pattern='no workers left')
+    )
+
+
+def test_wakes_waiters_when_pool_shrinks(pool, monkeypatch):
+    def fail():
+        raise OSError('Resource temporarily unavailable')
+    monkeypatch.setattr(pool, '_start', fail)
+    slow = [threading.Thread(target=lambda: pytest.raises(
+        EvaluationTimeout, pool.evaluate_snippet, 'slow', SLOW_SNIPPET, timeout=0.5)) for _ in range(2)]
+    for thread in slow:
+        thread.start()
+    while pool.metrics()['busy'] < 2:
+        time.sleep(0.01)
+    started = time.monotonic()
+    assert_that(
+        calling(pool.evaluate_snippet).with_args('ze-snippet', '1', timeout=30.0),
+        raises(RuntimeError, pattern='no workers left')
+    )
+    assert time.monotonic() - started < 10.0
+    for thread in slow:
+        thread.join()
+
+
+def test_replaces_worker_exceeding_memory_limit(pool):
+    assert_that(
+        calling(pool.evaluate_snippet).with_args(
+            'ze-snippet', 'std.length(std.join("", std.makeArray(100000000, function(i) "x")))'),
+        raises(RuntimeError)
+    )
+    assert pool.evaluate_snippet('ze-snippet', '1') == '1\n'
@@ -85,6 +85,57 @@ class TestMaterializeLayer:
         )
 
 
+class TestLayerCache:
+    @pytest.fixture(autouse=True)
+    def cache(self):
+        templating.setup_layer_cache(2)
+        yield
+        templating.setup_layer_cache(1000)
+
+    def _counted(self, value_parsers):
+        calls = []
+
+        def counting(value):
+            calls.append(value)
+            return value
+        value_parsers['default'] = counting
+        return calls
+
+    def test_reuses_materialized_layer(self, value_parsers):
+        calls = self._counted(value_parsers)
+        before = templating.layer_cache_metrics()
+        for _ in range(3):
+            layer = templating.materialize_layer('ze-layer', {'prip': 'prop'}, value_parsers)
+        assert layer == ('ze-layer', '{prip: "prop"}')
+        assert calls == ['prop']
+        after = templating.layer_cache_metrics()
+        assert after['hits'] - before['hits'] == 2
+        assert after['misses'] - before['misses'] == 1
+
+    def test_keys_on_value_parsers(self, value_parsers):
+        templating.materialize_layer('ze-layer', {'prip': 'prop'}, value_parsers)
+        layer = templating.materialize_layer(
+            'ze-layer', {'prip': 'prop'}, dict(value_parsers, default=lambda v: v.upper()))
+        assert layer == ('ze-layer', '{prip: "PROP"}')
+
+    def test_evicts_least_recently_used(self, value_parsers):
+        calls = self._counted(value_parsers)
+        for value in ['a', 'b', 'a', 'c', 'a', 'b']:
+            templating.materialize_layer('ze-layer', {'prip': value}, value_parsers)
+        assert calls == ['a', 'b', 'c', 'b']
+        assert templating.layer_cache_metrics()['size'] == 2
+
+    def test_does_not_cache_sensitive_values(self, value_parsers):
+        value_parsers['secret'] = templating.sensitive(lambda v: 'cleartext')
+        params = {'prip': {'_striv_type': 'secret', 'encrypted': 'xyz'}}
+        before = templating.layer_cache_metrics()
+        layer = templating.materialize_layer('ze-layer', params, value_parsers)
+        assert layer == ('ze-layer', '{prip: "cleartext"}')
+        after = templating.layer_cache_metrics()
+        assert after['uncached'] - before['uncached'] == 1
+        assert after['size'] == 0
+
+
 def test_merge_layers_uses_jsonnet_inheritance():
     snippet1 = '{prip: "prop"}'
     snippet2 = '{prup: self.prip + "prap"}'
@@ -92,7 +143,7 @@ def test_merge_layers_uses_jsonnet_inheritance():
         ('layer1', snippet1),
         ('layer2', snippet2)
     )
-    assert merged == '%s + %s' % (snippet1, snippet2)
+    assert json.loads(merged) == {'prip': 'prop', 'prup': 'propprap'}
 
 
 def test_merge_layers_complains_on_invalid_first_layer():
@@ -117,13 +168,45 @@ def test_merge_layers_complains_on_invalid_second_layer():
     )
 
 
+def test_merge_layers_points_to_first_failing_layer():
+    layers = [('layer%d' % n, '{prip%d: %d}' % (n, n)) for n in range(6)]
+    layers[3] = ('layer3', '{prap: self.prip9}')
+    assert_that(
+        calling(templating.merge_layers).with_args(*layers),
+        raises(templating.ValidationError,
+               pattern='(?s)prip9.*layer3:')
+    )
+
+
+def test_merge_layers_evaluates_valid_layers_once(monkeypatch):
+    evaluated = []
+    evaluate = templating._evaluate  # pylint: disable = protected-access
+
+    def counting(name, snippet):
+        evaluated.append(name)
+        return evaluate(name, snippet)
+    monkeypatch.setattr(templating, '_evaluate', counting)
+    templating.merge_layers(
+        *[('layer%d' % n, '{prip%d: %d}' % (n, n)) for n in range(10)])
+    assert evaluated == ['layer9']
+
+
 def test_evaluate():
     template = '{prip: params.prip + 1}'
-    param_snippet = '{prip: 1}'
-    payload = templating.evaluate(template, param_snippet)
+    payload = templating.evaluate(template, '{"prip": 1}')
     assert _compact_json(payload) == '{"prip": 2}'
 
 
+def test_evaluate_in_worker_pool():
+    templating.setup_evaluation(workers=1, timeout=5.0)
+    try:
+        payload = templating.evaluate('{prip: params.prip + 1}', '{"prip": 1}')
+        assert _compact_json(payload) == '{"prip": 2}'
+        assert templating.evaluation_metrics()['evaluations'] == 1
+    finally:
+        templating.setup_evaluation(workers=0)
+
+
 def test_evaluate_compains_on_invalid_snippet():
     template = '{prip: "}'
     assert_that(